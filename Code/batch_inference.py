@@ -0,0 +1,132 @@
+import json
+import numpy as np
+import xgboost as xgb
+from scipy import sparse
+from joblib import Parallel, delayed
+from scheduler import plan_cores
+
+# Ensemble weighting schemes ('follow_the_leader' is another name for 'cv_method')
+WEIGHTING_SCHEMES = ['equal', 'inverse_error', 'softmax', 'cv_method', 'follow_the_leader']
+
+
+def check_weighting(weighting):
+    if weighting not in WEIGHTING_SCHEMES:
+        raise ValueError(f"Invalid weighting. Please choose from {WEIGHTING_SCHEMES}.")
+
+
+def feature_subset(model):
+    """
+    Positions (in INDEP_VARS) of the features a model was trained on, if `estimate_xgb`
+    selected a subset of them for its month (None if it uses all of them).
+    """
+    subset = model.get_booster().attr('feature_subset')
+    return None if subset is None else np.asarray(json.loads(subset), dtype=np.int64)
+
+
+def member_dmatrices(models, X, feature_types=None, nthread=None):
+    """
+    DMatrix of a sample for each member of an ensemble. Members trained on the same
+    features (all of them, unless `estimate_xgb` selected a subset) share one DMatrix.
+
+    :return: List with the DMatrix of each model.
+    """
+    dmatrices = {}
+    member_matrices = []
+    for model in models:
+        subset = feature_subset(model)
+        key = None if subset is None else tuple(subset)
+        if key not in dmatrices:
+            matrix_args = {}
+            if feature_types is not None:
+                types = feature_types if subset is None else [feature_types[j] for j in subset]
+                matrix_args = {'feature_types': types, 'enable_categorical': True}
+            dmatrices[key] = xgb.DMatrix(X if subset is None else X[:, subset], nthread=nthread, **matrix_args)
+        member_matrices.append(dmatrices[key])
+    return member_matrices
+
+
+def predict_members(models, X, n_cores=None, inplace=False, feature_types=None):
+    """
+    Predictions of every member of an ensemble for the same sample, stacked in a
+    (members x rows) matrix.
+
+    The sample is converted once into a DMatrix shared by all the boosters (instead of
+    once per model and call, as `model.predict` does; members trained on a subset of the
+    features share one per subset), and the members predict at the same
+    time on threads (XGBoost releases the GIL while predicting). With `inplace=True` the
+    boosters predict straight from the NumPy array (`inplace_predict`), without a DMatrix.
+
+    :param models: List of fitted XGBRegressor models.
+    :param X: Array or DataFrame with the features of the sample.
+    :param n_cores: Integer, cores to use (all cores if None), split between members and booster threads.
+    :param inplace: Boolean, whether to use `inplace_predict`.
+    :param feature_types: List of XGBoost feature types ('q', 'c'), for models with categorical features.
+    :return: NumPy array of shape (number of models, number of rows).
+    """
+    if not sparse.issparse(X):
+        X = np.ascontiguousarray(X, dtype=np.float32)
+    if len(models) == 0:
+        return np.zeros((0, X.shape[0]))
+
+    # Members predicting at the same time, and threads per booster
+    core_plan = plan_cores(n_cores, n_months=1, n_search_tasks=len(models))
+    boosters = [model.get_booster() for model in models]
+    for booster in boosters:
+        booster.set_param({'nthread': core_plan.booster_jobs})
+
+    if inplace:
+        subsets = [feature_subset(model) for model in models]
+        predict = lambda i: boosters[i].inplace_predict(X if subsets[i] is None else X[:, subsets[i]])
+    else:
+        dmatrices = member_dmatrices(models, X, feature_types, nthread=core_plan.total_cores)
+        predict = lambda i: boosters[i].predict(dmatrices[i])
+
+    predictions = Parallel(n_jobs=core_plan.search_jobs, backend='threading')(
+        delayed(predict)(i) for i in range(len(boosters))
+    )
+    return np.vstack(predictions)
+
+
+def ensemble_weights(member_errors=None, n_members=None, weighting='equal', temperature=1.0):
+    """
+    Weights of the members of an ensemble, for one or several error metrics at once.
+
+    :param member_errors: Array (metrics x members) with each member's error in the previous
+                          month (not needed for equal weights).
+    :param n_members: Integer, number of members (only needed for equal weights without errors).
+    :param weighting: String, 'equal' (simple average), 'inverse_error' (weights proportional
+                      to 1 / error), 'softmax' (weights proportional to exp(-error / (temperature
+                      * mean error))) or 'cv_method' / 'follow_the_leader' (all the weight on the
+                      member with the smallest error, shared in case of ties).
+    :param temperature: Float, for softmax weights: the larger, the closer to equal weights.
+    :return: Array (metrics x members) with rows that sum to 1.
+    """
+    check_weighting(weighting)
+
+    if weighting == 'equal':
+        if member_errors is not None:
+            n_metrics, n_members = np.shape(member_errors)
+        else:
+            n_metrics = 1
+        return np.full((n_metrics, n_members), 1 / n_members)
+
+    member_errors = np.atleast_2d(np.asarray(member_errors, dtype=np.float64))
+    if weighting == 'inverse_error':
+        weights = 1 / member_errors
+    elif weighting == 'softmax':
+        # Errors relative to the mean error of each metric, so the temperature doesn't
+        # depend on the scale of the metric
+        scaled = member_errors / (temperature * member_errors.mean(axis=1, keepdims=True))
+        weights = np.exp(-(scaled - scaled.min(axis=1, keepdims=True)))
+    else:
+        weights = (member_errors == member_errors.min(axis=1, keepdims=True)).astype(np.float64)
+    return weights / weights.sum(axis=1, keepdims=True)
+
+
+def weighted_predictions(member_predictions, weights):
+    """
+    Ensemble predictions for every weighting at once: (weightings x members) @ (members x rows).
+    A single vector of weights returns a single vector of predictions.
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    return weights @ member_predictions
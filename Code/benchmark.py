@@ -0,0 +1,358 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import resource
+import tempfile
+import subprocess
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+from load_data import encode_locations
+from feature_layout import FEATURE_LAYOUTS
+from training_engine import ENGINES
+
+DEP_VAR = ['price_realpesos']
+
+# Features of the listings besides the location dummies, as in the cleaned data
+BASE_VARS = ['house', 'covered_area', 'uncovered_area', 'bedrooms', 'bathrooms',
+             'pool', 'security', 'furnished', 'heating', 'air_conditioning',
+             'parking', 'common_space', 'fitness_space',
+             'distance_to_transport', 'distance_to_greenspace',
+             'longitude', 'latitude']
+
+# Small grid for the tuned benchmarks
+BENCHMARK_GRID = [{'max_depth': [3, 6], 'n_estimators': [50, 100]}]
+
+
+def make_listings(n_rows=50_000, n_months=24, n_neighbourhoods=48, n_communes=15,
+                  first_month='2018-01-01', seed_=789):
+    """
+    Synthetic listings with the schema of the cleaned Buenos Aires data: 'listing_month',
+    'price_realpesos', the `BASE_VARS` and the `nei_*` / `commune_*` dummies (48
+    neighbourhoods grouped in 15 communes by default, encoded as `load_data.encode_locations` does).
+
+    Neighbourhoods are points spread over the city's bounding box and listings are drawn
+    around them, so locations, distances and prices are spatially correlated. Prices grow
+    with the covered area and amenities, differ by neighbourhood and drift from month to month.
+
+    :param n_rows: Integer, number of listings (spread evenly over the months).
+    :param n_months: Integer, number of months.
+    :return: DataFrame sorted by month.
+    """
+    rng = np.random.default_rng(seed_)
+
+    # Neighbourhood centres in the city's bounding box, their commune and price level
+    centres = np.column_stack([rng.uniform(-58.53, -58.34, n_neighbourhoods),
+                               rng.uniform(-34.70, -34.53, n_neighbourhoods)])
+    neighbourhood_commune = np.arange(n_neighbourhoods) % n_communes + 1
+    neighbourhood_effect = rng.normal(0, 0.25, n_neighbourhoods)
+
+    neighbourhood = rng.integers(0, n_neighbourhoods, n_rows)
+    months = pd.date_range(first_month, periods=n_months, freq='MS')
+    month = np.sort(rng.integers(0, n_months, n_rows))
+
+    df = pd.DataFrame({
+        'listing_month': months[month],
+        'neighbourhood': [f'BARRIO {i + 1}' for i in neighbourhood],
+        'commune': [f'COMUNA {neighbourhood_commune[i]}' for i in neighbourhood],
+        'house': rng.random(n_rows) < 0.15,
+        'covered_area': np.round(rng.lognormal(4.1, 0.5, n_rows)),
+        'uncovered_area': np.round(rng.exponential(8, n_rows)),
+        'bedrooms': rng.integers(0, 5, n_rows),
+        'bathrooms': rng.integers(1, 4, n_rows),
+        'longitude': centres[neighbourhood, 0] + rng.normal(0, 0.01, n_rows),
+        'latitude': centres[neighbourhood, 1] + rng.normal(0, 0.01, n_rows),
+    })
+    for amenity in ['pool', 'security', 'furnished', 'heating', 'air_conditioning', 'parking',
+                    'common_space', 'fitness_space']:
+        df[amenity] = (rng.random(n_rows) < 0.3).astype(np.int64)
+    df['house'] = df['house'].astype(np.int64)
+    df['distance_to_transport'] = rng.gamma(2, 250, n_rows)
+    df['distance_to_greenspace'] = rng.gamma(2, 400, n_rows)
+
+    log_price = (9.5 + 0.8 * np.log(df['covered_area']) + 0.002 * df['uncovered_area']
+                 + 0.05 * df['bathrooms'] + 0.1 * df[['pool', 'security', 'parking']].sum(axis=1)
+                 - 0.0001 * df['distance_to_transport'] + neighbourhood_effect[neighbourhood]
+                 + 0.01 * month + rng.normal(0, 0.2, n_rows))
+    df['price_realpesos'] = np.exp(log_price)
+
+    return encode_locations(df).drop(columns=['neighbourhood', 'commune'])
+
+
+def feature_columns(df):
+    """INDEP_VARS of a synthetic data frame: the `BASE_VARS` and its location dummies."""
+    return BASE_VARS + [col for col in df.columns if col.startswith('nei_') or col.startswith('commune_')]
+
+
+def benchmark_cases(window_sizes):
+    """Names of all the benchmarks for the given window sizes."""
+    cases = [f'estimate_xgb_ws{ws}' for ws in window_sizes]
+    cases += [f'estimate_xgb_tuned_ws{ws}' for ws in window_sizes]
+    cases += ['estimate_xgb_parallel', 'run_ensemble', 'ensemble_predict']
+    cases += [f'estimate_xgb_layout_{layout}' for layout in FEATURE_LAYOUTS]
+    cases += [f'estimate_xgb_engine_{engine}' for engine in ENGINES]
+    return cases
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def _save_ensemble_models(df, INDEP_VARS, window_sizes, model_dir, n_cores):
+    # Models and error metrics of every window size, as run_ensemble reads them
+    from estimate_xgboost import estimate_xgb_multiwindow
+    estimate_xgb_multiwindow(df, DEP_VAR, INDEP_VARS, time_window_sizes=window_sizes,
+                             error_metric=['rmse', 'mae', 'mape', 'mdae'], save_model_path=model_dir,
+                             error_metrics_path=model_dir, experiment_n=0, n_cores=n_cores)
+
+
+def run_case(case, n_rows, n_months, window_sizes, n_cores=None, seed_=789):
+    """
+    Time one benchmark in this process. Data generation and setup (e.g. the models that
+    the ensemble benchmarks load) are not timed.
+
+    The `estimate_xgb_layout_<layout>` benchmarks fit the smallest window size with each
+    feature layout of the location dummies, to compare them with the dense dummies. The
+    `estimate_xgb_engine_<engine>` benchmarks run the tuned backtest of the smallest window
+    size with each training engine, to compare the accuracy and time of hist against exact.
+
+    :return: Dictionary with the seconds, the throughput and the peak RSS of the process
+        (and the mean RMSE of the estimate_xgb benchmarks).
+    """
+    df = make_listings(n_rows, n_months, seed_=seed_)
+    INDEP_VARS = feature_columns(df)
+    n_predicted = len(df)
+    rmse = None
+
+    with tempfile.TemporaryDirectory() as model_dir:
+        if case.startswith('estimate_xgb_ws') or case.startswith('estimate_xgb_tuned_ws'):
+            from estimate_xgboost import estimate_xgb
+            tuned = case.startswith('estimate_xgb_tuned_ws')
+            ws = int(case.split('_ws')[-1])
+            start = time.perf_counter()
+            results = estimate_xgb(df, DEP_VAR, INDEP_VARS, time_window_size=ws, tune_hyperparams=tuned,
+                                   parameter_grid=[dict(grid) for grid in BENCHMARK_GRID], n_cores=n_cores,
+                                   seed_=seed_)
+            seconds = time.perf_counter() - start
+            rmse = results['rmse'].mean()
+
+        elif case.startswith('estimate_xgb_layout_'):
+            from estimate_xgboost import estimate_xgb
+            start = time.perf_counter()
+            results = estimate_xgb(df, DEP_VAR, INDEP_VARS, time_window_size=min(window_sizes),
+                                   feature_layout=case[len('estimate_xgb_layout_'):], n_cores=n_cores,
+                                   seed_=seed_)
+            seconds = time.perf_counter() - start
+            rmse = results['rmse'].mean()
+
+        elif case.startswith('estimate_xgb_engine_'):
+            from estimate_xgboost import estimate_xgb
+            start = time.perf_counter()
+            results = estimate_xgb(df, DEP_VAR, INDEP_VARS, time_window_size=min(window_sizes), tune_hyperparams=True,
+                                   parameter_grid=[dict(grid) for grid in BENCHMARK_GRID],
+                                   engine=case[len('estimate_xgb_engine_'):], n_cores=n_cores, seed_=seed_)
+            seconds = time.perf_counter() - start
+            rmse = results['rmse'].mean()
+
+        elif case == 'estimate_xgb_parallel':
+            from estimate_xgboost_parallel import estimate_xgb_parallel
+            start = time.perf_counter()
+            estimate_xgb_parallel(df, DEP_VAR=DEP_VAR, INDEP_VARS=INDEP_VARS, no_tuning=True,
+                                  n_cores=n_cores, seed_=seed_)
+            seconds = time.perf_counter() - start
+
+        elif case == 'run_ensemble':
+            from ensemble_model import run_ensemble
+            _save_ensemble_models(df, INDEP_VARS, window_sizes, model_dir, n_cores)
+            start = time.perf_counter()
+            run_ensemble(df, DEP_VAR, INDEP_VARS, os.path.join(model_dir, 'not_tuned'), model_dir, 0,
+                         weighting='inverse_error', time_window_sizes=list(window_sizes),
+                         n_cores=n_cores, seed_=seed_)
+            seconds = time.perf_counter() - start
+            n_predicted = int((df['listing_month'] >= sorted(df['listing_month'].unique())[max(window_sizes)]).sum())
+
+        elif case == 'ensemble_predict':
+            from ensemble_model import ensemble_predict
+            from model_store import get_model_store
+            _save_ensemble_models(df, INDEP_VARS, window_sizes, model_dir, n_cores)
+            model_store = get_model_store(model_dir)
+            models = model_store.load_ensemble(window_sizes, df['listing_month'].max(), 'not_tuned', False)
+            X = df[INDEP_VARS].to_numpy(dtype=np.float32)
+            start = time.perf_counter()
+            ensemble_predict(models, X, n_cores=n_cores, inplace_predict=True)
+            seconds = time.perf_counter() - start
+
+        else:
+            raise ValueError(f"Invalid case. Please choose from {benchmark_cases(window_sizes)}.")
+
+    result = {
+        'seconds': seconds,
+        'rows_per_second': n_predicted / seconds,
+        'months_per_second': n_months / seconds,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    if rmse is not None:
+        result['rmse'] = float(rmse)
+    return result
+
+
+def _run_case_subprocess(case, n_rows, n_months, window_sizes, n_cores, seed_):
+    # A fresh process per benchmark, so that its peak RSS is its own
+    command = [sys.executable, os.path.abspath(__file__), '--run-case', case,
+               '--rows', str(n_rows), '--months', str(n_months),
+               '--window-sizes', ','.join(str(ws) for ws in window_sizes), '--seed', str(seed_)]
+    if n_cores is not None:
+        command += ['--cores', str(n_cores)]
+    completed = subprocess.run(command, capture_output=True, text=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+    if completed.returncode != 0:
+        raise RuntimeError(f"Benchmark {case} failed:\n{completed.stderr}")
+    # The estimation functions print progress, the result is the last line
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def compare_to_baseline(report, baseline, tolerance=0.1):
+    """
+    Change in seconds and peak RSS of every benchmark against a stored baseline report.
+
+    :param tolerance: Float, relative slowdown above which a benchmark is flagged as a regression.
+    :return: Dictionary by benchmark with the baseline values, the relative changes and a
+        'regression' flag. Reports run with a different data size are not comparable.
+    """
+    comparable = baseline.get('config', {}).get('n_rows') == report['config']['n_rows'] \
+        and baseline.get('config', {}).get('n_months') == report['config']['n_months']
+    comparison = {}
+    for case, values in report['cases'].items():
+        if case not in baseline.get('cases', {}):
+            continue
+        base = baseline['cases'][case]
+        seconds_change = values['seconds'] / base['seconds'] - 1
+        comparison[case] = {
+            'baseline_seconds': base['seconds'],
+            'seconds_change': seconds_change,
+            'peak_rss_change': values['peak_rss_mb'] / base['peak_rss_mb'] - 1,
+            'regression': bool(comparable and seconds_change > tolerance),
+        }
+    return {'comparable': comparable, 'tolerance': tolerance, 'cases': comparison}
+
+
+def compare_engines(report, reference='exact'):
+    """
+    Speed-up and change in mean RMSE of each training engine against the reference engine,
+    from the `estimate_xgb_engine_<engine>` benchmarks of a report.
+
+    :return: Dictionary by engine (empty if the reference engine wasn't benchmarked).
+    """
+    cases = report['cases']
+    base = cases.get(f'estimate_xgb_engine_{reference}')
+    if base is None:
+        return {}
+    comparison = {}
+    for engine in ENGINES:
+        values = cases.get(f'estimate_xgb_engine_{engine}')
+        if engine == reference or values is None:
+            continue
+        comparison[engine] = {'speedup': base['seconds'] / values['seconds'],
+                              'rmse_change': values['rmse'] / base['rmse'] - 1}
+    return comparison
+
+
+def run_benchmarks(
+        cases=None,
+        n_rows=50_000,
+        n_months=24,
+        window_sizes=[1, 3, 6, 12],
+        n_cores=None,
+        repeat=1,
+        output_path=None,
+        baseline_path=None,
+        tolerance=0.1,
+        verbose=True,
+        seed_=789
+        ):
+    """
+    Time the estimation and ensemble paths on synthetic data, each benchmark in its own process.
+
+    :param cases: List of benchmarks to run (all of `benchmark_cases(window_sizes)` if None).
+    :param n_rows: Integer, listings of the synthetic data.
+    :param n_months: Integer, months of the synthetic data.
+    :param window_sizes: List of window sizes (one estimate_xgb benchmark each, and the ensemble members).
+    :param repeat: Integer, runs of each benchmark (the fastest is kept).
+    :param output_path: String, JSON file where the report is saved (not saved if None).
+    :param baseline_path: String, JSON report of an earlier run to compare against (no comparison if None).
+    :param tolerance: Float, relative slowdown flagged as a regression.
+    :return: Dictionary with the configuration, the environment, the results of every
+        benchmark and the comparison against the baseline.
+    """
+    if cases is None:
+        cases = benchmark_cases(window_sizes)
+
+    report = {
+        'config': {'n_rows': n_rows, 'n_months': n_months, 'window_sizes': list(window_sizes),
+                   'n_cores': n_cores, 'repeat': repeat, 'seed': seed_},
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpu_count': os.cpu_count(), 'numpy': np.__version__, 'pandas': pd.__version__,
+                        'xgboost': xgb.__version__},
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'cases': {},
+    }
+
+    for case in cases:
+        runs = [_run_case_subprocess(case, n_rows, n_months, window_sizes, n_cores, seed_) for _ in range(repeat)]
+        best = min(runs, key=lambda run: run['seconds'])
+        best['peak_rss_mb'] = max(run['peak_rss_mb'] for run in runs)
+        report['cases'][case] = best
+        if verbose:
+            print(f"{case}: {best['seconds']:.2f} s, {best['rows_per_second']:,.0f} rows/s, "
+                  f"peak RSS {best['peak_rss_mb']:.0f} MB")
+
+    # Accuracy and time of the hist engine against exact, on the same tuned backtest
+    report['engines'] = compare_engines(report)
+    if verbose:
+        for engine, values in report['engines'].items():
+            print(f"{engine} vs exact: {values['speedup']:.2f}x faster, RMSE {values['rmse_change']:+.2%}")
+
+    if baseline_path is not None:
+        with open(baseline_path) as f:
+            report['baseline'] = compare_to_baseline(report, json.load(f), tolerance)
+        if verbose:
+            for case, values in report['baseline']['cases'].items():
+                print(f"{case}: {values['seconds_change']:+.1%} vs baseline"
+                      f"{' (regression)' if values['regression'] else ''}")
+
+    if output_path is not None:
+        with open(output_path, 'w') as f:
+            json.dump(report, f, indent=1)
+
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the estimation and ensemble paths on synthetic data.')
+    parser.add_argument('--cases', default=None, help='Comma-separated benchmarks (all if not given)')
+    parser.add_argument('--rows', type=int, default=50_000)
+    parser.add_argument('--months', type=int, default=24)
+    parser.add_argument('--window-sizes', default='1,3,6,12', help='Comma-separated window sizes')
+    parser.add_argument('--cores', type=int, default=None)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--output', default=None, help='JSON file for the report')
+    parser.add_argument('--baseline', default=None, help='JSON report to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=789)
+    parser.add_argument('--run-case', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    window_sizes = [int(ws) for ws in args.window_sizes.split(',')]
+    if args.run_case is not None:
+        print(json.dumps(run_case(args.run_case, args.rows, args.months, window_sizes, args.cores, args.seed)))
+    else:
+        run_benchmarks(cases=args.cases.split(',') if args.cases else None, n_rows=args.rows,
+                       n_months=args.months, window_sizes=window_sizes, n_cores=args.cores,
+                       repeat=args.repeat, output_path=args.output, baseline_path=args.baseline,
+                       tolerance=args.tolerance, seed_=args.seed)
@@ -0,0 +1,97 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import numpy as np
+
+# Default maximum number of fold scores kept on disk
+DEFAULT_MAX_ENTRIES = 1_000_000
+
+
+def fold_key(context, train_idx, valid_idx, params, n_samples=None, months=None):
+    """
+    Key of one cross-validation fit: a hash of the context (CV scheme, engine, sample
+    weight scheme...), the data of the fold, and the parameters.
+
+    The data of the fold is the hashes of the months its rows span (`months`), and its
+    training and validation rows relative to the first row of those months. A fold with the
+    same rows of the same months gets the same key in any window and experiment.
+    """
+    h = hashlib.sha1()
+    h.update(json.dumps(context, sort_keys=True, default=str).encode())
+    h.update(json.dumps(months).encode())
+    h.update(np.ascontiguousarray(train_idx, dtype=np.int64).view(np.uint8))
+    h.update(b'|')
+    h.update(np.ascontiguousarray(valid_idx, dtype=np.int64).view(np.uint8))
+    h.update(json.dumps({'params': params, 'n_samples': n_samples}, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+class FoldScoreCache:
+    """
+    Persistent cache of cross-validation fold scores, stored in a SQLite file so that it
+    survives between sessions. When it holds more than `max_entries` scores, the least
+    recently used ones are deleted.
+
+    Lookups and inserts are meant to be called from a single thread (the search loop); the
+    fits themselves can run on other threads.
+
+    :param path: String, path to the SQLite file (created if it doesn't exist).
+    :param max_entries: Integer, maximum number of scores to keep.
+    """
+
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS fold_scores '
+            '(key TEXT PRIMARY KEY, score REAL NOT NULL, last_used REAL NOT NULL)'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS idx_last_used ON fold_scores (last_used)')
+        self.connection.commit()
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM fold_scores').fetchone()[0]
+
+    def get_many(self, keys):
+        """Return a dictionary with the cached score of each key found."""
+        found = {}
+        for key in keys:
+            row = self.connection.execute('SELECT score FROM fold_scores WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                found[key] = row[0]
+        if found:
+            now = time.time()
+            self.connection.executemany('UPDATE fold_scores SET last_used = ? WHERE key = ?',
+                                        [(now, key) for key in found])
+            self.connection.commit()
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, scores):
+        """Store a dictionary of key: score, and evict the oldest scores if the cache is full."""
+        now = time.time()
+        self.connection.executemany('INSERT OR REPLACE INTO fold_scores VALUES (?, ?, ?)',
+                                    [(key, float(score), now) for key, score in scores.items()])
+        excess = len(self) - self.max_entries
+        if excess > 0:
+            self.connection.execute(
+                'DELETE FROM fold_scores WHERE key IN '
+                '(SELECT key FROM fold_scores ORDER BY last_used LIMIT ?)', (excess,)
+            )
+        self.connection.commit()
+
+    def clear(self):
+        self.connection.execute('DELETE FROM fold_scores')
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,111 @@
+import numpy as np
+from scipy import sparse
+from scipy.stats import ks_2samp
+
+
+def psi(reference, current, n_bins=10):
+    """
+    Population stability index of a numeric feature: sum((p_cur - p_ref) * ln(p_cur / p_ref))
+    over bins defined by the quantiles of the reference sample.
+    """
+    reference = np.asarray(reference, dtype=np.float64)
+    current = np.asarray(current, dtype=np.float64)
+    reference = reference[~np.isnan(reference)]
+    current = current[~np.isnan(current)]
+    if len(reference) == 0 or len(current) == 0:
+        return np.nan
+
+    edges = np.unique(np.quantile(reference, np.linspace(0, 1, n_bins + 1)[1:-1]))
+    p_ref = np.bincount(np.searchsorted(edges, reference, side='right'), minlength=len(edges) + 1) / len(reference)
+    p_cur = np.bincount(np.searchsorted(edges, current, side='right'), minlength=len(edges) + 1) / len(current)
+    return proportions_psi(p_ref, p_cur)
+
+
+def _columns(X, columns):
+    # Dense array with some columns of a feature matrix (dense or sparse)
+    if sparse.issparse(X):
+        return X[:, columns].toarray()
+    return np.asarray(X[:, columns])
+
+
+def proportions_psi(p_ref, p_cur, eps=1e-4):
+    """PSI of two vectors of proportions (e.g. the neighbourhood mix of two samples)."""
+    p_ref = np.maximum(np.asarray(p_ref, dtype=np.float64), eps)
+    p_cur = np.maximum(np.asarray(p_cur, dtype=np.float64), eps)
+    return float(np.sum((p_cur - p_ref) * np.log(p_cur / p_ref)))
+
+
+class DriftDetector:
+    """
+    Decide whether the month that just arrived drifted away from the data the current
+    model was trained on, so that the model is only retrained (and retuned) when needed.
+
+    Three detectors are checked, and the month triggers a retrain if any of them fires:
+    - Input drift of numeric features: PSI or Kolmogorov-Smirnov statistic between the
+      training window of the current model and the new month.
+    - Input drift of the neighbourhood mix: PSI of the share of listings in each
+      neighbourhood (the `nei_*` columns).
+    - Residual drift: RMSE of the current model on the new month, relative to its RMSE on
+      the first month it predicted.
+
+    :param INDEP_VARS: List of feature columns (in the order of the feature matrix).
+    :param numeric_features: List of numeric features to monitor ('covered_area' and the
+        'distance_to_*' features if None).
+    :param category_prefix: String, prefix of the dummy columns whose mix is monitored.
+    :param psi_threshold: Float, PSI above which a feature drifted (0.2 is the usual "significant shift").
+    :param ks_threshold: Float, KS statistic above which a numeric feature drifted.
+    :param residual_threshold: Float, relative RMSE increase above which the residuals drifted.
+    :param max_months_without_retrain: Integer, retrain at least this often (never forced if None).
+    """
+
+    def __init__(self, INDEP_VARS, numeric_features=None, category_prefix='nei_', psi_threshold=0.2,
+                 ks_threshold=0.1, residual_threshold=0.1, max_months_without_retrain=None):
+        self.INDEP_VARS = list(INDEP_VARS)
+        if numeric_features is None:
+            numeric_features = [v for v in self.INDEP_VARS if v == 'covered_area' or v.startswith('distance_to_')]
+        self.numeric_features = list(numeric_features)
+        self.numeric_columns = [self.INDEP_VARS.index(v) for v in self.numeric_features]
+        self.category_columns = [i for i, v in enumerate(self.INDEP_VARS) if v.startswith(category_prefix)]
+        self.psi_threshold = psi_threshold
+        self.ks_threshold = ks_threshold
+        self.residual_threshold = residual_threshold
+        self.max_months_without_retrain = max_months_without_retrain
+
+    def check(self, X_reference, X_new, reference_rmse=None, new_residuals=None, months_since_retrain=0):
+        """
+        Drift statistics of a new month, and whether any detector fired.
+
+        :param X_reference: Array with the features the current model was trained on.
+        :param X_new: Array with the features of the new month.
+        :param reference_rmse: Float, RMSE of the current model on the first month it predicted.
+        :param new_residuals: Array with the residuals of the current model on the new month.
+        :param months_since_retrain: Integer, months the current model has been used.
+        :return: Dictionary with the statistics, 'fired' (bool) and 'reasons' (list of strings).
+        """
+        stats = {}
+        reasons = []
+
+        numeric_reference = _columns(X_reference, self.numeric_columns)
+        numeric_new = _columns(X_new, self.numeric_columns)
+        for i, feature in enumerate(self.numeric_features):
+            stats[f'psi_{feature}'] = psi(numeric_reference[:, i], numeric_new[:, i])
+            stats[f'ks_{feature}'] = ks_2samp(numeric_reference[:, i], numeric_new[:, i]).statistic
+            if stats[f'psi_{feature}'] > self.psi_threshold or stats[f'ks_{feature}'] > self.ks_threshold:
+                reasons.append(feature)
+
+        if self.category_columns:
+            p_ref = _columns(X_reference, self.category_columns).astype(np.float64).mean(axis=0)
+            p_new = _columns(X_new, self.category_columns).astype(np.float64).mean(axis=0)
+            stats['psi_neighbourhood_mix'] = proportions_psi(p_ref, p_new)
+            if stats['psi_neighbourhood_mix'] > self.psi_threshold:
+                reasons.append('neighbourhood_mix')
+
+        if reference_rmse is not None and new_residuals is not None and len(new_residuals):
+            stats['residual_rmse_change'] = np.sqrt(np.mean(np.square(new_residuals))) / reference_rmse - 1
+            if stats['residual_rmse_change'] > self.residual_threshold:
+                reasons.append('residuals')
+
+        if self.max_months_without_retrain is not None and months_since_retrain >= self.max_months_without_retrain:
+            reasons.append('max_months_without_retrain')
+
+        return {**stats, 'fired': bool(reasons), 'reasons': reasons}
@@ -1,9 +1,14 @@
 import time
 import pandas as pd
 import numpy as np
-import joblib
 import os
-from sklearn.metrics import mean_absolute_percentage_error, mean_squared_error, mean_absolute_error, median_absolute_error
+from model_store import get_model_store
+from month_index import MonthIndex
+from batch_inference import predict_members, ensemble_weights, weighted_predictions, check_weighting
+from online_weights import ErrorTracker
+from metrics import MetricsCollector, check_metrics
+from profiling import get_profiler
+from feature_layout import check_feature_layout, categorical_features, location_columns
 
 def run_ensemble(
         df,
@@ -21,10 +26,23 @@ def run_ensemble(
 
         equal_weights=True,
         cv_method=False,
+        weighting=None, # or 'equal', 'inverse_error', 'softmax', 'follow_the_leader'
+        softmax_temperature=1.0,
+
+        weight_source='csv', # or 'online'
+        tracker='window', # or 'ewm'
+        tracker_window=1,
+        tracker_alpha=0.5,
         
         time_window_sizes=[1,3,6,12,24],
         error_metric = ['rmse', 'mae', 'mape', 'mdae'],
 
+        inplace_predict=False,
+        n_cores=None,
+        keep_predictions=False,
+        feature_layout='dummies', # or 'categorical', 'sparse'
+
+        profile=False,
         verbose=False,
         seed_=789
 ):
@@ -32,6 +50,9 @@ def run_ensemble(
     # Start measuring total execution time
     start_time_total = time.time()
 
+    # Per-stage timings of each month (a no-op unless profile is given)
+    profiler = get_profiler(profile)
+
     # Sort relevant lists
     error_metric.sort()
     time_window_sizes.sort()
@@ -62,11 +83,48 @@ def run_ensemble(
         {'month': unique_months_rel}
         )
 
+    # Same feature layout as the one the members were estimated with (see estimate_xgb)
+    check_feature_layout(feature_layout)
+    feature_types = None
+    sparse_columns = None
+    if feature_layout == 'categorical':
+        df, INDEP_VARS, feature_types = categorical_features(df, INDEP_VARS)
+    elif feature_layout == 'sparse':
+        sparse_columns = [col for cols in location_columns(INDEP_VARS).values() for col in cols]
+
+    # Index the rows of each month once, so that test samples are slices
+    month_index = MonthIndex(df, INDEP_VARS, DEP_VAR, sparse_columns=sparse_columns)
+
     # Add columns for the error metrics
     for em in error_metric:
         results[em] = np.nan
 
-    if equal_weights==False:
+    # Predictions of each month, evaluated for all months at once at the end
+    check_metrics(error_metric)
+    collector = MetricsCollector(len(results))
+
+    # Weighting scheme: given directly, or by the equal_weights / cv_method flags
+    if weighting is None:
+        if equal_weights:
+            weighting = 'equal'
+        elif cv_method:
+            weighting = 'cv_method'
+        else:
+            weighting = 'inverse_error'
+    check_weighting(weighting)
+    equal_weights = weighting == 'equal'
+
+    if weight_source not in ['csv', 'online']:
+        raise ValueError("Invalid weight_source. Please choose from 'csv' or 'online'.")
+
+    # Online weights: the members' errors are tracked as each month's actual prices arrive,
+    # instead of reading the error metrics saved by estimate_xgb
+    error_tracker = None
+    if not equal_weights and weight_source == 'online':
+        error_tracker = ErrorTracker(len(time_window_sizes), error_metric, tracker=tracker,
+                                     window=tracker_window, alpha=tracker_alpha)
+
+    if equal_weights==False and weight_source == 'csv':
         # Create df to store previously estimated models' error metrics
         error_metrics_df = pd.DataFrame({'month': unique_months_rel})
 
@@ -100,14 +158,28 @@ def run_ensemble(
             # Normalize columns
             error_metrics_df[vars_em] = error_metrics_df[vars_em].div(row_sums, axis=0)                       
 
+    # Models saved by estimate_xgb, and the members of the ensemble in each month
+    model_store = get_model_store(path_to_models)
+    ensemble_members = {}
+
+    # Stacked member predictions of each month (members x rows), if they are kept
+    stacked_predictions = {}
+
     # Start iteration to create ensemble, 
     # considering each month (except the first) as the test sample.
-    for month in unique_months_rel:
+    for month_row, month in enumerate(unique_months_rel):
 
         # For the weighted method, you have to start one month later because there is
-        # no previous error metric to use
-        if (month==unique_months_rel[0]) & (equal_weights==False) & (starting_month<skip_months):
-            continue
+        # no previous error metric to use (online, the first month is only used to
+        # start tracking the members' errors)
+        if error_tracker is not None:
+            skip_month = error_tracker.n_updates == 0
+        else:
+            skip_month = (month==unique_months_rel[0]) & (equal_weights==False) & (starting_month<skip_months)
+            if skip_month:
+                continue
+
+        profiler.start_month(month)
 
         # Parse month string
         if isinstance(month, pd.Timestamp):
@@ -120,84 +192,90 @@ def run_ensemble(
             print(f"Starting estimation for month: {month_parsed} \n")
 
         # Test set
-        df_subset_test = df.loc[df['listing_month'] == month].copy()        
+        X_test, y_test = month_index.test(month)
+        profiler.lap('split')
+
+        # Load models to build ensemble (each model is read from disk at most once per process)
+        ensemble_keys = [model_store.key(ws, month, sample_df=sample_df) for ws in time_window_sizes]
+        ensemble = [model_store.load(key) for key in ensemble_keys]
+        ensemble_members[month_parsed] = ensemble_keys
+        profiler.lap('load_models')
+
+        # Predict the test month with every member once; every weighting below is a
+        # matrix product over these stacked predictions (members x rows)
+        member_predictions = predict_members(ensemble, X_test, n_cores=n_cores, inplace=inplace_predict,
+                                             feature_types=feature_types)
+        if keep_predictions:
+            stacked_predictions[month_parsed] = member_predictions
+        profiler.lap('predict_members')
+
+        if skip_month:
+            error_tracker.update_from_predictions(member_predictions, y_test)
+            profiler.lap('tracker_update')
+            profiler.end_month()
+            continue
 
-        # Define training and test samples
-        X_test = df_subset_test[INDEP_VARS]
-        y_test = df_subset_test[DEP_VAR]
+        # Weights of the members for each error metric (metrics x members)
+        # !!! Asegurarse de que tanto los modelos en ensemble como las metricas de erorr
+        # usadas como pesos esten en el mismo orden
+        if equal_weights:
+            weights = ensemble_weights(n_members=len(ensemble), weighting='equal')
+            weights = np.repeat(weights, len(error_metric), axis=0)
+        elif error_tracker is not None:
+            weights = error_tracker.weights(weighting, temperature=softmax_temperature)
+        else:
+            previous_month = month - pd.DateOffset(months=1)
+            previous_month_metrics = error_metrics_df[(error_metrics_df["month"]==previous_month)]
+            member_errors = np.vstack([
+                previous_month_metrics[[em + str(ws) for ws in time_window_sizes]].iloc[0,].values
+                for em in error_metric
+            ])
+
+            weights = ensemble_weights(member_errors, weighting=weighting, temperature=softmax_temperature)
+
+        profiler.lap('weights')
+
+        # Cross-validation method: report model chosen
+        if weighting in ['cv_method', 'follow_the_leader'] and verbose>1:
+            for em, em_weights in zip(error_metric, weights):
+                print(f"Model with smallest error in this month: {em + str(time_window_sizes[int(np.argmax(em_weights))])} \n")
+
+        # Ensemble prediction for every error metric at once (metrics x rows)
+        y_preds = weighted_predictions(member_predictions, weights)
+        profiler.lap('combine')
+
+        # Error metrics (each metric with the prediction weighted by it) are computed at the end
+        collector.add_predictions(month_row, y_preds, y_test)
+        profiler.lap('metrics')
+
+        # The actual prices of this month update the members' errors for the next one
+        if error_tracker is not None:
+            error_tracker.update_from_predictions(member_predictions, y_test)
+            profiler.lap('tracker_update')
+        profiler.end_month()
+
+    # Calculate error metrics of all months
+    profiler.start_month(None)
+    results = collector.write(results, error_metric)
+    profiler.lap('metrics')
+    profiler.end_month()
+
+    # Save which models make up the ensemble in each month (the models themselves are not copied)
+    if equal_weights:
+        weights_lab = 'equalw'
+    else:
+        weights_lab = 'unequalw'
+    manifest_name = ('_').join(['ensemble', 'winsize', ('-').join([str(ws) for ws in time_window_sizes]),
+                                weights_lab, 'sample' + str(sample_df)])
+    model_store.save_ensemble_manifest(manifest_name, ensemble_members)
 
-        # Load models to build ensemble
-        ensemble=[]
+    if keep_predictions:
+        results.attrs['member_predictions'] = stacked_predictions
 
-        for ws in time_window_sizes:
-            # Load model and append it to list
-            path_ = os.path.join(path_to_models, 
-                             f'winsize{ws}_sample{sample_df}_{month_parsed}.pkl')
-            model = joblib.load(path_)
-            ensemble.append(model)
-
-        # Save ensemble as pkl file
-        if path_to_models:
-            if equal_weights:
-                weights_lab = 'equalw'
-            else:
-                weights_lab = 'unequalw'
-            path_end_ = ['winsize', ('-').join([str(ws) for ws in time_window_sizes]),
-                         weights_lab, 'sample' + str(sample_df),
-                         month_parsed]            
-            path_end_ = ('_').join(path_end_) + '.pkl'
-
-            path_ = os.path.join(path_to_models, path_end_)
-            joblib.dump(ensemble, path_)
-
-        # Make prediction using each error metric as weights         
-        for em in error_metric:
-            
-            # Select corresponding weights
-            # !!! Asegurarse de que tanto los modelos en ensemble como las metricas de erorr
-            # usadas como pesos esten en el mismo orden
-            if equal_weights:
-                weights=None
-            else:
-                # !!! Ojo con esto, funciona pero si tuviese dos metricas que empiezan igual no sirve
-                vars_em = [x for x in error_metrics_df.columns if x.startswith(em)]
-                previous_month = month - pd.DateOffset(months=1)
-                previous_month_metrics = error_metrics_df[(error_metrics_df["month"]==previous_month)][vars_em]
-                weights = previous_month_metrics.iloc[0,].values.flatten().tolist()
-
-                # Cross-validation method
-                if cv_method:
-                    weights = [1 if w==min(weights) else 0 for w in weights]
-
-                    #Report model chosen
-                    if verbose>1:
-                        print(f"Model with smallest error in this month: {previous_month_metrics.columns[weights.index(1)]} \n")
-                    
-                # Inverse of error metric method
-                else:
-                    weights = [1/w for w in weights]
-                    weights = [w/sum(weights) for w in weights]
-
-
-            # Make prediction
-            y_pred = ensemble_predict(ensemble, X_test, weights=weights)
-
-            # Calculate error metric and add it to results df
-            if em=='rmse':
-                rmse = np.sqrt(mean_squared_error(y_pred, y_test))
-                results.loc[results['month'] == month, em] = rmse
-
-            elif em=='mae':
-                mae = mean_absolute_error(y_pred, y_test)
-                results.loc[results['month'] == month, em] = mae
-
-            elif em=='mape':
-                mape = mean_absolute_percentage_error(y_pred, y_test)
-                results.loc[results['month'] == month, em] = mape
-
-            elif em=='mdae':
-                mdae = median_absolute_error(y_pred, y_test)
-                results.loc[results['month'] == month, em] = mdae
+    # Per-month, per-stage breakdown (long format, one row per month and stage)
+    if profiler.enabled:
+        results.attrs['stage_profile'] = profiler.frame()
+        profiler.close()
 
     # End measuring total execution time
     end_time_total = time.time()
@@ -210,20 +288,19 @@ def run_ensemble(
 
 
 # Function to make predictions with ensemble and weight them if necessary
-def ensemble_predict(models, input_data, weights=None):
+def ensemble_predict(models, input_data, weights=None, n_cores=None, inplace_predict=False, feature_types=None):
 
-    # Generate predictions from each model
-    predictions = np.array([model.predict(input_data) for model in models])
+    # Generate predictions from each model (one DMatrix shared by all of them)
+    predictions = predict_members(models, input_data, n_cores=n_cores, inplace=inplace_predict,
+                                  feature_types=feature_types)
 
     if weights is not None:
         # Ensure the weights sum to 1
-        # !!! redundant
-        weights = np.array(weights) / np.sum(np.array(weights))
-        # Compute the weighted average
-        weights = weights.flatten()
-        weighted_prediction = np.average(predictions, axis=0, weights=weights)
-        return weighted_prediction
+        weights = np.array(weights, dtype=np.float64).flatten()
+        weights = weights / np.sum(weights)
     else:
-        # Compute the simple average
-        avg_prediction = np.mean(predictions, axis=0)
-        return avg_prediction
\ No newline at end of file
+        # Simple average
+        weights = ensemble_weights(n_members=len(models), weighting='equal')[0]
+
+    # Compute the weighted average
+    return weighted_predictions(predictions, weights)
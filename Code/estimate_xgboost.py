@@ -2,12 +2,23 @@ import pandas as pd
 import time
 import xgboost as xgb
 import os
+import json
 import numpy as np
-import joblib
+from joblib import Parallel, delayed, parallel_backend
 from sklearn.model_selection import GridSearchCV, TimeSeriesSplit, train_test_split
-from sklearn.metrics import mean_absolute_percentage_error, mean_squared_error, mean_absolute_error, median_absolute_error
-  
-n_cpu = os.cpu_count()
+from model_store import get_model_store, load_model_file, parse_month
+from month_index import MonthIndex
+from cv_cache import FoldScoreCache
+from metrics import MetricsCollector, grouped_metrics, check_metrics
+from scheduler import plan_cores, n_search_tasks
+from training_engine import HistWindow, check_engine
+from drift import DriftDetector
+from feature_selection import LassoPathSelector
+from run_journal import RunJournal, month_metrics
+from profiling import get_profiler
+from feature_layout import (check_feature_layout, categorical_features, location_columns, layout_params)
+from hyperparameter_search import (CVEvaluator, SearchBudget, search_hyperparams, check_search_backend,
+                                   neighbourhood_candidates, local_search, month_series_cv)
 
 def estimate_xgb(
         df,
@@ -32,13 +43,41 @@ def estimate_xgb(
                             'colsample_bytree': [],
                             'reg_alpha':[]    
                             }], # list of dictionary/ies
-        cv_strategy="random_cv", # or 'time_series_split'
+        cv_strategy="random_cv", # or 'time_series_split', 'month_series_split'
+        search_backend='grid', # or 'halving', 'tpe'
+        halving_resource='n_estimators', # or 'n_samples'
+        search_max_fits=None,
+        search_max_seconds=None,
+        tuning_mode='full', # or 'carry_over'
+        carry_over_radius=1,
+        carry_over_threshold=0.05,
+        cv_cache_path=None,
         sample_weights=None,
 
         time_window_size=False,
         error_metric = ['rmse', 'mae', 'mape', 'mdae'],
         save_model_path=False,
+        journal_path=None,
+        resume=False,
 
+        update_strategy='full_refit', # or 'warm_start'
+        warm_start_method='append', # or 'refresh'
+        warm_start_n_estimators=None,
+        refit_every=None,
+
+        retrain_policy='always', # or 'drift'
+        drift_detector=None,
+
+        feature_selection=None, # or 'lasso'
+        feature_selector=None,
+
+        engine='exact', # or 'hist'
+        max_bin=256,
+        feature_layout='dummies', # or 'categorical', 'sparse'
+
+        n_cores=None,
+
+        profile=False,
         verbose=False,
         seed_=789
 
@@ -47,6 +86,9 @@ def estimate_xgb(
     # Start measuring total execution time
     start_time_total = time.time()
     
+    # Per-stage timings of each month (a no-op unless profile is given)
+    profiler = get_profiler(profile)
+
     # Sort data frame by month
     df = df.sort_values(by=['listing_month'])
 
@@ -68,9 +110,33 @@ def estimate_xgb(
         {'month': unique_months}
         )
     
+    # Location dummies as XGBoost categoricals (one coded column per location variable) or
+    # as a sparse block of the feature matrix
+    check_feature_layout(feature_layout)
+    feature_types = None
+    sparse_columns = None
+    if feature_layout != 'dummies' and train_test_splin != 'time_series':
+        raise ValueError(f"feature_layout='{feature_layout}' requires train_test_splin='time_series'.")
+    # Month-aligned CV folds need the month index too
+    if cv_strategy == 'month_series_split' and train_test_splin != 'time_series':
+        raise ValueError("cv_strategy='month_series_split' requires train_test_splin='time_series'.")
+    if feature_layout == 'categorical':
+        df, INDEP_VARS, feature_types = categorical_features(df, INDEP_VARS)
+    elif feature_layout == 'sparse':
+        sparse_columns = [col for cols in location_columns(INDEP_VARS).values() for col in cols]
+
+    # Index the rows of each month once, so that training and test windows are slices
+    if train_test_splin=='time_series':
+        month_index = MonthIndex(df, INDEP_VARS, DEP_VAR, sparse_columns=sparse_columns)
+
     # Add column for loop iteration time
     results['loop_duration_seconds'] = np.nan
 
+    # Predictions and other values of each month, written into results at the end
+    check_metrics(error_metric)
+    collector = MetricsCollector(len(results))
+    month_rows = {month: row for row, month in enumerate(unique_months)}
+
     # Add columns for the error metrics
     for em in error_metric:
         results[em] = np.nan
@@ -83,10 +149,115 @@ def estimate_xgb(
         for param_key in all_param_keys:
             results[param_key] = np.nan
 
+        # Record whether each month ran a full search or only searched around last month's best
+        if tuning_mode == 'carry_over':
+            results['tuning_search'] = None
+
     # Consider window size
     skip_months = 1
     if time_window_size is not False:
         skip_months = skip_months + time_window_size - 1
+
+    # Month-aligned CV has one fold per month of the window (up to 5): plan the cores for the
+    # folds of the largest window, the last test month's
+    n_folds = 5
+    test_months = unique_months[starting_month + skip_months : ending_month]
+    if tune_hyperparams and cv_strategy == 'month_series_split' and test_months:
+        if time_window_size is False:
+            n_window_months = int(np.searchsorted(month_index.months, np.datetime64(test_months[-1], 'ns')))
+        else:
+            n_window_months = time_window_size
+        n_folds = month_series_cv(np.arange(n_window_months + 1)).get_n_splits()
+
+    # Split the core budget between grid search fits and booster threads (one month at a time)
+    core_plan = plan_cores(n_cores, n_months=1,
+                           n_search_tasks=n_search_tasks(parameter_grid, n_folds) if tune_hyperparams else 1)
+
+    check_engine(engine)
+    check_search_backend(search_backend, halving_resource)
+    budgeted_search = search_backend != 'grid' or search_max_fits is not None or search_max_seconds is not None
+
+    # Persistent cache of CV fold scores, keyed on the months of each fold (so it needs the
+    # month index). Candidates are then scored by the CVEvaluator, which looks up their folds
+    # and fits the missing ones in parallel (all candidates at once for a plain grid search)
+    cv_cache = None
+    if cv_cache_path is not None and tune_hyperparams:
+        if train_test_splin != 'time_series':
+            raise ValueError("cv_cache_path requires train_test_split='time_series'.")
+        cv_cache = FoldScoreCache(cv_cache_path)
+        budgeted_search = True
+
+    # Warm start only makes sense when months arrive in order
+    if update_strategy not in ['full_refit', 'warm_start']:
+        raise ValueError("Invalid update_strategy. Please choose from 'full_refit' or 'warm_start'.")
+    if update_strategy == 'warm_start':
+        if train_test_splin != 'time_series':
+            raise ValueError("update_strategy='warm_start' requires train_test_splin='time_series'.")
+        if warm_start_method not in ['append', 'refresh']:
+            raise ValueError("Invalid warm_start_method. Please choose from 'append' or 'refresh'.")
+
+    if tuning_mode not in ['full', 'carry_over']:
+        raise ValueError("Invalid tuning_mode. Please choose from 'full' or 'carry_over'.")
+
+    # Drift-triggered retraining: the model (and its tuning) is only updated in the months
+    # where the month that just arrived drifted, so it also needs months in order
+    if retrain_policy not in ['always', 'drift']:
+        raise ValueError("Invalid retrain_policy. Please choose from 'always' or 'drift'.")
+    if retrain_policy == 'drift':
+        if train_test_splin != 'time_series':
+            raise ValueError("retrain_policy='drift' requires train_test_splin='time_series'.")
+        if update_strategy == 'warm_start':
+            raise ValueError("retrain_policy='drift' can't be combined with update_strategy='warm_start'.")
+        if drift_detector is None:
+            drift_detector = DriftDetector(INDEP_VARS)
+        results['retrained'] = None
+        results['drift_reasons'] = None
+
+        # Training window of the current model, its RMSE on the first month it predicted
+        # and its residuals on the last month it predicted
+        reference_rows = None
+        reference_rmse = None
+        last_residuals = None
+
+    # Feature selection: a LASSO path on each month's training window chooses the features
+    # the booster is trained on (categorical columns are always kept)
+    if feature_selection not in [None, 'lasso']:
+        raise ValueError("Invalid feature_selection. Please choose from None or 'lasso'.")
+    if feature_selection == 'lasso':
+        if train_test_splin != 'time_series':
+            raise ValueError("feature_selection='lasso' requires train_test_splin='time_series'.")
+        if feature_selector is None:
+            feature_selector = LassoPathSelector(
+                INDEP_VARS, always_keep=[col for col, ft in zip(INDEP_VARS, feature_types or []) if ft == 'c'])
+        elif feature_selector.INDEP_VARS != list(INDEP_VARS):
+            raise ValueError("The feature_selector must be built on the INDEP_VARS of the feature layout.")
+        results['selected_features'] = None
+
+    # Features of the current model (boolean mask over INDEP_VARS), kept by warm start steps
+    # and reused models
+    selected = None
+
+    # Journal of finished months. When resuming, the journaled months are not computed again:
+    # their results, and the state later months need, are read from the journal
+    journal = None
+    journaled = {}
+    resume_model_path = None
+    if journal_path is not None:
+        journal = RunJournal(journal_path)
+        if resume:
+            journaled = journal.entries()
+    elif resume:
+        raise ValueError("resume=True requires a journal_path.")
+
+    # Best parameters of the last tuned month and their CV error, for carry-over tuning
+    previous_best_params = None
+    previous_cv_rmse = None
+
+    # Model fitted in the previous month, its parameters and months since the last full refit
+    previous_model = None
+    refit_params = None
+    months_since_refit = 0
+    previous_month = None
     
     # Start iteration to evaluate performance in the test sample, 
     #   considering each month (except the first) as the test sample.
@@ -94,6 +265,58 @@ def estimate_xgb(
 
         # Start measuring time for this loop iteration
         start_time_loop = time.time()
+        month_row = month_rows[month]
+
+        # Month already journaled: keep its results and the state the next months start from
+        if parse_month(month) in journaled:
+            entry = journaled[parse_month(month)]
+            collector.record(month_row, **entry['values'])
+            state = entry['state']
+            if 'best_params' in state:
+                previous_best_params = state['best_params']
+                previous_cv_rmse = state['cv_rmse']
+            if update_strategy == 'warm_start' or retrain_policy == 'drift':
+                if entry['model_path'] is None:
+                    raise ValueError("Resuming with update_strategy='warm_start' or retrain_policy='drift' "
+                                     "requires the models of the journaled months (save_model_path).")
+                resume_model_path = entry['model_path']
+                refit_params = state.get('refit_params')
+                months_since_refit = state['months_since_refit']
+            if retrain_policy == 'drift':
+                reference_rows = slice(*state['reference_rows'])
+                reference_rmse = state['reference_rmse']
+            if feature_selection is not None:
+                selected = np.asarray(state['selected'], dtype=bool)
+                feature_selector.set_state(state['feature_selector'])
+            previous_month = month
+            continue
+
+        profiler.start_month(month)
+
+        # First month computed after resuming: load the last journaled model (only the
+        # strategies that build on last month's model need it)
+        if resume_model_path is not None:
+            previous_model = load_model_file(resume_model_path)
+            resume_model_path = None
+            if retrain_policy == 'drift':
+                # Residuals of that model on its last month; the hist engine predicts with
+                # the cuts of the window it was trained on
+                X_previous, y_previous = month_index.test(previous_month)
+                X_reference = month_index.X[reference_rows]
+                month_feature_types = feature_types
+                if selected is not None:
+                    X_previous, X_reference = X_previous[:, selected], X_reference[:, selected]
+                    if feature_types is not None:
+                        month_feature_types = [ft for ft, keep in zip(feature_types, selected) if keep]
+                if engine == 'hist':
+                    hist_window = HistWindow(X_reference, month_index.y[reference_rows],
+                                             max_bin=max_bin, seed_=seed_, n_jobs=core_plan.booster_jobs,
+                                             feature_types=month_feature_types)
+                    y_previous_pred = hist_window.predict(previous_model, X_previous)
+                else:
+                    y_previous_pred = previous_model.predict(X_previous)
+                last_residuals = np.ravel(y_previous) - np.ravel(y_previous_pred)
+            profiler.lap('resume')
 
         # Parse month string
         if isinstance(month, pd.Timestamp):
@@ -107,7 +330,7 @@ def estimate_xgb(
 
         # Define first month and parse it
         if time_window_size is False:
-            first_month = unique_months[0]
+            first_month = pd.Timestamp(unique_months[0]).to_datetime64()
             # first_month_parsed = first_month.strftime('%Y-%m')
         else:
             first_month = month - pd.DateOffset(months=time_window_size)
@@ -127,40 +350,106 @@ def estimate_xgb(
             X = df[INDEP_VARS]
             y = df[DEP_VAR]
             X_train, X_test, y_train, y_test = train_test_split(X, y, test_size = 0.3, random_state=seed_)
+            window_offsets, window_hashes = None, None
 
         # Train-Test Time Series Split: Subset dataframe according to the chosen timeframe
         elif train_test_splin=='time_series':
-            df_subset_train = df.loc[(df['listing_month'] >= first_month) & 
-                                    (df['listing_month'] < month)].copy()
-            df_subset_test = df.loc[df['listing_month'] == month].copy()        
+            # Training and test samples are views of the month-sorted feature matrix
+            train_rows = month_index.rows(first_month, month)
+            X_train, y_train = month_index.X[train_rows], month_index.y[train_rows]
+            X_test, y_test = month_index.test(month)
+            # Where each month of the window starts, for month-aligned CV folds and their cache keys
+            window_offsets, window_hashes = month_index.window_months(train_rows)
 
             # If specified, define sample weights based on months since the present
             if sample_weights:
-                df_subset_train['first_month'] = df_subset_train['listing_month'].min()
-                df_subset_train['month_abs_diff'] = round(
-                    (df_subset_train['listing_month'] - df_subset_train['first_month']).dt.days / 30
-                )
+                month_abs_diff = month_index.month_abs_diff(train_rows)
+
+        profiler.lap('split')
+
+        # Decide whether this month updates last month's booster instead of refitting.
+        # The first month, and every `refit_every` months, are always fully refitted
+        # on the whole training window.
+        warm_start_step = (
+            update_strategy == 'warm_start'
+            and previous_model is not None
+            and (refit_every is None or months_since_refit < refit_every)
+        )
 
-            # Define training and test samples
-            X_train = df_subset_train[INDEP_VARS]
-            y_train = df_subset_train[DEP_VAR]
-            X_test = df_subset_test[INDEP_VARS]
-            y_test = df_subset_test[DEP_VAR]
+        # Drift-triggered retraining: compare the newly arrived month (the one right before
+        # the test month) with the training window of the current model, and keep the
+        # current model unless a detector fires
+        reuse_step = False
+        if retrain_policy == 'drift':
+            if previous_model is not None:
+                X_new, _ = month_index.test(previous_month)
+                drift = drift_detector.check(month_index.X[reference_rows], X_new,
+                                             reference_rmse=reference_rmse, new_residuals=last_residuals,
+                                             months_since_retrain=months_since_refit)
+                reuse_step = not drift['fired']
+                collector.record(month_row, drift_reasons=','.join(drift['reasons']),
+                                 **{key: value for key, value in drift.items() if key not in ['fired', 'reasons']})
 
+                if verbose>2:
+                    print(f"Drift detectors: {drift['reasons'] if drift['fired'] else 'none fired'}")
+
+            collector.record(month_row, retrained=not reuse_step)
+            profiler.lap('drift_check')
+
+        # Feature selection, whenever the model is fitted from scratch: warm start steps and
+        # reused models keep the features of the model they continue
+        month_feature_types = feature_types
+        if feature_selection is not None:
+            if not warm_start_step and not reuse_step:
+                selection = feature_selector.select(X_train, y_train)
+                selected = selection['mask']
+                collector.record(month_row, lasso_alpha=selection['alpha'],
+                                 lasso_iterations=selection['iterations'])
+            X_train, X_test = X_train[:, selected], X_test[:, selected]
+            if feature_types is not None:
+                month_feature_types = [ft for ft, keep in zip(feature_types, selected) if keep]
+            collector.record(month_row, n_features=int(selected.sum()),
+                             selected_features=','.join(col for col, keep in zip(INDEP_VARS, selected) if keep))
+
+            if verbose>2:
+                print(f"Training on {selected.sum()} of {len(INDEP_VARS)} features")
+            profiler.lap('feature_selection')
 
         # Initiate XGB regressor
-        xgbr = xgb.XGBRegressor(objective='reg:squarederror', tree_method = 'exact', seed=seed_)
+        xgbr = xgb.XGBRegressor(objective='reg:squarederror', tree_method = 'exact', seed=seed_,
+                                n_jobs=core_plan.booster_jobs)
+        xgbr.set_params(**layout_params(feature_layout, month_feature_types))
 
 
         # HYPERPARAMETER TUNING
 
+        # Warm start: keep the parameters of the last full refit, no tuning
+        if warm_start_step:
+            best_model = xgb.XGBRegressor(**refit_params)
+
+            # Refresh the leaf values of the existing trees with the new month
+            if warm_start_method == 'refresh':
+                best_model.set_params(
+                    process_type='update', 
+                    updater='refresh', 
+                    refresh_leaf=True,
+                    n_estimators=previous_model.get_booster().num_boosted_rounds()
+                )
+            # Append new trees trained on the new month
+            elif warm_start_n_estimators is not None:
+                best_model.set_params(n_estimators=warm_start_n_estimators)
+
+        # No drift: keep last month's model, no tuning
+        elif reuse_step:
+            best_model = previous_model
+
         # No tuning
-        if not tune_hyperparams:
+        elif not tune_hyperparams:
             best_model = xgbr
 
             # Impose best parameters
             if best_params_path is not None:
-                saved_model = joblib.load(best_params_path)
+                saved_model = load_model_file(best_params_path)
                 best_params = saved_model.get_params()
                 best_model.set_params(**best_params)
 
@@ -172,103 +461,503 @@ def estimate_xgb(
                 cv_arg = 5
             elif cv_strategy == 'time_series_split':
                 cv_arg = TimeSeriesSplit(n_splits=5)
+            elif cv_strategy == 'month_series_split':
+                cv_arg = month_series_cv(window_offsets)
+
+            # Define sample weights
+            s_weights = None
+            if sample_weights == 'linear':
+                s_weights = month_abs_diff
+            elif sample_weights == 'quadratic':
+                s_weights = month_abs_diff ** 2
+
+            # Hist engine: quantize the training window and the CV folds once for all rounds and candidates
+            if engine == 'hist':
+                hist_window = HistWindow(X_train, y_train, sample_weight=s_weights, max_bin=max_bin, seed_=seed_,
+                                         n_jobs=core_plan.booster_jobs, search_jobs=core_plan.search_jobs,
+                                         feature_types=month_feature_types)
+
+            # Successive halving / TPE / budgeted grid / carry-over: score candidates one by one,
+            # within a budget of fits and seconds for the whole month
+            search_budget = SearchBudget(search_max_fits, search_max_seconds)
+            cache_context = None
+            if cv_cache is not None:
+                # Everything besides the months and rows of the fold and the parameters that a fold
+                # score depends on. Sample weights are relative to the first month of the window,
+                # and the hist engine quantizes the folds with the cuts of the whole window
+                cache_context = {'cv': repr(cv_arg), 'engine': engine, 'seed': seed_,
+                                 'sample_weights': sample_weights}
+                if sample_weights:
+                    cache_context['window_start'] = str(month_index.row_months[train_rows.start])
+                if engine == 'hist':
+                    cache_context.update({'max_bin': max_bin, 'window': window_hashes})
+                if selected is not None:
+                    cache_context['features'] = np.flatnonzero(selected).tolist()
+            evaluator = CVEvaluator(xgbr, X_train, y_train, cv_arg, sample_weight=s_weights,
+                                    n_jobs=core_plan.search_jobs,
+                                    hist_window=hist_window if engine == 'hist' else None,
+                                    cache=cv_cache, cache_context=cache_context,
+                                    month_offsets=window_offsets, month_hashes=window_hashes)
+
+            # Carry-over: only search around last month's best parameters, and fall back on a
+            # full search if the CV error got worse than last month's by more than the threshold
+            full_search = True
+            if tuning_mode == 'carry_over' and previous_best_params is not None:
+                candidates = neighbourhood_candidates(parameter_grid, previous_best_params, carry_over_radius)
+                month_best_params, month_score = local_search(evaluator, candidates, budget=search_budget)
+                full_search = np.sqrt(-month_score) > previous_cv_rmse * (1 + carry_over_threshold)
 
-            # If the parameter grid is a list with more than one dictionary of parameters,
-            # loop across dictionaries and select the best parameters one set at a time
-            for round_num, params in enumerate(parameter_grid, start=1):
-
-                print(f"Starting hyper-parameter tuning round number: {round_num}")
-
-                grid_search = GridSearchCV(
-                    estimator=xgbr, 
-                    param_grid=params, 
-                    cv=cv_arg, 
-                    scoring='neg_mean_squared_error', 
-                    verbose=0, 
-                    n_jobs=n_cpu-2
-                )
-                
-                # Fit the model with or without sample weights
-                if sample_weights is None:
-                    grid_search.fit(X_train, y_train)
-                else:
-                    if sample_weights == 'linear':
-                        s_weights = df_subset_train['month_abs_diff']
-                    elif sample_weights == 'quadratic':
-                        s_weights = df_subset_train['month_abs_diff'] ** 2
-                    grid_search.fit(X_train, y_train, sample_weight=s_weights)
-
-                # Get the best parameters from the current grid search
-                best_params = grid_search.best_params_
                 if verbose>2:
-                    print(f"Best parameters from round {round_num}: {best_params}")
+                    print(f"Local search over {len(candidates)} candidates: CV RMSE {np.sqrt(-month_score):.2f} "
+                          f"(last month {previous_cv_rmse:.2f}){', starting full search' if full_search else ''}")
+
+                if not full_search:
+                    collector.record(month_row, **month_best_params)
+
+            if full_search:
+
+                # Copy the grids, so that adding round one's best parameters to round two
+                # doesn't change the grid used in later months
+                round_grids = [dict(params) for params in parameter_grid]
+                month_best_params = {}
+
+                # If the parameter grid is a list with more than one dictionary of parameters,
+                # loop across dictionaries and select the best parameters one set at a time
+                for round_num, params in enumerate(round_grids, start=1):
+
+                    print(f"Starting hyper-parameter tuning round number: {round_num}")
+
+                    if budgeted_search:
+                        best_params = search_hyperparams(evaluator, params, search_backend=search_backend,
+                                                         halving_resource=halving_resource,
+                                                         budget=search_budget, seed_=seed_)
+
+                    elif engine == 'hist':
+                        best_params = hist_window.grid_search(xgbr.get_params(), params, cv_arg)
+
+                    else:
+                        grid_search = GridSearchCV(
+                            estimator=xgbr, 
+                            param_grid=params, 
+                            cv=cv_arg, 
+                            scoring='neg_mean_squared_error', 
+                            verbose=0, 
+                            n_jobs=core_plan.search_jobs
+                        )
+                        
+                        # Fit the model with or without sample weights. Fits run on threads (XGBoost
+                        # releases the GIL), so that search_jobs x booster_jobs stays within the budget.
+                        with parallel_backend('threading'):
+                            grid_search.fit(X_train, y_train, sample_weight=s_weights)
+
+                        # Get the best parameters from the current grid search
+                        best_params = grid_search.best_params_
+                    if verbose>2:
+                        print(f"Best parameters from round {round_num}: {best_params}")
+
+                    # Add the best parameters from the first grid to the second grid
+                    if round_num==1 and len(round_grids)>1:
+                        aux = {key: [value]  for key, value in best_params.items()}
+                        round_grids[1].update(aux)
+
+                    # Store best parameters for this month in the results data frame
+                    month_best_params.update(best_params)
+                    collector.record(month_row, **best_params)
+
+                # CV score of the chosen parameters, to compare next month's local search against
+                if tuning_mode == 'carry_over':
+                    if budgeted_search:
+                        month_score = evaluator.lookup_score(month_best_params)
+                    elif engine == 'hist':
+                        month_score = np.max(hist_window.cv_results_['mean_test_score'])
+                    else:
+                        month_score = grid_search.best_score_
+
+            if tuning_mode == 'carry_over':
+                previous_best_params = month_best_params
+                previous_cv_rmse = np.sqrt(-month_score)
+                collector.record(month_row, tuning_search='full' if full_search else 'local')
 
-                # Add the best parameters from the first grid to the second grid
-                if round_num==1 and len(parameter_grid)>1:
-                    aux = {key: [value]  for key, value in best_params.items()}
-                    parameter_grid[1].update(aux)
-
-                # Store best parameters for this month in the results data frame
-                for key, value in best_params.items():
-                    results.loc[results['month'] == month, key] = value
+            # Get the best estimator after tuning
+            if full_search and not budgeted_search and engine != 'hist':
+                best_model = grid_search.best_estimator_
+            else:
+                best_model = xgbr.set_params(**month_best_params)
 
-                
+            if verbose>2 and (budgeted_search or not full_search):
+                print(f"Search used {evaluator.n_fits} fits in {search_budget.elapsed():.2f} seconds")
 
-            # Get the best estimator after tuning
-            best_model = grid_search.best_estimator_
+        profiler.lap('tuning')
 
         # Fit the model to the training set
-        best_model.fit(X_train, y_train)
+        if warm_start_step:
+            # Only the newly arrived month (the one right before the test month) is used
+            X_new, y_new = month_index.test(previous_month)
+            if selected is not None:
+                X_new = X_new[:, selected]
+            best_model.fit(X_new, y_new, xgb_model=previous_model.get_booster())
+            months_since_refit += 1
+        elif reuse_step:
+            months_since_refit += 1
+        else:
+            if engine == 'hist':
+                # Reuse the quantized window if tuning already built it
+                if not tune_hyperparams:
+                    hist_window = HistWindow(X_train, y_train, max_bin=max_bin, seed_=seed_,
+                                             n_jobs=core_plan.booster_jobs, feature_types=month_feature_types)
+                best_model = hist_window.fit(best_model.get_params())
+            else:
+                best_model.fit(X_train, y_train)
+            refit_params = best_model.get_params()
+            months_since_refit = 1
+
+        # Record which features the booster uses, so saved models can be predicted from all INDEP_VARS
+        if selected is not None and not reuse_step:
+            best_model.get_booster().set_attr(feature_subset=json.dumps(np.flatnonzero(selected).tolist()))
+
+        previous_model = best_model
+        previous_month = month
+        profiler.lap('fit')
 
         # Save the model
+        model_path = None
         if save_model_path:
 
-            path_end_ = ['winsize' + str(time_window_size), 
-                         'sample' + str(sample_df),
-                         month_parsed]
-            
             if tune_hyperparams:
                 hyp_tune='tuned'
-                path_end_.insert(0, cv_strategy)
+                model_cv_strategy = cv_strategy
             else:
                 hyp_tune='not_tuned'
-            
-            path_end_ = ('_').join(path_end_) + '.pkl'
-
-            path_ = os.path.join(save_model_path, hyp_tune, path_end_)
-            joblib.dump(best_model, path_)
-
-        # Predict and calculate error metrics
-        y_pred = best_model.predict(X_test)
-
-        # Calculate error metrics
-        for em in error_metric:
-                if em=='rmse':
-                    rmse = np.sqrt(mean_squared_error(y_pred, y_test))
-                    results.loc[results['month'] == month, em] = rmse
-                elif em=='mae':
-                    mae = mean_absolute_error(y_pred, y_test)
-                    results.loc[results['month'] == month, em] = mae
-                elif em=='mape':
-                    mape = mean_absolute_percentage_error(y_pred, y_test)
-                    results.loc[results['month'] == month, em] = mape
-                elif em=='mdae':
-                    mdae = median_absolute_error(y_pred, y_test)
-                    results.loc[results['month'] == month, em] = mdae
-        
+                model_cv_strategy = None
+
+            model_store = get_model_store(save_model_path)
+            model_key = model_store.key(time_window_size, month, hyp_tune, sample_df, model_cv_strategy)
+            model_path = model_store.save(best_model, model_key)
+            profiler.lap('save_model')
+
+        # Predict and calculate error metrics (with the hist engine, the test month is
+        # quantized with the cuts of the training window)
+        if engine == 'hist' and not warm_start_step:
+            y_pred = hist_window.predict(best_model, X_test)
+        else:
+            y_pred = best_model.predict(X_test)
+        profiler.lap('predict')
+
+        # Error metrics are computed for all months at once, at the end
+        collector.add_predictions(month_row, y_pred, y_test)
+
+        # Residuals of the current model, for next month's drift check
+        if retrain_policy == 'drift':
+            last_residuals = np.ravel(y_test) - np.ravel(y_pred)
+            if not reuse_step:
+                reference_rows = train_rows
+                reference_rmse = np.sqrt(np.mean(np.square(last_residuals)))
+        profiler.lap('metrics')
 
         # End measuring time for this loop iteration
         end_time_loop = time.time()
         loop_duration = end_time_loop - start_time_loop
-        results.loc[results['month'] == month, 'loop_duration_seconds'] = loop_duration  # Store loop duration
+        collector.record(month_row, loop_duration_seconds=loop_duration)  # Store loop duration
+
+        # Journal the finished month, with what the next months need to resume from it
+        if journal is not None:
+            state = {'months_since_refit': months_since_refit}
+            if update_strategy == 'warm_start':
+                state['refit_params'] = refit_params
+            if tune_hyperparams and tuning_mode == 'carry_over':
+                state.update(best_params=previous_best_params, cv_rmse=previous_cv_rmse)
+            if retrain_policy == 'drift':
+                state.update(reference_rows=[reference_rows.start, reference_rows.stop],
+                             reference_rmse=reference_rmse)
+            if feature_selection is not None:
+                state.update(selected=selected.tolist(), feature_selector=feature_selector.get_state())
+            journal.append(month, {**collector.records.get(month_row, {}),
+                                   **month_metrics(y_pred, y_test, error_metric)},
+                           model_path=model_path, state=state)
+            profiler.lap('journal')
+        profiler.end_month()
 
         if verbose>1:
             print(f"Time taken for month {month_parsed}: {loop_duration:.2f} seconds\n")
 
+    # Calculate error metrics of all months
+    profiler.start_month(None)
+    results = collector.write(results, error_metric)
+    profiler.lap('metrics')
+    profiler.end_month()
+
     # End measuring total execution time
     end_time_total = time.time()
     total_duration = end_time_total - start_time_total
     if verbose>0:
         print(f"Total execution time: {total_duration:.2f} seconds\n\n\n")
 
-    return results
\ No newline at end of file
+    if cv_cache is not None:
+        if verbose>0:
+            print(f"CV cache: {cv_cache.hits} fold scores reused, {cv_cache.misses} fitted\n")
+        results.attrs['cv_cache'] = {'hits': cv_cache.hits, 'misses': cv_cache.misses}
+        cv_cache.close()
+
+    # Months that retrained and compute saved by reusing the model in the others: each
+    # reused month saves the mean time of a retraining month minus its own time
+    if retrain_policy == 'drift':
+        retrained = results['retrained'].dropna().astype(bool)
+        durations = results.loc[retrained.index, 'loop_duration_seconds']
+        retrain_seconds = durations[retrained].mean()
+        reuse_seconds = durations[~retrained].sum()
+        results.attrs['drift'] = {
+            'retrained_months': [str(month)[:7] for month in results.loc[retrained.index[retrained], 'month']],
+            'n_retrained': int(retrained.sum()),
+            'n_reused': int((~retrained).sum()),
+            'seconds_saved': float((~retrained).sum() * retrain_seconds - reuse_seconds),
+        }
+        if verbose>0:
+            print(f"Retrained in {results.attrs['drift']['n_retrained']} of {len(retrained)} months, "
+                  f"saving about {results.attrs['drift']['seconds_saved']:.2f} seconds\n")
+
+    # Per-month, per-stage breakdown (long format, one row per month and stage)
+    if profiler.enabled:
+        results.attrs['stage_profile'] = profiler.frame()
+        profiler.close()
+
+    return results
+
+
+def compare_engines(
+        df,
+        DEP_VAR,
+        INDEP_VARS,
+        engines=['exact', 'hist'],
+        error_metric=['rmse', 'mae', 'mape', 'mdae'],
+        verbose=False,
+        **kwargs
+        ):
+    """
+    Run the same backtest with each training engine and compare accuracy and speed.
+
+    :param engines: List of engines to compare (the first one is the reference).
+    :param kwargs: Any other argument of `estimate_xgb` (same for every engine).
+    :return: Tuple with the per-month results of every engine (long format, with an
+        'engine' column) and a summary with the mean error metrics, the total time and
+        the change of each against the reference engine.
+    """
+    results_list = []
+    for engine in engines:
+        if verbose>0:
+            print(f"Running backtest with engine: {engine}")
+
+        results = estimate_xgb(df, DEP_VAR, INDEP_VARS, engine=engine, error_metric=error_metric,
+                               verbose=verbose, **kwargs)
+        results.insert(1, 'engine', engine)
+        results_list.append(results.dropna(subset=['loop_duration_seconds']))
+
+    results = pd.concat(results_list, ignore_index=True)
+
+    # Mean error metrics and total time by engine, and relative change against the reference
+    summary = results.groupby('engine', sort=False).agg(
+        {**{em: 'mean' for em in error_metric}, 'loop_duration_seconds': 'sum'}
+    )
+    reference = summary.iloc[0]
+    for col in error_metric + ['loop_duration_seconds']:
+        summary[col + '_change'] = summary[col] / reference[col] - 1
+
+    return results, summary
+
+
+def compare_retrain_policies(
+        df,
+        DEP_VAR,
+        INDEP_VARS,
+        drift_detector=None,
+        error_metric=['rmse', 'mae', 'mape', 'mdae'],
+        verbose=False,
+        **kwargs
+        ):
+    """
+    Run the same backtest retraining every month and retraining only when drift is detected,
+    and compare accuracy and speed.
+
+    :param drift_detector: DriftDetector used by the drift policy (default thresholds if None).
+    :param kwargs: Any other argument of `estimate_xgb` (same for both policies).
+    :return: Tuple with the per-month results of both policies (long format, with a
+        'retrain_policy' column) and a summary with the mean error metrics, the total time,
+        the months retrained and the change of each against always retraining.
+    """
+    results_list = []
+    for retrain_policy in ['always', 'drift']:
+        if verbose>0:
+            print(f"Running backtest with retrain policy: {retrain_policy}")
+
+        results = estimate_xgb(df, DEP_VAR, INDEP_VARS, retrain_policy=retrain_policy,
+                               drift_detector=drift_detector, error_metric=error_metric,
+                               verbose=verbose, **kwargs)
+        results.insert(1, 'retrain_policy', retrain_policy)
+        if retrain_policy == 'always':
+            results['retrained'] = results['loop_duration_seconds'].notna()
+        results_list.append(results.dropna(subset=['loop_duration_seconds']))
+
+    results = pd.concat(results_list, ignore_index=True)
+    results['retrained'] = results['retrained'].astype(bool)
+
+    # Mean error metrics, total time and months retrained by policy, and relative change
+    # against always retraining
+    summary = results.groupby('retrain_policy', sort=False).agg(
+        {**{em: 'mean' for em in error_metric}, 'loop_duration_seconds': 'sum', 'retrained': 'sum'}
+    )
+    reference = summary.iloc[0]
+    for col in error_metric + ['loop_duration_seconds']:
+        summary[col + '_change'] = summary[col] / reference[col] - 1
+
+    return results, summary
+
+
+def estimate_xgb_multiwindow(
+        df,
+        DEP_VAR,
+        INDEP_VARS,
+
+        time_window_sizes=[1, 3, 6, 9, 12, 24, 36],
+
+        sample_df=False,
+        starting_month=0,
+        ending_month=None,
+
+        best_params_path=None,
+
+        error_metric=['rmse', 'mae', 'mape', 'mdae'],
+        save_model_path=False,
+        error_metrics_path=None,
+        experiment_n=None,
+        test_months=None,
+
+        engine='exact', # or 'hist'
+        max_bin=256,
+        n_cores=None,
+
+        verbose=False,
+        seed_=789
+        ):
+    """
+    Walk-forward estimation of the models of every window size in a single pass over the
+    data, as `estimate_xgb(time_window_size=ws)` (without tuning) does for one window size.
+
+    The data is sorted and indexed once (one shared feature matrix); for each test month,
+    the models of all the window sizes are trained at the same time on threads, each on a
+    slice of that matrix.
+
+    :param time_window_sizes: List of window sizes (months of training data).
+    :param best_params_path: String, path to a saved model whose parameters are imposed on every model.
+    :param save_model_path: String, model store where the models are saved (under 'not_tuned',
+        the directory `run_ensemble` reads).
+    :param error_metrics_path: String, directory where the error metrics of each window size are
+        saved as `exp{experiment_n}{ws}_notuning.csv`, as `run_ensemble` reads them (not saved if None).
+    :param experiment_n: Experiment number used in the name of those files.
+    :param test_months: List of months to estimate (all the months with enough training data if None).
+    :return: Long-format DataFrame with one row per month and window size.
+    """
+    # Start measuring total execution time
+    start_time_total = time.time()
+
+    check_engine(engine)
+    time_window_sizes = sorted(time_window_sizes)
+
+    # Sort data frame by month, once for every window size
+    df = df.sort_values(by=['listing_month'])
+    unique_months = sorted(df["listing_month"].unique())
+    if starting_month:
+        df = df.loc[(df['listing_month'] >= unique_months[starting_month])].copy()
+    if ending_month:
+        df = df.loc[(df['listing_month'] <= unique_months[ending_month])].copy()
+    if sample_df:
+        df = df.sample(n=sample_df)
+
+    month_index = MonthIndex(df, INDEP_VARS, DEP_VAR)
+    del df
+
+    # Models of the same month are trained at the same time, and share the cores
+    core_plan = plan_cores(n_cores, n_months=1, n_search_tasks=len(time_window_sizes))
+
+    # Parameters imposed on every model
+    model_params = {}
+    if best_params_path is not None:
+        model_params = load_model_file(best_params_path).get_params()
+
+    model_store = get_model_store(save_model_path) if save_model_path else None
+
+    def fit_window(month, time_window_size):
+        start_time_loop = time.time()
+
+        # Training window: the `time_window_size` months before the test month
+        first_month = (month - pd.DateOffset(months=time_window_size)).to_datetime64()
+        train_rows = month_index.rows(first_month, month)
+        X_train, y_train = month_index.X[train_rows], month_index.y[train_rows]
+        X_test, y_test = month_index.test(month)
+
+        xgbr = xgb.XGBRegressor(objective='reg:squarederror', tree_method='exact', seed=seed_,
+                                n_jobs=core_plan.booster_jobs)
+        xgbr.set_params(**model_params)
+        xgbr.set_params(n_jobs=core_plan.booster_jobs)
+
+        if engine == 'hist':
+            hist_window = HistWindow(X_train, y_train, max_bin=max_bin, seed_=seed_, n_jobs=core_plan.booster_jobs)
+            model = hist_window.fit(xgbr.get_params())
+            y_pred = hist_window.predict(model, X_test)
+        else:
+            model = xgbr.fit(X_train, y_train)
+            y_pred = model.predict(X_test)
+
+        if model_store is not None:
+            model_store.save(model, model_store.key(time_window_size, month, 'not_tuned', sample_df))
+
+        result = {'month': month, 'window_size': time_window_size,
+                  'loop_duration_seconds': time.time() - start_time_loop}
+        return result, y_pred, y_test
+
+    if test_months is not None:
+        test_months = set(pd.to_datetime(test_months))
+
+    # Each window size starts once it has `time_window_size` months of training data,
+    # as in estimate_xgb
+    results_list = []
+    for month_pos, month in enumerate(unique_months[starting_month:ending_month]):
+        month = pd.Timestamp(month)
+        window_sizes = [ws for ws in time_window_sizes if month_pos >= ws]
+        if not window_sizes or (test_months is not None and month not in test_months):
+            continue
+
+        if verbose>1:
+            print(f"Starting estimation for month: {month.strftime('%Y-%m')} (window sizes {window_sizes})")
+
+        results_list.extend(Parallel(n_jobs=core_plan.search_jobs, backend='threading')(
+            delayed(fit_window)(month, ws) for ws in window_sizes
+        ))
+
+    # Error metrics of every month and window size at once (each model's test month is a group)
+    check_metrics(error_metric)
+    results = pd.DataFrame([result for result, _, _ in results_list], columns=['month', 'window_size', 'loop_duration_seconds'])
+    if results_list:
+        metrics = grouped_metrics(
+            np.concatenate([y_pred for _, y_pred, _ in results_list]),
+            np.concatenate([y_test for _, _, y_test in results_list]),
+            np.repeat(np.arange(len(results_list)), [len(y_test) for _, _, y_test in results_list]),
+            error_metric, n_groups=len(results_list))
+    for i, em in enumerate(error_metric):
+        results.insert(2 + i, em, metrics[em] if results_list else np.nan)
+    results = results.sort_values(by=['window_size', 'month']).reset_index(drop=True)
+
+    # Error metrics of each window size, in the files run_ensemble reads to weight the models
+    if error_metrics_path is not None:
+        os.makedirs(error_metrics_path, exist_ok=True)
+        for ws in time_window_sizes:
+            # One row per month, empty before the window size starts, as estimate_xgb saves them
+            results_ws = pd.DataFrame({'month': pd.to_datetime(unique_months)}).merge(
+                results.loc[results['window_size'] == ws].drop(columns=['window_size']), on='month', how='left')
+            path_ = os.path.join(error_metrics_path, f'exp{experiment_n}{ws}_notuning.csv')
+            results_ws.to_csv(path_, index=False)
+
+    # End measuring total execution time
+    total_duration = time.time() - start_time_total
+    if verbose>0:
+        print(f"Total execution time: {total_duration:.2f} seconds\n\n\n")
+
+    return results
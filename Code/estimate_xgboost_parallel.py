@@ -3,8 +3,14 @@ import time
 import xgboost as xgb
 import numpy as np
 from sklearn.model_selection import GridSearchCV, TimeSeriesSplit
-from sklearn.metrics import make_scorer, mean_absolute_percentage_error, mean_squared_error, mean_absolute_error
-from multiprocessing import Pool, cpu_count
+from multiprocessing import Pool
+from joblib import parallel_backend
+from month_index import MonthIndex
+from scheduler import plan_cores, n_search_tasks, order_largest_first, UtilizationTracker
+from training_engine import HistWindow, check_engine
+from metrics import grouped_metrics, check_metrics
+from model_store import parse_month
+from run_journal import RunJournal, month_metrics
 
 def estimate_xgb_parallel(
         df,
@@ -32,6 +38,12 @@ def estimate_xgb_parallel(
        'distance_to_transport', 'distance_to_greenspace',
        'longitude', 'latitude'],
         error_metric = ['rmse', 'mae', 'mape'],
+        engine='exact', # or 'hist'
+        max_bin=256,
+        n_cores=None,
+        max_months_in_flight=None,
+        journal_path=None,
+        resume=False,
         verbose=False,
         seed_=789
         ):
@@ -49,22 +61,93 @@ def estimate_xgb_parallel(
     # Unique months
     unique_months = sorted(df["listing_month"].unique())
 
-    # Preparing parameters for each month
+    # Index the rows of each month once and put the data in shared memory, so that
+    # workers attach to a single copy instead of receiving the data with every month
+    month_index = MonthIndex(df, INDEP_VARS, DEP_VAR)
+    shared_spec = month_index.share()
+    del df
+
+    check_engine(engine)
+    check_metrics(error_metric)
+
+    # Journal of finished months, written as each month completes. When resuming, the
+    # journaled months are not computed again
+    journal = None
+    journaled = {}
+    if journal_path is not None:
+        journal = RunJournal(journal_path)
+        if resume:
+            journaled = journal.entries()
+    elif resume:
+        raise ValueError("resume=True requires a journal_path.")
+
+    # Split the core budget among months in flight, grid search fits and booster threads
+    months = [month for month in unique_months[starting_month + 1:] if parse_month(month) not in journaled]
+    if no_tuning:
+        search_tasks = 1
+    else:
+        search_tasks = n_search_tasks([parameter_grid_1, parameter_grid_2])
+    core_plan = plan_cores(n_cores, n_months=len(months), n_search_tasks=search_tasks,
+                           max_months_in_flight=max_months_in_flight)
+    if verbose:
+        print(f"Core plan: {core_plan}")
+
+    # Start the most expensive months (largest training samples) first
+    training_rows = [month_index.rows(unique_months[0], month).stop for month in months]
+    months = order_largest_first(months, training_rows)
+
+    # Preparing parameters for each month (only months, not data, are sent to the workers)
     params_list = []
-    for month in unique_months[starting_month + 1:]:
-        params_list.append((month, df, parameter_grid_1, parameter_grid_2, 
+    for month in months:
+        params_list.append((month, parameter_grid_1, parameter_grid_2, 
                             INDEP_VARS, DEP_VAR, 
                             sample_weights, cv_strategy, seed_, verbose, no_tuning,
-                            unique_months))
+                            unique_months, core_plan.search_jobs, core_plan.booster_jobs,
+                            engine, max_bin))
 
-    # Use multiprocessing to process each month in parallel
-    pool = Pool(processes=cpu_count()-1)
-    results_list = pool.map(process_month, params_list)
-    pool.close()
-    pool.join()
+    # Use multiprocessing to process each month in parallel. Months are handed out
+    # one at a time, so the order above is kept.
+    tracker = UtilizationTracker(core_plan.total_cores)
+    results_list = []
+    predictions = []
+    try:
+        pool = Pool(processes=core_plan.months_in_flight, initializer=attach_month_index, initargs=(shared_spec,))
+        for result, y_pred, y_test in pool.imap_unordered(process_month, params_list, chunksize=1):
+            tracker.add(result['cpu_seconds'], result['loop_duration_seconds'])
+            results_list.append(result)
+            predictions.append((y_pred, y_test))
+            if journal is not None:
+                journal.append(result['month'], {**{key: value for key, value in result.items() if key != 'month'},
+                                                 **month_metrics(y_pred, y_test, error_metric)})
+        pool.close()
+        pool.join()
+    finally:
+        month_index.unlink()
 
-    # Convert results to a DataFrame
+    # Convert results to a DataFrame, with the error metrics of all months computed at once
     results = pd.DataFrame(results_list)
+    if results_list:
+        metrics = grouped_metrics(
+            np.concatenate([y_pred for y_pred, _ in predictions]),
+            np.concatenate([y_test for _, y_test in predictions]),
+            np.repeat(np.arange(len(predictions)), [len(y_test) for _, y_test in predictions]),
+            error_metric, n_groups=len(predictions))
+        for em in error_metric:
+            results[em] = metrics[em]
+
+    # Journaled months of a resumed run
+    if journaled:
+        journaled_results = pd.DataFrame(
+            [{'month': month, **journaled[parse_month(month)]['values']}
+             for month in unique_months[starting_month + 1:] if parse_month(month) in journaled]
+        )
+        results = pd.concat([results, journaled_results], ignore_index=True)
+    results = results.sort_values(by=['month']).reset_index(drop=True)
+
+    # Report how much of the core budget was used
+    results.attrs['utilization'] = tracker.report()
+    if verbose:
+        print(f"Realized core utilization: {results.attrs['utilization']['utilization']:.1%}")
 
     # End measuring total execution time
     end_time_total = time.time()
@@ -75,29 +158,37 @@ def estimate_xgb_parallel(
     return results
 
 
+# Month index attached to the shared data, one per worker process
+_worker_month_index = None
+
+
+# Worker initializer: attach to the data shared by estimate_xgb_parallel
+def attach_month_index(shared_spec):
+    global _worker_month_index
+    _worker_month_index = MonthIndex.attach(shared_spec)
+
+
 # Define the function to be executed in parallel
 def process_month(params):
     # Unpack parameters
-    (month, df, parameter_grid_1, parameter_grid_2, 
+    (month, parameter_grid_1, parameter_grid_2, 
      INDEP_VARS, DEP_VAR, 
-     sample_weights, cv_strategy, seed_, verbose, no_tuning, unique_months) = params
+     sample_weights, cv_strategy, seed_, verbose, no_tuning, unique_months,
+     search_jobs, booster_jobs, engine, max_bin) = params
+    month_index = _worker_month_index
 
-    # Subset df
-    df_subset_train = df.loc[df['listing_month'] < month].copy()
-    df_subset_test = df.loc[df['listing_month'] == month].copy()
+    # Start measuring wall and CPU time for this month
+    start_time_loop = time.time()
+    start_cpu_loop = time.process_time()
 
-    # Define sample weights based on month
-    df_subset_train['first_month'] = unique_months[0].copy()
-    df_subset_train['month_abs_diff'] = round(
-        (df_subset_train['listing_month'] - df_subset_train['first_month']).dt.days / 30
-    )
-
-    # Define training and test samples
+    # Define training and test samples: every month before this one, and this month
     # !!! In exp 3 this will require a function
-    X_train = df_subset_train[INDEP_VARS]
-    y_train = df_subset_train[DEP_VAR]
-    X_test = df_subset_test[INDEP_VARS]
-    y_test = df_subset_test[DEP_VAR]
+    train_rows = month_index.rows(unique_months[0], month)
+    X_train, y_train = month_index.X[train_rows], month_index.y[train_rows]
+    X_test, y_test = month_index.test(month)
+
+    # Define sample weights based on month
+    month_abs_diff = month_index.month_abs_diff(train_rows)
 
     # Prepare the result for this month
     result = {
@@ -114,7 +205,20 @@ def process_month(params):
         cv_arg = TimeSeriesSplit(n_splits=5)
 
     # Initiate XGB regressor
-    xgbr = xgb.XGBRegressor(objective='reg:squarederror', tree_method = 'exact', seed=seed_)
+    xgbr = xgb.XGBRegressor(objective='reg:squarederror', tree_method = 'exact', seed=seed_,
+                            n_jobs=booster_jobs)
+
+    # Define sample weights
+    s_weights = None
+    if sample_weights == 'linear':
+        s_weights = month_abs_diff
+    elif sample_weights == 'quadratic':
+        s_weights = month_abs_diff ** 2
+
+    # Hist engine: quantize the training window and the CV folds once
+    if engine == 'hist':
+        hist_window = HistWindow(X_train, y_train, sample_weight=s_weights, max_bin=max_bin, seed_=seed_,
+                                 n_jobs=booster_jobs, search_jobs=search_jobs)
 
     # No tuning
     if no_tuning:
@@ -127,51 +231,47 @@ def process_month(params):
 
         # Loop through each round of tuning
         for round_num, params in enumerate(parameter_grids, start=1):
-            grid_search = GridSearchCV(
-                estimator=xgbr, 
-                param_grid=params, 
-                cv=cv_arg, 
-                scoring='neg_mean_squared_error', 
-                verbose=0, 
-                n_jobs=-1
-            )
-
-            # Fit the model with or without sample weights
-            if sample_weights is None:
-                grid_search.fit(X_train, y_train)
+            if engine == 'hist':
+                best_params = hist_window.grid_search(xgbr.get_params(), params, cv_arg)
+
             else:
-                if sample_weights == 'linear':
-                    s_weights = df_subset_train['month_abs_diff']
-                elif sample_weights == 'quadratic':
-                    s_weights = df_subset_train['month_abs_diff'] ** 2
-                grid_search.fit(X_train, y_train, sample_weight=s_weights)
+                grid_search = GridSearchCV(
+                    estimator=xgbr, 
+                    param_grid=params, 
+                    cv=cv_arg, 
+                    scoring='neg_mean_squared_error', 
+                    verbose=0, 
+                    n_jobs=search_jobs
+                )
+
+                # Fit the model with or without sample weights. Fits run on threads (XGBoost
+                # releases the GIL), so they stay within this month's share of the cores.
+                with parallel_backend('threading'):
+                    grid_search.fit(X_train, y_train, sample_weight=s_weights)
+                best_params = grid_search.best_params_
 
             # Update the model with the best parameters
-            best_params = grid_search.best_params_
             xgbr.set_params(**best_params)
 
             # Store best parameters for this month in the results data frame
             for key, value in best_params.items():
-                result.loc[result['month'] == month, key] = value
+                result[key] = value
 
         # Get the best estimator after tuning
-        best_model = grid_search.best_estimator_
-
-    # Fit the model to the training set
-    best_model.fit(X_train, y_train)
-
-    # Predict and calculate error metrics
-    y_pred = best_model.predict(X_test)
-
-    # Calculate error metric
-    result_metrics = {}
-    for em in ['rmse', 'mae', 'mape']:
-        if em == 'rmse':
-            result_metrics['rmse'] = np.sqrt(mean_squared_error(y_pred, y_test))
-        elif em == 'mae':
-            result_metrics['mae'] = np.sqrt(mean_absolute_error(y_pred, y_test))
-        elif em == 'mape':
-            result_metrics['mape'] = np.sqrt(mean_absolute_percentage_error(y_pred, y_test))
-    result.update(result_metrics)
-
-    return result
\ No newline at end of file
+        best_model = xgbr
+
+    # Fit the model to the training set, predict and calculate error metrics
+    if engine == 'hist':
+        best_model = hist_window.fit(best_model.get_params())
+        y_pred = hist_window.predict(best_model, X_test)
+    else:
+        best_model.fit(X_train, y_train)
+        y_pred = best_model.predict(X_test)
+
+    # Error metrics are calculated for all months at once by estimate_xgb_parallel
+
+    # End measuring time for this month
+    result['loop_duration_seconds'] = time.time() - start_time_loop
+    result['cpu_seconds'] = time.process_time() - start_cpu_loop
+
+    return result, np.asarray(y_pred), np.asarray(y_test)
\ No newline at end of file
@@ -0,0 +1,366 @@
+import time
+import numpy as np
+import pandas as pd
+from multiprocessing import Pool
+from scipy import sparse
+from batch_inference import predict_members, member_dmatrices, feature_subset
+from feature_layout import check_feature_layout, categorical_features, location_columns
+from metrics import check_metrics, grouped_metrics
+from model_store import get_model_store, parse_month
+from month_index import MonthIndex
+from scheduler import plan_cores, order_largest_first
+
+# Attributions computed by `month_attributions`
+ATTRIBUTION_METHODS = ['shap', 'permutation']
+
+
+def check_attribution_methods(methods):
+    for method in methods:
+        if method not in ATTRIBUTION_METHODS:
+            raise ValueError(f"Invalid attribution method {method}. Please choose from {ATTRIBUTION_METHODS}.")
+
+
+def dense_features(X):
+    """
+    Dense float32 copy of a feature matrix. Entries a sparse matrix doesn't store become
+    NaN (missing), which is how XGBoost reads them, so predictions don't change.
+    """
+    if not sparse.issparse(X):
+        return np.ascontiguousarray(X, dtype=np.float32)
+    X = X.tocoo()
+    dense = np.full(X.shape, np.nan, dtype=np.float32)
+    dense[X.row, X.col] = X.data
+    return dense
+
+
+def _member_weights(weights, n_members):
+    # Weights of the members of an ensemble (equal if None), summing to 1
+    if weights is None:
+        return np.full(n_members, 1 / n_members)
+    weights = np.asarray(weights, dtype=np.float64).ravel()
+    return weights / weights.sum()
+
+
+def _group_matrix(features, feature_groups):
+    # (features x groups) 0/1 matrix that adds up the columns of each group
+    position = {col: j for j, col in enumerate(features)}
+    groups = np.zeros((len(features), len(feature_groups)))
+    for g, cols in enumerate(feature_groups.values()):
+        groups[[position[col] for col in cols], g] = 1
+    return groups
+
+
+def shap_values(models, X, weights=None, feature_types=None, n_cores=None):
+    """
+    TreeSHAP contributions of a model or an ensemble for every row of a sample, from
+    XGBoost's `pred_contribs` (one DMatrix shared by the members trained on the same features).
+
+    SHAP values are additive in the model, so the contributions of a weighted ensemble are
+    the weighted sum of the members' contributions.
+
+    :param models: List of fitted XGBRegressor models (a single model is a list of one).
+    :param X: Array or CSR matrix with the features of the sample.
+    :param weights: Array with the weight of each member (equal weights if None).
+    :param feature_types: List of XGBoost feature types ('q', 'c'), for models with categorical features.
+    :param n_cores: Integer, threads of each booster (all cores if None).
+    :return: Array (rows x features + 1); the last column is the bias (expected prediction).
+    """
+    if not sparse.issparse(X):
+        X = np.ascontiguousarray(X, dtype=np.float32)
+    weights = _member_weights(weights, len(models))
+
+    core_plan = plan_cores(n_cores)
+    dmatrices = member_dmatrices(models, X, feature_types, nthread=core_plan.total_cores)
+
+    # Members trained on a subset of the features contribute nothing through the others
+    contributions = np.zeros((X.shape[0], X.shape[1] + 1))
+    for model, dmatrix, weight in zip(models, dmatrices, weights):
+        booster = model.get_booster()
+        booster.set_param({'nthread': core_plan.total_cores})
+        member_contributions = weight * booster.predict(dmatrix, pred_contribs=True)
+        subset = feature_subset(model)
+        if subset is None:
+            contributions += member_contributions
+        else:
+            contributions[:, subset] += member_contributions[:, :-1]
+            contributions[:, -1] += member_contributions[:, -1]
+    return contributions
+
+
+def permutation_importance(models, X, y, weights=None, feature_groups=None, n_repeats=30,
+                           error_metric=['rmse'], feature_types=None, max_batch_rows=500_000,
+                           n_cores=None, seed_=789):
+    """
+    Permutation importance of a model or an ensemble: how much each error metric grows
+    when a feature (or a group of features, permuted together) is shuffled.
+
+    Instead of predicting the sample once per feature and repeat, the permuted copies of
+    the sample are stacked into one matrix (up to `max_batch_rows` rows) that every member
+    predicts at once, and the errors of all the copies come from one grouped reduction.
+
+    :param models: List of fitted XGBRegressor models (a single model is a list of one).
+    :param X: Array or CSR matrix with the features of the sample.
+    :param y: Array with the target of the sample.
+    :param weights: Array with the weight of each member (equal weights if None).
+    :param feature_groups: Dictionary mapping a name to a list of column positions permuted
+        together (each column on its own if None).
+    :param n_repeats: Integer, permutations of each feature.
+    :param error_metric: List of metrics: 'rmse', 'mae', 'mape', 'mdae' or 'pinball_<quantile>'.
+    :param feature_types: List of XGBoost feature types ('q', 'c'), for models with categorical features.
+    :param max_batch_rows: Integer, largest number of rows predicted at once (bounds memory).
+    :param n_cores: Integer, cores to use (all cores if None).
+    :param seed_: Integer, seed of the permutations.
+    :return: DataFrame with one row per feature (group): the increase of each metric
+        ('<metric>_mean') and its standard deviation across repeats ('<metric>_std').
+    """
+    check_metrics(error_metric)
+    X = dense_features(X)
+    y = np.asarray(y, dtype=np.float64).ravel()
+    n_rows = len(y)
+    weights = _member_weights(weights, len(models))
+    if feature_groups is None:
+        feature_groups = {j: [j] for j in range(X.shape[1])}
+    rng = np.random.default_rng(seed_)
+
+    def ensemble_prediction(X_):
+        return weights @ predict_members(models, X_, n_cores=n_cores, feature_types=feature_types)
+
+    # Error of the unpermuted sample
+    baseline = grouped_metrics(ensemble_prediction(X), y, np.zeros(n_rows, dtype=np.int64), error_metric)
+
+    # Every (feature group, repeat) is one permuted copy of the sample; the copies are
+    # predicted in batches that fit in max_batch_rows
+    tasks = [(g, cols) for g, cols in enumerate(feature_groups.values()) for _ in range(n_repeats)]
+    copies_per_batch = max(1, max_batch_rows // max(n_rows, 1))
+    increases = {em: np.zeros(len(tasks)) for em in error_metric}
+    for start in range(0, len(tasks), copies_per_batch):
+        batch = tasks[start:start + copies_per_batch]
+        X_stack = np.tile(X, (len(batch), 1))
+        for i, (_, cols) in enumerate(batch):
+            permutation = rng.permutation(n_rows)
+            X_stack[i * n_rows:(i + 1) * n_rows, cols] = X[np.ix_(permutation, cols)]
+
+        copy_codes = np.repeat(np.arange(len(batch)), n_rows)
+        metrics = grouped_metrics(ensemble_prediction(X_stack), np.tile(y, len(batch)), copy_codes,
+                                  error_metric, n_groups=len(batch))
+        for em in error_metric:
+            increases[em][start:start + len(batch)] = metrics[em] - baseline[em][0]
+
+    # Mean and standard deviation across the repeats of each feature group
+    importance = pd.DataFrame({'feature': list(feature_groups)})
+    for em in error_metric:
+        by_group = increases[em].reshape(len(feature_groups), n_repeats)
+        importance[em + '_mean'] = by_group.mean(axis=1)
+        importance[em + '_std'] = by_group.std(axis=1)
+    return importance
+
+
+def attribute_month(month_index, month, models, weights=None, methods=['shap', 'permutation'],
+                    feature_groups=None, n_repeats=30, error_metric=['rmse'], feature_types=None,
+                    max_rows=None, max_batch_rows=500_000, n_cores=None, seed_=789):
+    """
+    Attributions of one month's model (or ensemble) on that month's test sample.
+
+    :param month_index: MonthIndex with the data.
+    :param feature_groups: Dictionary mapping a name to a list of features attributed
+        together (e.g. `location_columns(INDEP_VARS)` for whole neighbourhoods and communes);
+        the features not in a group are attributed on their own.
+    :param max_rows: Integer, attribute a random sample of at most this many rows of the month (all rows if None).
+    :return: DataFrame with one row per feature (group): 'mean_abs_shap' and 'mean_shap'
+        (SHAP contributions of a group are added up row by row) and the permutation
+        importance of each metric.
+    """
+    X, y = month_index.test(month)
+    if max_rows is not None and len(y) > max_rows:
+        rows = np.sort(np.random.default_rng(seed_).choice(len(y), max_rows, replace=False))
+        X, y = X[rows], y[rows]
+
+    # Columns of each feature (group), in the order of the features
+    features = month_index.INDEP_VARS
+    grouped = {col for cols in (feature_groups or {}).values() for col in cols}
+    groups = {}
+    for col in features:
+        if col not in grouped:
+            groups[col] = [col]
+        else:
+            name = next(name for name, cols in feature_groups.items() if col in cols)
+            groups.setdefault(name, list(feature_groups[name]))
+    position = {col: j for j, col in enumerate(features)}
+    group_positions = {name: [position[col] for col in cols] for name, cols in groups.items()}
+
+    attributions = pd.DataFrame({'month': month, 'feature': list(groups)})
+    if 'shap' in methods:
+        contributions = shap_values(models, X, weights, feature_types, n_cores)
+        group_contributions = contributions[:, :-1] @ _group_matrix(features, groups)
+        attributions['mean_abs_shap'] = np.abs(group_contributions).mean(axis=0)
+        attributions['mean_shap'] = group_contributions.mean(axis=0)
+        attributions['bias'] = contributions[:, -1].mean()
+    if 'permutation' in methods:
+        importance = permutation_importance(models, X, y, weights, group_positions, n_repeats, error_metric,
+                                            feature_types, max_batch_rows, n_cores, seed_)
+        for col in importance.columns.drop('feature'):
+            attributions['permutation_' + col] = importance[col].to_numpy()
+    attributions['n_rows'] = len(y)
+    return attributions
+
+
+# Month index attached to the shared data, one per worker process
+_worker_month_index = None
+
+
+# Worker initializer: attach to the data shared by month_attributions
+def attach_month_index(shared_spec):
+    global _worker_month_index
+    _worker_month_index = MonthIndex.attach(shared_spec)
+
+
+# Attributions of one month in a worker: the models are read from the model store there
+def process_month(params):
+    (month, path_to_models, model_keys, weights, kwargs) = params
+    model_store = get_model_store(path_to_models)
+    start_time = time.time()
+    attributions = attribute_month(_worker_month_index, month, [model_store.load(key) for key in model_keys],
+                                   weights, **kwargs)
+    attributions['seconds'] = time.time() - start_time
+    return attributions
+
+
+def month_attributions(
+        df,
+        path_to_models,
+        DEP_VAR=['price_realpesos'],
+        INDEP_VARS=None,
+        time_window_sizes=[1],
+        hyp_tune='not_tuned',
+        sample_df=False,
+        cv_strategy=None,
+        months=None,
+        weights=None,
+        methods=['shap', 'permutation'],
+        feature_groups=None,
+        n_repeats=30,
+        error_metric=['rmse'],
+        max_rows=None,
+        max_batch_rows=500_000,
+        feature_layout='dummies', # or 'categorical', 'sparse'
+        n_cores=None,
+        verbose=False,
+        seed_=789
+):
+    """
+    Attributions of every month's model saved by `estimate_xgb` (one window size), or of
+    every month's ensemble of `run_ensemble` (several window sizes), on the month it predicts.
+
+    Months are computed in parallel, each in a worker process attached to a single shared
+    copy of the data that reads its month's models from the model store.
+
+    :param df: DataFrame with the data (as given to estimate_xgb / run_ensemble).
+    :param path_to_models: String, the model store where the models were saved.
+    :param time_window_sizes: List of window sizes, one model per month (several make an ensemble).
+    :param hyp_tune: String, 'tuned' or 'not_tuned' as estimate_xgb saves them (None for the
+        models at the root of the store, as run_ensemble reads them).
+    :param months: List of months to attribute (every month with a model for each window size if None).
+    :param weights: Dictionary mapping 'YYYY-MM' to the ensemble weights of that month (equal weights if None).
+    :param methods: List of attributions: 'shap' and/or 'permutation'.
+    :param feature_groups: Dictionary mapping a name to a list of features attributed together.
+    :param feature_layout: String, the layout the models were trained with.
+    :param n_cores: Integer, cores to use (all cores if None), split between months and booster threads.
+    :return: Long DataFrame, the month x feature importance cube, with one row per month and
+        feature (group); see `importance_cube` for a month x feature table of one measure.
+    """
+    check_attribution_methods(methods)
+    check_metrics(error_metric)
+    check_feature_layout(feature_layout)
+    start_time_total = time.time()
+
+    feature_types = None
+    sparse_columns = None
+    if feature_layout == 'categorical':
+        df, INDEP_VARS, feature_types = categorical_features(df, INDEP_VARS)
+        # The dummies of a location are now a single categorical column
+        if feature_groups is not None:
+            feature_groups = {name: [col for col in cols if col in INDEP_VARS]
+                              for name, cols in feature_groups.items()}
+            feature_groups = {name: cols for name, cols in feature_groups.items() if cols}
+    elif feature_layout == 'sparse':
+        sparse_columns = [col for cols in location_columns(INDEP_VARS).values() for col in cols]
+
+    month_index = MonthIndex(df, INDEP_VARS, DEP_VAR, sparse_columns=sparse_columns)
+    del df
+
+    # Months with a saved model for every window size
+    model_store = get_model_store(path_to_models)
+    saved_months = None
+    for ws in time_window_sizes:
+        ws_months = set(model_store.months(ws, hyp_tune, sample_df, cv_strategy))
+        saved_months = ws_months if saved_months is None else saved_months & ws_months
+    data_months = {parse_month(month): month for month in month_index.months}
+    if months is None:
+        months = sorted(saved_months & set(data_months))
+    months = [parse_month(month) for month in months]
+
+    # Split the cores between months in flight and booster threads, largest months first
+    core_plan = plan_cores(n_cores, n_months=len(months))
+    month_rows = [month_index.month_rows(data_months[month]).stop - month_index.month_rows(data_months[month]).start
+                  for month in months]
+    months = order_largest_first(months, month_rows)
+    if verbose:
+        print(f"Core plan: {core_plan}")
+
+    kwargs = {'methods': methods, 'feature_groups': feature_groups, 'n_repeats': n_repeats,
+              'error_metric': error_metric, 'feature_types': feature_types, 'max_rows': max_rows,
+              'max_batch_rows': max_batch_rows, 'n_cores': core_plan.booster_jobs, 'seed_': seed_}
+    params_list = []
+    for month in months:
+        model_keys = [model_store.key(ws, month, hyp_tune, sample_df, cv_strategy) for ws in time_window_sizes]
+        month_weights = None if weights is None else weights[month]
+        params_list.append((data_months[month], path_to_models, model_keys, month_weights, kwargs))
+
+    # A single month in flight runs here; otherwise months are handed out one at a time
+    # to workers attached to the shared data
+    attributions = []
+    if core_plan.months_in_flight == 1:
+        global _worker_month_index
+        _worker_month_index = month_index
+        for params in params_list:
+            attributions.append(process_month(params))
+            if verbose > 1:
+                print(f"Attributed month {parse_month(params[0])}")
+        _worker_month_index = None
+    else:
+        shared_spec = month_index.share()
+        try:
+            pool = Pool(processes=core_plan.months_in_flight, initializer=attach_month_index, initargs=(shared_spec,))
+            for month_attribution in pool.imap_unordered(process_month, params_list, chunksize=1):
+                attributions.append(month_attribution)
+                if verbose > 1:
+                    print(f"Attributed month {parse_month(month_attribution['month'].iloc[0])}")
+            pool.close()
+            pool.join()
+        finally:
+            month_index.unlink()
+
+    if attributions:
+        attributions = pd.concat(attributions, ignore_index=True)
+    else:
+        attributions = pd.DataFrame(columns=['month', 'feature'])
+    attributions = attributions.sort_values(by=['month'], kind='stable').reset_index(drop=True)
+
+    if verbose:
+        print(f"Total execution time: {time.time() - start_time_total:.2f} seconds")
+    return attributions
+
+
+def importance_cube(attributions, measure='mean_abs_shap', normalize=False):
+    """
+    Month x feature table of one measure of `month_attributions` (e.g. 'mean_abs_shap',
+    'permutation_rmse_mean'), to follow how the drivers of prices change over time.
+
+    :param normalize: Boolean, divide each month by its total, so months with different
+        price levels are comparable.
+    """
+    cube = attributions.pivot(index='month', columns='feature', values=measure)
+    cube = cube[attributions['feature'].drop_duplicates()]
+    if normalize:
+        cube = cube.div(cube.abs().sum(axis=1), axis=0)
+    return cube
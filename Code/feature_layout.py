@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# How the neighbourhood and commune dummies are given to XGBoost
+FEATURE_LAYOUTS = ['dummies', 'categorical', 'sparse']
+
+# Prefix of the dummy columns of each location variable, and whether the dummies dropped
+# their first category (all zeros is then that category, not a missing location)
+LOCATION_GROUPS = {'neighbourhood': ('nei_', False), 'commune': ('commune_', True)}
+
+
+def check_feature_layout(feature_layout):
+    if feature_layout not in FEATURE_LAYOUTS:
+        raise ValueError(f"Invalid feature_layout. Please choose from {FEATURE_LAYOUTS}.")
+
+
+def location_columns(INDEP_VARS):
+    """The `nei_*` and `commune_*` dummy columns of INDEP_VARS, by location variable."""
+    return {name: [col for col in INDEP_VARS if col.startswith(prefix)]
+            for name, (prefix, _) in LOCATION_GROUPS.items()
+            if any(col.startswith(prefix) for col in INDEP_VARS)}
+
+
+def categorical_features(df, INDEP_VARS):
+    """
+    Replace the location dummies by one integer-coded categorical column per location
+    variable ('neighbourhood', 'commune'), for XGBoost's native categorical splits.
+
+    The code of a row is the position of its dummy in INDEP_VARS. Communes dropped their
+    first category, so rows with no commune dummy get code 0 and the others 1, 2, ...; rows
+    with no neighbourhood dummy are missing (NaN).
+
+    :return: Tuple with the data frame (with the new columns), the new list of features
+        (the other INDEP_VARS in order, then the categorical columns) and their XGBoost
+        feature types ('q' numeric, 'c' categorical).
+    """
+    groups = location_columns(INDEP_VARS)
+    dummies = [col for cols in groups.values() for col in cols]
+    features = [col for col in INDEP_VARS if col not in dummies]
+
+    codes = {}
+    for name, cols in groups.items():
+        values = df[cols].to_numpy()
+        any_dummy = values.any(axis=1)
+        if LOCATION_GROUPS[name][1]:
+            codes[name] = np.where(any_dummy, values.argmax(axis=1) + 1, 0).astype(np.float32)
+        else:
+            codes[name] = np.where(any_dummy, values.argmax(axis=1), np.nan).astype(np.float32)
+
+    df = df.drop(columns=dummies).assign(**codes)
+    features += list(codes)
+    return df, features, ['c' if col in codes else 'q' for col in features]
+
+
+def sparse_matrix(df, INDEP_VARS, sparse_columns, dtype=np.float32):
+    """
+    CSR matrix of the features where `sparse_columns` (the location dummies) only store
+    their non-zero entries and every other column stores all its values, zeros included
+    (XGBoost treats entries that are not stored as missing).
+
+    The dense matrix of all the features is never built.
+    """
+    sparse_set = set(sparse_columns)
+    n_rows = len(df)
+    rows, cols, values = [], [], []
+    for j, col in enumerate(INDEP_VARS):
+        column = df[col].to_numpy(dtype=dtype)
+        if col in sparse_set:
+            stored = np.flatnonzero(column)
+        else:
+            stored = np.flatnonzero(~np.isnan(column))
+        rows.append(stored)
+        cols.append(np.full(len(stored), j, dtype=np.int32))
+        values.append(column[stored])
+
+    rows = np.concatenate(rows)
+    order = np.argsort(rows, kind='stable')
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=n_rows))])
+    return sparse.csr_matrix((np.concatenate(values)[order], np.concatenate(cols)[order], indptr),
+                             shape=(n_rows, len(INDEP_VARS)))
+
+
+def layout_params(feature_layout, feature_types=None):
+    """
+    XGBRegressor parameters of a feature layout. Categorical splits need the hist tree
+    method; `max_cat_to_onehot=1` makes every categorical split a partition of the categories.
+    """
+    if feature_layout == 'categorical':
+        return {'tree_method': 'hist', 'enable_categorical': True, 'feature_types': feature_types,
+                'max_cat_to_onehot': 1}
+    return {}
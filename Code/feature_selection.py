@@ -0,0 +1,145 @@
+import numpy as np
+from scipy import sparse
+from sklearn.linear_model import enet_path
+
+# Criteria to choose the alpha of the regularization path
+SELECTION_CRITERIA = ['bic', 'aic']
+
+
+def check_selection_criterion(criterion):
+    if criterion not in SELECTION_CRITERIA:
+        raise ValueError(f"Invalid criterion. Please choose from {SELECTION_CRITERIA}.")
+
+
+class LassoPathSelector:
+    """
+    Feature selection with a LASSO regularization path, recomputed every month.
+
+    The features and the target are standardized with the training window's means and
+    standard deviations, so the alphas (relative to the smallest alpha that drops every
+    feature) and the coefficients are comparable from month to month. The Gram matrix
+    X'X and X'y are computed once per month and every alpha is solved on them by
+    coordinate descent, without going through the data again.
+
+    The path goes from the largest alpha down. Each alpha starts from whichever is closer
+    to its solution (lower LASSO objective): the previous alpha's coefficients or last
+    month's coefficients at the same alpha. The chosen alpha minimizes the BIC or AIC,
+    and the features with non-zero coefficients are kept.
+
+    :param INDEP_VARS: List of feature columns.
+    :param always_keep: List of features kept whatever their coefficient (e.g. categorical
+        columns, which the LASSO can't use).
+    :param n_alphas: Integer, number of alphas of the path.
+    :param alpha_min_ratio: Float, smallest alpha of the path relative to the largest.
+    :param criterion: String, 'bic' or 'aic'.
+    :param max_features: Integer, keep at most this many features (among the alphas whose
+        coefficients have at most this many non-zeros, the one with the best criterion).
+    :param tol: Float, tolerance of the coordinate descent.
+    :param max_iter: Integer, maximum coordinate descent iterations for each alpha.
+    """
+
+    def __init__(self, INDEP_VARS, always_keep=None, n_alphas=30, alpha_min_ratio=1e-3, criterion='bic',
+                 max_features=None, tol=1e-4, max_iter=10000):
+        check_selection_criterion(criterion)
+        self.INDEP_VARS = list(INDEP_VARS)
+        self.always_keep = list(always_keep or [])
+        self.lasso_columns = [j for j, col in enumerate(self.INDEP_VARS) if col not in self.always_keep]
+        self.alpha_ratios = np.geomspace(1, alpha_min_ratio, n_alphas)
+        self.criterion = criterion
+        self.max_features = max_features
+        self.tol = tol
+        self.max_iter = max_iter
+
+        # Standardized coefficients of last month's path (alphas x LASSO features)
+        self.coef_path_ = None
+
+    def get_state(self):
+        """What the next month needs from this one (for the run journal)."""
+        return {'coef_path': self.coef_path_}
+
+    def set_state(self, state):
+        """Continue from a month saved with `get_state`."""
+        coef_path = state.get('coef_path')
+        self.coef_path_ = None if coef_path is None else np.asarray(coef_path, dtype=np.float64)
+
+    def _standardize(self, X, y):
+        # Standardized LASSO features and target; missing values get the column mean, and
+        # the entries a sparse matrix doesn't store are zeros (the location dummies)
+        if sparse.issparse(X):
+            X = X[:, self.lasso_columns].toarray()
+        else:
+            X = np.asarray(X)[:, self.lasso_columns]
+        X = X.astype(np.float64)
+        means = np.nanmean(X, axis=0)
+        X = X - means
+        X[np.isnan(X)] = 0
+        scale = X.std(axis=0)
+        X /= np.where(scale > 0, scale, 1)
+
+        y = np.asarray(y, dtype=np.float64).ravel()
+        y = y - y.mean()
+        y_scale = y.std()
+        return X, y / (y_scale if y_scale > 0 else 1)
+
+    def select(self, X, y):
+        """
+        Compute the month's regularization path and choose the features.
+
+        :param X: Array or CSR matrix with the features of the training window (all INDEP_VARS).
+        :param y: Array with the target of the training window.
+        :return: Dictionary with 'mask' (boolean array over INDEP_VARS), 'selected' (names of
+            the kept features), 'alpha' (chosen alpha, standardized units), 'alpha_ratio'
+            (relative to the largest alpha) and 'iterations' (coordinate descent iterations
+            of the whole path).
+        """
+        Z, z = self._standardize(X, y)
+        n_rows, n_features = Z.shape
+        gram = Z.T @ Z
+        Zz = Z.T @ z
+        zz = z @ z
+
+        # Sum of squared residuals and LASSO objective of coefficients w, from the Gram matrix
+        def rss(w):
+            return max(zz - 2 * w @ Zz + w @ gram @ w, 0.0)
+
+        def objective(w, alpha):
+            return rss(w) / (2 * n_rows) + alpha * np.abs(w).sum()
+
+        alphas = np.abs(Zz).max() / n_rows * self.alpha_ratios
+        previous_month = self.coef_path_
+        if previous_month is not None and previous_month.shape != (len(alphas), n_features):
+            previous_month = None
+
+        coef_path = np.zeros((len(alphas), n_features))
+        coef = np.zeros(n_features)
+        iterations = 0
+        for k, alpha in enumerate(alphas):
+            # Start from the previous alpha's or last month's solution, whichever is better
+            if previous_month is not None and objective(previous_month[k], alpha) < objective(coef, alpha):
+                coef = previous_month[k]
+            _, coefs, _, n_iter = enet_path(Z, z, l1_ratio=1.0, alphas=[alpha], precompute=gram, Xy=Zz,
+                                            coef_init=coef.copy(), check_input=False, return_n_iter=True,
+                                            tol=self.tol, max_iter=self.max_iter)
+            coef = coefs[:, 0]
+            coef_path[k] = coef
+            iterations += int(n_iter[0])
+        self.coef_path_ = coef_path
+
+        # Information criterion of each alpha (degrees of freedom: non-zero coefficients)
+        n_nonzero = (coef_path != 0).sum(axis=1)
+        log_rss = np.log(np.maximum([rss(w) for w in coef_path], np.finfo(np.float64).tiny) / n_rows)
+        penalty = np.log(n_rows) if self.criterion == 'bic' else 2
+        criterion = n_rows * log_rss + penalty * n_nonzero
+        if self.max_features is not None:
+            criterion = np.where(n_nonzero + len(self.always_keep) <= self.max_features, criterion, np.inf)
+        best = int(np.argmin(criterion))
+
+        mask = np.array([col in self.always_keep for col in self.INDEP_VARS])
+        mask[self.lasso_columns] = coef_path[best] != 0
+        # The booster needs at least one feature
+        if not mask.any():
+            mask[:] = True
+
+        return {'mask': mask, 'selected': [col for col, keep in zip(self.INDEP_VARS, mask) if keep],
+                'alpha': float(alphas[best]), 'alpha_ratio': float(self.alpha_ratios[best]),
+                'iterations': iterations}
@@ -0,0 +1,402 @@
+import math
+import time
+import importlib.util
+import numpy as np
+from joblib import Parallel, delayed
+from sklearn.base import clone
+from sklearn.model_selection import ParameterGrid, TimeSeriesSplit, check_cv
+from cv_cache import fold_key
+
+# Search backends supported by estimate_xgb
+SEARCH_BACKENDS = ['grid', 'halving', 'tpe']
+
+# Resources that successive halving can give to candidates
+HALVING_RESOURCES = ['n_estimators', 'n_samples']
+
+
+def check_search_backend(search_backend, halving_resource='n_estimators'):
+    if search_backend not in SEARCH_BACKENDS:
+        raise ValueError(f"Invalid search_backend. Please choose from {SEARCH_BACKENDS}.")
+    if search_backend == 'tpe' and importlib.util.find_spec('optuna') is None:
+        raise ValueError("Invalid search_backend. 'tpe' requires optuna (pip install optuna); "
+                         f"without it, please choose from {[b for b in SEARCH_BACKENDS if b != 'tpe']}.")
+    if halving_resource not in HALVING_RESOURCES:
+        raise ValueError(f"Invalid halving_resource. Please choose from {HALVING_RESOURCES}.")
+
+
+class SearchBudget:
+    """
+    Budget for the hyperparameter search of one month: a maximum number of model fits
+    (each fold counts as one fit) and/or a maximum number of seconds. None means no limit.
+    """
+
+    def __init__(self, max_fits=None, max_seconds=None):
+        self.max_fits = max_fits
+        self.max_seconds = max_seconds
+        self.start_time = time.time()
+
+    def elapsed(self):
+        return time.time() - self.start_time
+
+    def exhausted(self, n_fits):
+        if self.max_fits is not None and n_fits >= self.max_fits:
+            return True
+        if self.max_seconds is not None and self.elapsed() >= self.max_seconds:
+            return True
+        return False
+
+
+class MonthSeriesSplit:
+    """
+    Time series cross-validation with folds aligned on months: each of the last `n_splits`
+    months of the window is a validation fold, trained on every month before it.
+
+    Unlike TimeSeriesSplit, whose boundaries depend on the number of rows of the window, a
+    fold is the same rows of the same months in every window that contains them, so an
+    expanding window reuses the cached scores of all but its newest fold.
+
+    :param month_offsets: Array with the row where each month of the window starts (plus the end).
+    :param n_splits: Integer, number of folds (fewer if the window has fewer months).
+    """
+
+    def __init__(self, month_offsets, n_splits=5):
+        self.month_offsets = np.asarray(month_offsets)
+        self.n_splits = n_splits
+
+    def __repr__(self):
+        return f"MonthSeriesSplit(n_splits={self.n_splits})"
+
+    def get_n_splits(self, X=None, y=None, groups=None):
+        return min(self.n_splits, len(self.month_offsets) - 2)
+
+    def split(self, X, y=None, groups=None):
+        n_months = len(self.month_offsets) - 1
+        for month in range(n_months - self.get_n_splits(), n_months):
+            yield (np.arange(self.month_offsets[0], self.month_offsets[month]),
+                   np.arange(self.month_offsets[month], self.month_offsets[month + 1]))
+
+
+def month_series_cv(month_offsets, n_splits=5):
+    """
+    CV splitter of cv_strategy='month_series_split': month-aligned folds when the window has
+    at least two months, TimeSeriesSplit on the rows otherwise.
+    """
+    if len(month_offsets) > 2:
+        return MonthSeriesSplit(month_offsets, n_splits)
+    return TimeSeriesSplit(n_splits=n_splits)
+
+
+class CVEvaluator:
+    """
+    Cross-validation score (negative MSE, as GridSearchCV with scoring='neg_mean_squared_error')
+    of single candidates, so that search backends can decide which candidates to try and
+    with how many trees or rows.
+
+    With the exact engine each fold fits a clone of `estimator`; with the hist engine the
+    candidates are scored on the quantized folds of `hist_window`.
+
+    :param estimator: XGBRegressor with the base parameters.
+    :param X: Array with the features of the training window.
+    :param y: Array with the target of the training window.
+    :param cv: Integer or CV splitter, as in GridSearchCV.
+    :param sample_weight: Array with sample weights (or None).
+    :param n_jobs: Integer, folds fitted at the same time (threads).
+    :param hist_window: training_engine.HistWindow of this window, for the hist engine.
+    :param cache: cv_cache.FoldScoreCache where fold scores are looked up and stored (or None).
+    :param cache_context: Dictionary with what else the scores depend on (CV scheme, engine, sample weight scheme...).
+    :param month_offsets: Array with the row of `X` where each of its months starts (plus the end),
+                          so that cached folds are keyed on the months they span.
+    :param month_hashes: List with the hash of each month of `X` (MonthIndex.month_hashes).
+    """
+
+    def __init__(self, estimator, X, y, cv, sample_weight=None, n_jobs=1, hist_window=None,
+                 cache=None, cache_context=None, month_offsets=None, month_hashes=None):
+        self.estimator = estimator
+        self.X = X
+        self.y = np.asarray(y).ravel()
+        self.cv = cv
+        self.sample_weight = sample_weight
+        self.n_jobs = n_jobs
+        self.hist_window = hist_window
+        self.cache = cache
+        self.cache_context = cache_context or {}
+        self.month_offsets = None if month_offsets is None else np.asarray(month_offsets)
+        self.month_hashes = month_hashes
+        if cache is not None and (month_offsets is None or month_hashes is None):
+            raise ValueError("A fold score cache requires the month_offsets and month_hashes of X.")
+
+        self.folds = list(check_cv(cv).split(X))
+        self.n_folds = len(self.folds)
+        self.n_fits = 0
+        self.history = []
+
+    def max_samples(self):
+        """Rows of the smallest training fold."""
+        return min(len(train_idx) for train_idx, _ in self.folds)
+
+    def _fold_key(self, params, n_samples, train_idx, valid_idx):
+        # Months spanned by the rows of the fold, and its rows relative to the first of them
+        rows = np.concatenate([train_idx, valid_idx])
+        first = int(np.searchsorted(self.month_offsets, rows.min(), side='right')) - 1
+        last = int(np.searchsorted(self.month_offsets, rows.max(), side='right')) - 1
+        start = self.month_offsets[first]
+        return fold_key(self.cache_context, train_idx - start, valid_idx - start, params, n_samples,
+                        months=self.month_hashes[first:last + 1])
+
+    def _fold_score(self, params, train_idx, valid_idx):
+        model = clone(self.estimator).set_params(**params)
+        weight = None if self.sample_weight is None else np.asarray(self.sample_weight)[train_idx]
+        model.fit(self.X[train_idx], self.y[train_idx], sample_weight=weight)
+        return -np.mean((model.predict(self.X[valid_idx]) - self.y[valid_idx]) ** 2)
+
+    def score(self, params, n_samples=None):
+        """
+        Mean CV score of a candidate. If `n_samples` is given, only the last (most recent)
+        `n_samples` rows of each training fold are used. With a cache, only the folds not
+        found in it are fitted.
+        """
+        return self.score_many([params], n_samples)[0]
+
+    def score_many(self, candidates, n_samples=None):
+        """
+        Mean CV scores of several candidates, as `score`, with the folds of all of them
+        fitted at the same time (as GridSearchCV does with candidates x folds).
+        """
+        folds = [(train_idx if n_samples is None else train_idx[-n_samples:], valid_idx)
+                 for train_idx, valid_idx in self.folds]
+
+        # Look up the folds already scored (in this or a previous session)
+        keys, cached = None, {}
+        if self.cache is not None:
+            keys = {}
+            for c, params in enumerate(candidates):
+                key_params = {k: v for k, v in {**self.estimator.get_params(), **params}.items() if k != 'n_jobs'}
+                for i, (train_idx, valid_idx) in enumerate(folds):
+                    keys[c, i] = self._fold_key(key_params, n_samples, train_idx, valid_idx)
+            cached = self.cache.get_many(list(keys.values()))
+        missing = [(c, i) for c in range(len(candidates)) for i in range(self.n_folds)
+                   if keys is None or keys[c, i] not in cached]
+
+        scores = {}
+        if missing:
+            if self.hist_window is not None:
+                new_scores = self.hist_window.candidate_fold_scores(
+                    [({**self.estimator.get_params(), **candidates[c]}, i) for c, i in missing], self.cv, n_samples
+                )
+            else:
+                new_scores = Parallel(n_jobs=self.n_jobs, backend='threading')(
+                    delayed(self._fold_score)(candidates[c], *folds[i]) for c, i in missing
+                )
+            scores = dict(zip(missing, new_scores))
+            if self.cache is not None:
+                self.cache.put_many({keys[task]: scores[task] for task in missing})
+        if keys is not None:
+            scores.update({task: cached[key] for task, key in keys.items() if key in cached})
+
+        mean_scores = []
+        for c, params in enumerate(candidates):
+            mean_scores.append(float(np.mean([scores[c, i] for i in range(self.n_folds)])))
+            self.history.append((params, n_samples, mean_scores[-1]))
+        self.n_fits += len(missing)
+        return mean_scores
+
+    def lookup_score(self, params):
+        """Score of a candidate with the full training folds, computed only if it wasn't already."""
+        for past_params, n_samples, score in self.history:
+            if n_samples is None and past_params == params:
+                return score
+        return self.score(params)
+
+
+def successive_halving(evaluator, param_grid, resource='n_estimators', factor=3, min_resource=None, budget=None):
+    """
+    Successive halving: every candidate is first scored with a small resource (few trees,
+    or few rows), and only the best 1/factor of them move on to the next rung, where the
+    resource is multiplied by `factor`, until one candidate is left or the full resource is
+    reached. If the budget runs out, the best candidate of the last rung evaluated is kept.
+
+    :param evaluator: CVEvaluator of the training window.
+    :param param_grid: Dictionary with the values to try for each parameter.
+    :param resource: String, 'n_estimators' (trees) or 'n_samples' (most recent training rows).
+    :param factor: Integer, proportion of candidates dropped at each rung.
+    :param min_resource: Integer, smallest resource given to a candidate (10 trees or 200 rows by default).
+    :param budget: SearchBudget (no limit if None).
+    :return: Dictionary with the best parameters.
+    """
+    if budget is None:
+        budget = SearchBudget()
+    param_grid = dict(param_grid)
+
+    # Maximum resource: the largest number of trees in the grid (which is not searched,
+    # as the resource decides it), or all the rows of the training folds
+    if resource == 'n_estimators':
+        n_estimators = param_grid.pop('n_estimators', None) or [evaluator.estimator.get_params().get('n_estimators') or 100]
+        max_resource = max(n_estimators)
+        if min_resource is None:
+            min_resource = 10
+    else:
+        max_resource = evaluator.max_samples()
+        if min_resource is None:
+            min_resource = 200
+
+    candidates = list(ParameterGrid(param_grid))
+
+    # Rungs needed to get down to one candidate, limited by how many times the
+    # minimum resource can be multiplied by `factor` before reaching the maximum
+    n_rungs = 1
+    n_candidates = len(candidates)
+    while n_candidates > 1 and min_resource * factor ** n_rungs <= max_resource:
+        n_candidates = math.ceil(n_candidates / factor)
+        n_rungs += 1
+    first_resource = max(1, max_resource // factor ** (n_rungs - 1))
+
+    best_params = candidates[0]
+    for rung in range(n_rungs):
+        r = max_resource if rung == n_rungs - 1 else first_resource * factor ** rung
+
+        scores = []
+        for params in candidates:
+            if (scores or rung > 0) and budget.exhausted(evaluator.n_fits):
+                break
+            if resource == 'n_estimators':
+                scores.append(evaluator.score({**params, 'n_estimators': r}))
+            else:
+                scores.append(evaluator.score(params, n_samples=r))
+
+        # Rank the candidates evaluated in this rung and keep the best ones
+        if scores:
+            order = np.argsort(-np.asarray(scores), kind='stable')
+            best_params = candidates[order[0]]
+            candidates = [candidates[i] for i in order[:max(1, math.ceil(len(scores) / factor))]]
+
+        if len(candidates) == 1 or budget.exhausted(evaluator.n_fits):
+            break
+
+    if resource == 'n_estimators':
+        best_params = {**best_params, 'n_estimators': max_resource}
+    return best_params
+
+
+def tpe_search(evaluator, param_grid, budget=None, n_trials=50, seed_=789):
+    """
+    Bayesian search with a Tree-structured Parzen Estimator (optuna) over the values of
+    `param_grid`. Runs `n_trials` candidates, or fewer if the budget runs out first, but
+    always at least one (as the other backends do), so a round that starts with the month's
+    budget already spent still returns parameters.
+
+    :param evaluator: CVEvaluator of the training window.
+    :param param_grid: Dictionary with the values to try for each parameter.
+    :param budget: SearchBudget (no limit if None).
+    :param n_trials: Integer, maximum number of candidates.
+    :param seed_: Integer, random seed of the sampler.
+    :return: Dictionary with the best parameters.
+    """
+    try:
+        import optuna
+    except ImportError:
+        raise ValueError("Invalid search_backend. 'tpe' requires optuna (pip install optuna).")
+
+    if budget is None:
+        budget = SearchBudget()
+    optuna.logging.set_verbosity(optuna.logging.WARNING)
+
+    def objective(trial):
+        params = {key: trial.suggest_categorical(key, list(values)) for key, values in param_grid.items()}
+        return evaluator.score(params)
+
+    # Stop when the fit budget is used up (the time budget is passed to optuna directly)
+    def check_budget(study, trial):
+        if budget.exhausted(evaluator.n_fits):
+            study.stop()
+
+    study = optuna.create_study(direction='maximize', sampler=optuna.samplers.TPESampler(seed=seed_))
+    study.optimize(objective, n_trials=1)
+
+    if n_trials > 1 and not budget.exhausted(evaluator.n_fits):
+        timeout = None
+        if budget.max_seconds is not None:
+            timeout = max(0, budget.max_seconds - budget.elapsed())
+        study.optimize(objective, n_trials=n_trials - 1, timeout=timeout, callbacks=[check_budget])
+    return study.best_params
+
+
+def _is_number(value):
+    return isinstance(value, (int, float, np.number)) and not isinstance(value, bool)
+
+
+def neighbourhood_candidates(param_grid, center, radius=1):
+    """
+    Candidates around `center` (e.g. last month's best parameters): the center itself,
+    plus the center with one parameter at a time moved to the values of the grid that are
+    at most `radius` positions away from its current value.
+
+    Numeric values are sorted; a parameter with any non-numeric value (e.g. `grow_policy`,
+    or `max_leaves` with None) keeps the order of its grid list, and its neighbours are the
+    values next to it in that list.
+
+    :param param_grid: Dictionary, or list of dictionaries, with the values of each parameter.
+    :param center: Dictionary with the parameters to search around.
+    :param radius: Integer, positions to move each parameter along its sorted grid values.
+    :return: List of dictionaries with the candidate parameters.
+    """
+    if isinstance(param_grid, dict):
+        param_grid = [param_grid]
+
+    # Values of every parameter across all the grids (sorted if they are all numbers)
+    values = {}
+    for grid in param_grid:
+        for key, grid_values in grid.items():
+            key_values = values.setdefault(key, [])
+            key_values.extend(v for v in grid_values if v not in key_values)
+    for key, key_values in values.items():
+        if all(_is_number(v) for v in key_values):
+            values[key] = sorted(key_values)
+
+    candidates = [dict(center)]
+    for key, key_values in values.items():
+        if key not in center or not key_values:
+            continue
+        # Position of the current value (or, for numbers, of the closest value in the grid)
+        if center[key] in key_values:
+            pos = key_values.index(center[key])
+        elif _is_number(center[key]) and all(_is_number(v) for v in key_values):
+            pos = int(np.argmin([abs(v - center[key]) for v in key_values]))
+        else:
+            continue
+        for i in range(max(0, pos - radius), min(len(key_values), pos + radius + 1)):
+            if key_values[i] != center[key]:
+                candidates.append({**center, key: key_values[i]})
+    return candidates
+
+
+def local_search(evaluator, candidates, budget=None):
+    """
+    Score a list of candidates (the first one always) and return the best one and its score.
+    """
+    scores = []
+    for params in candidates:
+        if scores and budget is not None and budget.exhausted(evaluator.n_fits):
+            break
+        scores.append(evaluator.score(params))
+    best = int(np.argmax(scores))
+    return candidates[best], scores[best]
+
+
+def search_hyperparams(evaluator, param_grid, search_backend='halving', halving_resource='n_estimators',
+                       budget=None, seed_=789):
+    """Run one round of hyperparameter search with the chosen backend and return the best parameters."""
+    if search_backend == 'halving':
+        return successive_halving(evaluator, param_grid, resource=halving_resource, budget=budget)
+    elif search_backend == 'tpe':
+        return tpe_search(evaluator, param_grid, budget=budget, seed_=seed_)
+    elif search_backend == 'grid':
+        candidates = list(ParameterGrid(param_grid))
+        # Without a budget every candidate is scored, all of their folds at the same time
+        if budget is None or (budget.max_fits is None and budget.max_seconds is None):
+            return candidates[int(np.argmax(evaluator.score_many(candidates)))]
+        scores = []
+        for params in candidates:
+            if scores and budget is not None and budget.exhausted(evaluator.n_fits):
+                break
+            scores.append(evaluator.score(params))
+        return candidates[int(np.argmax(scores))]
@@ -0,0 +1,179 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from load_data import neighbourhood_column, commune_column, month_index, month_offsets, read_dataset_cache
+from estimate_xgboost import estimate_xgb_multiwindow
+
+
+def _append_npy(path_, values, n_rows):
+    """
+    Append values to a 1-D .npy file that holds `n_rows` rows, writing only the new rows.
+
+    The shape in the header is rewritten in place (NumPy leaves room in the header for the
+    shape to grow); anything after the first `n_rows` rows (e.g. from an interrupted append)
+    is overwritten.
+    """
+    with open(path_, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        header_length = f.tell()
+        if len(shape) != 1 or shape[0] < n_rows:
+            raise ValueError(f"{path_} doesn't match the dataset cache (shape {shape}, {n_rows} rows expected).")
+
+        values = np.ascontiguousarray(values, dtype=dtype)
+        f.seek(header_length + n_rows * dtype.itemsize)
+        f.write(values.tobytes())
+        f.truncate()
+
+        # New header, which must keep the same length
+        f.seek(0)
+        header = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False,
+                  'shape': (n_rows + len(values),)}
+        if version == (1, 0):
+            np.lib.format.write_array_header_1_0(f, header)
+        else:
+            np.lib.format.write_array_header_2_0(f, header)
+        if f.tell() != header_length:
+            raise ValueError(f"The header of {path_} can't grow in place.")
+
+
+def append_month(path_, listings, chunk_size=100_000, spatial_index=None):
+    """
+    Append a new month of cleaned listings to a dataset cache (see `load_data.build_dataset_cache`).
+
+    Only the new rows are written: each column file is extended in place, chunk by chunk.
+    Text columns get new categories at the end of their list, so existing codes don't
+    change. Neighbourhoods and communes never seen before get a new dummy column that only
+    stores the rows from this month on (earlier rows read as zeros), so history is not
+    rewritten. The month offsets in meta.json are updated, so later reads can start at any month.
+
+    :param path_: String, cache directory.
+    :param listings: DataFrame with the new listings (same columns as the cleaned CSV, with raw
+        'neighbourhood' and 'commune'), a path to a CSV with them, or an iterable of DataFrame chunks.
+    :param chunk_size: Integer, rows appended at a time when `listings` is a CSV path or a DataFrame.
+    :param spatial_index: SpatialIndex used to compute the `distance_to_*` columns from 'longitude'
+        and 'latitude' where the listings don't have them (see `spatial_features`).
+    :return: List of the months appended ('YYYY-MM').
+    """
+    with open(os.path.join(path_, 'meta.json')) as f:
+        meta = json.load(f)
+    offsets = month_offsets(path_, meta).tolist()
+    first_month = pd.Timestamp(meta['first_month'])
+    columns = {col_meta['name']: col_meta for col_meta in meta['columns']}
+
+    # Neighbourhoods and communes with a dummy column, and communes known without one (the
+    # category dropped by the dummy encoding)
+    known_communes = set(columns.get('commune', {}).get('categories', []))
+
+    if isinstance(listings, str):
+        chunks = pd.read_csv(listings, chunksize=chunk_size)
+    elif isinstance(listings, pd.DataFrame):
+        chunks = (listings.iloc[i:i + chunk_size] for i in range(0, len(listings), chunk_size))
+    else:
+        chunks = listings
+
+    n_rows = meta['n_rows']
+    appended_months = set()
+    for chunk in chunks:
+        chunk = chunk.loc[:, ~chunk.columns.str.startswith('Unnamed')]
+        if len(chunk) == 0:
+            continue
+
+        # Distances the new listings don't have yet, as 1.4.AddVariables.R computes them
+        if spatial_index is not None:
+            distances = spatial_index.distances(chunk['longitude'].to_numpy(), chunk['latitude'].to_numpy())
+            chunk = chunk.assign(**{col: chunk[col].fillna(pd.Series(values, index=chunk.index))
+                                    if col in chunk else values
+                                    for col, values in distances.items() if col in columns})
+
+        # Months as an int32 index; the data must stay sorted by month
+        months = pd.to_datetime(chunk['listing_month'])
+        chunk = chunk.assign(listing_month_idx=month_index(months, first_month)).drop(columns=['listing_month'])
+        chunk = chunk.sort_values(by=['listing_month_idx'], kind='stable')
+        last_month = meta['n_months'] - 1 if n_rows else -1
+        if chunk['listing_month_idx'].iloc[0] < last_month:
+            raise ValueError("Only months at or after the last month of the cache can be appended.")
+
+        # Location dummies of this chunk, with new columns for locations never seen before
+        dummies = {}
+        for nei in chunk['neighbourhood'].dropna().unique():
+            dummies[neighbourhood_column(nei)] = (chunk['neighbourhood'] == nei).to_numpy(np.uint8)
+        for commune in chunk['commune'].dropna().unique():
+            col = commune_column(commune)
+            if col in columns or commune not in known_communes:
+                dummies[col] = (chunk['commune'] == commune).to_numpy(np.uint8)
+        for col, values in dummies.items():
+            if col not in columns:
+                col_meta = {'name': col, 'file': f'{len(meta["columns"])}.npy', 'start_row': n_rows}
+                np.save(os.path.join(path_, col_meta['file']), np.zeros(0, dtype=np.uint8))
+                meta['columns'].append(col_meta)
+                columns[col] = col_meta
+
+        missing = [c for c in columns if c not in chunk and c not in dummies and not c.startswith(('nei_', 'commune_'))]
+        if missing:
+            raise ValueError(f"Columns missing from the new listings: {missing}")
+
+        # Append every column (zeros for the dummies of locations not in this chunk)
+        for name, col_meta in columns.items():
+            if name in dummies:
+                values = dummies[name]
+            elif name.startswith(('nei_', 'commune_')) and name not in chunk:
+                values = np.zeros(len(chunk), dtype=np.uint8)
+            else:
+                values = chunk[name]
+            if 'categories' in col_meta:
+                new_categories = [str(c) for c in pd.unique(values.dropna().astype(str))
+                                  if str(c) not in col_meta['categories']]
+                col_meta['categories'] += new_categories
+                values = pd.Categorical(values.astype(str).where(values.notna()),
+                                        categories=col_meta['categories']).codes
+            _append_npy(os.path.join(path_, col_meta['file']), np.asarray(values),
+                        n_rows - col_meta.get('start_row', 0))
+
+        # Month offsets: the months after the last one of the cache start where their first
+        # row (or, for months without rows, the next month's first row) is in this chunk
+        month_idx = chunk['listing_month_idx'].to_numpy()
+        new_n_months = max(meta['n_months'], int(month_idx.max()) + 1)
+        new_months = np.arange(meta['n_months'], new_n_months)
+        offsets = offsets[:-1] + (n_rows + np.searchsorted(month_idx, new_months)).tolist()
+        n_rows += len(chunk)
+        offsets.append(n_rows)
+        meta['n_months'] = new_n_months
+        meta['n_rows'] = n_rows
+        appended_months.update((first_month + pd.DateOffset(months=int(m))).strftime('%Y-%m')
+                               for m in np.unique(month_idx))
+
+    # Write the metadata last, so an interrupted append leaves the cache as it was
+    meta['month_offsets'] = offsets
+    meta['appended_months'] = sorted(set(meta.get('appended_months', [])) | appended_months)
+    tmp_path = os.path.join(path_, 'meta.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f, indent=1)
+    os.replace(tmp_path, os.path.join(path_, 'meta.json'))
+
+    return sorted(appended_months)
+
+
+def train_new_month(path_, month, DEP_VAR, INDEP_VARS, time_window_sizes, save_model_path, **kwargs):
+    """
+    Train only the models that predict `month` (one per window size), reading only the
+    rows of the months they need from the dataset cache.
+
+    :param path_: String, cache directory.
+    :param month: The new month ('YYYY-MM' or date).
+    :param kwargs: Any other argument of `estimate_xgb_multiwindow`.
+    :return: Long-format results of the new month (one row per window size).
+    """
+    month = pd.Timestamp(month)
+    first_month = month - pd.DateOffset(months=max(time_window_sizes))
+    df = read_dataset_cache(path_, columns=['listing_month'] + list(DEP_VAR) + list(INDEP_VARS),
+                            first_month=first_month)
+    df = df.loc[df['listing_month'] <= month]
+
+    # INDEP_VARS may include dummies of locations added after some of the rows
+    return estimate_xgb_multiwindow(df, DEP_VAR, INDEP_VARS, time_window_sizes=time_window_sizes,
+                                    save_model_path=save_model_path, test_months=[month], **kwargs)
@@ -0,0 +1,270 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+
+# Name of the cleaned dataset produced by the R scripts
+CSV_NAME = 'meli_clean_alquiler_2018_2022.csv'
+
+# Bump when the layout of the cache changes, so old caches are rebuilt
+CACHE_VERSION = 1
+
+
+def file_hash(path, chunk_size=1 << 22):
+    """Return the SHA-1 hash of a file, reading it in chunks."""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def neighbourhood_column(neighbourhood):
+    """Name of the dummy column of a neighbourhood (e.g. 'VILLA CRESPO' -> 'nei_villa_crespo')."""
+    return 'nei_' + neighbourhood.replace(' ', '_').lower()
+
+
+def commune_column(commune):
+    """Name of the dummy column of a commune (e.g. 'COMUNA 13' -> 'commune_13')."""
+    return commune.replace('COMUNA', 'commune').replace(' ', '_').lower()
+
+
+def encode_locations(df, neighbourhoods=None, communes=None):
+    """
+    Add the `nei_*` and `commune_*` one-hot columns as uint8.
+
+    Neighbourhoods get one column each. Communes drop the first category, as in
+    `pd.get_dummies(..., drop_first=True)`. If the category lists are not given they
+    are taken (sorted) from the data.
+
+    :param df: DataFrame with 'neighbourhood' and 'commune' columns.
+    :param neighbourhoods: List of neighbourhood names, in column order.
+    :param communes: List of commune names (as in the raw data, 'COMUNA X'), in column order.
+    """
+    if neighbourhoods is None:
+        neighbourhoods = sorted(df['neighbourhood'].dropna().unique())
+    if communes is None:
+        communes = sorted(df['commune'].dropna().unique(), key=commune_column)
+
+    nei_codes = pd.Categorical(df['neighbourhood'], categories=neighbourhoods).codes
+    commune_codes = pd.Categorical(df['commune'], categories=communes).codes
+
+    one_hot = {}
+    for i, nei in enumerate(neighbourhoods):
+        one_hot[neighbourhood_column(nei)] = (nei_codes == i).astype(np.uint8)
+    for i, commune in enumerate(communes[1:], start=1):
+        one_hot[commune_column(commune)] = (commune_codes == i).astype(np.uint8)
+
+    return df.join(pd.DataFrame(one_hot, index=df.index))
+
+
+def month_index(months, first_month):
+    """Number of months since `first_month`, as int32."""
+    months = pd.DatetimeIndex(months)
+    first_month = pd.Timestamp(first_month)
+    return ((months.year - first_month.year) * 12 + (months.month - first_month.month)).astype(np.int32)
+
+
+def _cache_path(cache_dir, csv_path, source_hash):
+    stem = os.path.splitext(os.path.basename(csv_path))[0]
+    return os.path.join(cache_dir, f'{stem}_{source_hash[:16]}')
+
+
+def _source_hash(csv_path, cache_dir):
+    """
+    Hash of the source file. The hash is remembered together with the file size and
+    modification time, so an unchanged file is not read again.
+    """
+    stat = os.stat(csv_path)
+    stat_key = f'{os.path.abspath(csv_path)}|{stat.st_size}|{stat.st_mtime_ns}'
+    index_path = os.path.join(cache_dir, 'hash_index.json')
+
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+    if stat_key in index:
+        return index[stat_key]
+
+    source_hash = file_hash(csv_path)
+    index[stat_key] = source_hash
+    with open(index_path, 'w') as f:
+        json.dump(index, f, indent=1)
+    return source_hash
+
+
+def build_dataset_cache(csv_path, cache_dir, source_hash=None):
+    """
+    Read the cleaned CSV once and write it as one .npy file per column.
+
+    The data is sorted by month. The location dummies are stored as uint8, text columns
+    as integer codes plus their categories, and `listing_month` as an int32 month index
+    ('listing_month_idx') together with the list of months.
+
+    :param csv_path: String, path to the cleaned CSV.
+    :param cache_dir: String, directory where the cache is written.
+    :param source_hash: String, hash of the CSV (computed if not given).
+    :return: String, path of the cache directory.
+    """
+    if source_hash is None:
+        source_hash = file_hash(csv_path)
+    path_ = _cache_path(cache_dir, csv_path, source_hash)
+
+    df = pd.read_csv(csv_path)
+    df = df.loc[:, ~df.columns.str.startswith('Unnamed')]
+
+    # Months as an int32 index, sorted
+    df['listing_month'] = pd.to_datetime(df['listing_month'])
+    df = df.sort_values(by=['listing_month'], kind='stable').reset_index(drop=True)
+    first_month = df['listing_month'].min().to_period('M').to_timestamp()
+    df['listing_month_idx'] = month_index(df['listing_month'], first_month)
+    n_months = int(df['listing_month_idx'].max()) + 1
+    df = df.drop(columns=['listing_month'])
+
+    # Location dummies
+    df = encode_locations(df)
+
+    # Write every column to a temporary directory, then move it into place
+    tmp_path = path_ + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    columns = []
+    for i, col in enumerate(df.columns):
+        values = df[col]
+        col_meta = {'name': col, 'file': f'{i}.npy'}
+        if values.dtype == object or isinstance(values.dtype, pd.StringDtype):
+            cat = pd.Categorical(values)
+            col_meta['categories'] = [str(c) for c in cat.categories]
+            values = cat.codes
+        np.save(os.path.join(tmp_path, col_meta['file']), np.ascontiguousarray(values))
+        columns.append(col_meta)
+
+    meta = {
+        'version': CACHE_VERSION,
+        'source': os.path.abspath(csv_path),
+        'source_hash': source_hash,
+        'n_rows': len(df),
+        'first_month': first_month.strftime('%Y-%m'),
+        'n_months': n_months,
+        'month_offsets': np.searchsorted(df['listing_month_idx'].values, np.arange(n_months + 1)).tolist(),
+        'columns': columns,
+    }
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=1)
+
+    if os.path.exists(path_):
+        shutil.rmtree(path_)
+    os.replace(tmp_path, path_)
+
+    return path_
+
+
+def month_offsets(path_, meta=None):
+    """
+    Row where each month starts in a dataset cache (plus the number of rows), read from
+    meta.json, or computed from the month index column for caches that don't store it.
+    """
+    if meta is None:
+        with open(os.path.join(path_, 'meta.json')) as f:
+            meta = json.load(f)
+    if 'month_offsets' in meta:
+        return np.asarray(meta['month_offsets'], dtype=np.int64)
+    col_meta = next(c for c in meta['columns'] if c['name'] == 'listing_month_idx')
+    idx = np.load(os.path.join(path_, col_meta['file']), mmap_mode='r')
+    return np.searchsorted(idx, np.arange(meta['n_months'] + 1), side='left').astype(np.int64)
+
+
+def read_dataset_cache(path_, columns=None, first_month=None):
+    """
+    Open a dataset cache as a DataFrame whose numeric columns are read-only memory maps.
+
+    :param path_: String, cache directory written by `build_dataset_cache`.
+    :param columns: List of columns to load (all if None). 'listing_month' can always be requested.
+    :param first_month: Only load the rows of this month ('YYYY-MM' or date) and later ones (still memory-mapped).
+    """
+    with open(os.path.join(path_, 'meta.json')) as f:
+        meta = json.load(f)
+
+    # First row to load: where `first_month` starts
+    start = 0
+    if first_month is not None:
+        month_pos = int(month_index([first_month], pd.Timestamp(meta['first_month']))[0])
+        offsets = month_offsets(path_, meta)
+        start = int(offsets[min(max(month_pos, 0), meta['n_months'])])
+    n_rows = meta['n_rows'] - start
+
+    data = {}
+    for col_meta in meta['columns']:
+        name = col_meta['name']
+        if columns is not None and name not in columns and not (
+                name == 'listing_month_idx' and 'listing_month' in columns):
+            continue
+        values = np.load(os.path.join(path_, col_meta['file']), mmap_mode='r')
+
+        # Columns added by `ingest.append_month` only store the rows from `start_row` on;
+        # the rows before are zeros (a neighbourhood or commune that didn't exist yet)
+        start_row = col_meta.get('start_row', 0)
+        if start_row > start:
+            values = np.concatenate([np.zeros(start_row - start, dtype=values.dtype), values[:meta['n_rows'] - start_row]])
+        else:
+            values = values[start - start_row:meta['n_rows'] - start_row]
+
+        if 'categories' in col_meta:
+            values = pd.Categorical.from_codes(values, categories=col_meta['categories'])
+        data[name] = values
+
+    df = pd.DataFrame(data, copy=False)
+    df.index = pd.RangeIndex(start, start + n_rows)
+
+    # Rebuild the datetime month from the int32 index (the functions downstream use dates)
+    if columns is None or 'listing_month' in columns:
+        months = pd.date_range(meta['first_month'], periods=meta['n_months'], freq='MS').values
+        df.insert(0, 'listing_month', months[df['listing_month_idx'].values])
+
+    return df
+
+
+def load_dataset(csv_path, cache_dir=None, columns=None, rebuild=False):
+    """
+    Load the cleaned dataset with the location dummies already encoded.
+
+    The first call converts the CSV into a columnar cache keyed on the file's hash;
+    later calls memory-map that cache instead of parsing the CSV again.
+
+    :param csv_path: String, path to the cleaned CSV.
+    :param cache_dir: String, directory for the cache (defaults to a 'cache' folder next to the CSV).
+    Text columns come back as object (string) columns and communes are named 'commune X',
+    as the notebook's data-loading cell left them (the cache itself keeps categorical codes
+    and the raw 'COMUNA X' names).
+
+    :param columns: List of columns to load (all if None).
+    :param rebuild: Boolean, if True, rebuilds the cache even if it exists.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(csv_path)), 'cache')
+    os.makedirs(cache_dir, exist_ok=True)
+
+    source_hash = _source_hash(csv_path, cache_dir)
+    path_ = _cache_path(cache_dir, csv_path, source_hash)
+
+    if rebuild or not os.path.exists(os.path.join(path_, 'meta.json')):
+        path_ = build_dataset_cache(csv_path, cache_dir, source_hash=source_hash)
+    else:
+        with open(os.path.join(path_, 'meta.json')) as f:
+            if json.load(f).get('version') != CACHE_VERSION:
+                path_ = build_dataset_cache(csv_path, cache_dir, source_hash=source_hash)
+
+    df = read_dataset_cache(path_, columns=columns)
+
+    # Same values and dtypes as the notebook's original cell
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(object)
+    if 'commune' in df:
+        df['commune'] = df['commune'].str.replace('COMUNA', 'commune', regex=False)
+
+    return df
@@ -0,0 +1,195 @@
+import numpy as np
+import pandas as pd
+
+# Error metrics computed by `grouped_metrics`, besides quantile (pinball) losses named
+# 'pinball_<quantile>' (e.g. 'pinball_0.9')
+ERROR_METRICS = ['rmse', 'mae', 'mape', 'mdae']
+
+# Metrics that are the mean of a loss of each row, as functions of (prediction, actual).
+# MAPE is relative to the prediction, as the sklearn metrics are called with the prediction
+# first in estimate_xgb and run_ensemble.
+ROW_LOSSES = {
+    'rmse': lambda y_pred, y_true: (y_pred - y_true) ** 2,
+    'mae': lambda y_pred, y_true: np.abs(y_pred - y_true),
+    'mape': lambda y_pred, y_true: np.abs(y_pred - y_true) / np.maximum(np.abs(y_pred), np.finfo(np.float64).eps),
+}
+
+# Transformation applied to the mean of the row losses
+MEAN_TRANSFORMS = {
+    'rmse': np.sqrt,
+}
+
+
+def check_metrics(error_metric):
+    for em in error_metric:
+        if em not in ERROR_METRICS and not em.startswith('pinball_'):
+            raise ValueError(f"Invalid error metric {em}. Please choose from {ERROR_METRICS} or 'pinball_<quantile>'.")
+
+
+def pinball_loss(quantile):
+    """Row loss of a quantile prediction: max(q * (y - p), (q - 1) * (y - p))."""
+    def loss(y_pred, y_true):
+        diff = y_true - y_pred
+        return np.maximum(quantile * diff, (quantile - 1) * diff)
+    return loss
+
+
+def group_codes(*keys):
+    """
+    Combine one or more keys of each row (e.g. month and neighbourhood) into a single
+    integer group code. Returns the codes and a DataFrame with the keys of each group.
+    """
+    keys_df = pd.DataFrame({f'key_{i}': np.asarray(key) for i, key in enumerate(keys)})
+    codes, uniques = pd.MultiIndex.from_frame(keys_df).factorize(sort=True)
+    return codes, uniques.to_frame(index=False)
+
+
+def grouped_metrics(predictions, actuals, groups, error_metric=['rmse', 'mae', 'mape', 'mdae'], n_groups=None):
+    """
+    Error metrics of one or several models in every group (e.g. month) at once.
+
+    The rows are sorted by group once, and every metric is a grouped NumPy reduction over
+    all models and groups (sums with `np.add.reduceat`, medians by sorting the errors
+    within each group), instead of one call per month, model and metric.
+
+    :param predictions: Array (rows,) or (models x rows) with the predictions.
+    :param actuals: Array (rows,) with the actual values.
+    :param groups: Integer array (rows,) with the group of each row, from 0 to n_groups - 1.
+    :param error_metric: List of metrics: 'rmse', 'mae', 'mape', 'mdae' or 'pinball_<quantile>'.
+    :param n_groups: Integer, number of groups (the largest group code + 1 if None).
+    :return: Dictionary with an array (groups,) or (models x groups) for each metric, NaN for empty groups.
+    """
+    check_metrics(error_metric)
+    predictions = np.asarray(predictions, dtype=np.float64)
+    single_model = predictions.ndim == 1
+    predictions = np.atleast_2d(predictions)
+    actuals = np.asarray(actuals, dtype=np.float64).ravel()
+    groups = np.asarray(groups).ravel()
+    if n_groups is None:
+        n_groups = int(groups.max()) + 1 if len(groups) else 0
+
+    # Sort the rows by group (once), and find where each non-empty group starts
+    if len(groups) and np.any(groups[1:] < groups[:-1]):
+        order = np.argsort(groups, kind='stable')
+        predictions, actuals, groups = predictions[:, order], actuals[order], groups[order]
+    counts = np.bincount(groups, minlength=n_groups)
+    present = np.flatnonzero(counts)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[present]
+
+    metrics = {}
+    for em in error_metric:
+        values = np.full((len(predictions), n_groups), np.nan)
+        if len(present):
+            if em == 'mdae':
+                values[:, present] = _grouped_median(np.abs(predictions - actuals), groups, starts, counts[present])
+            else:
+                loss = pinball_loss(float(em[len('pinball_'):])) if em.startswith('pinball_') else ROW_LOSSES[em]
+                sums = np.add.reduceat(loss(predictions, actuals), starts, axis=1)
+                values[:, present] = MEAN_TRANSFORMS.get(em, lambda x: x)(sums / counts[present])
+        metrics[em] = values[0] if single_model else values
+    return metrics
+
+
+def _grouped_median(errors, groups, starts, counts):
+    # Sort the errors of each model within each group (rows are already sorted by group)
+    medians = np.empty((len(errors), len(starts)))
+    lower = starts + (counts - 1) // 2
+    upper = starts + counts // 2
+    for i, model_errors in enumerate(errors):
+        sorted_errors = model_errors[np.lexsort((model_errors, groups))]
+        medians[i] = (sorted_errors[lower] + sorted_errors[upper]) / 2
+    return medians
+
+
+def metrics_frame(predictions, actuals, keys, error_metric=['rmse', 'mae', 'mape', 'mdae'], key_names=None,
+                  model_names=None):
+    """
+    Error metrics by group in a long DataFrame, e.g. by month and neighbourhood:
+    `metrics_frame(y_pred, y_test, [months, neighbourhoods], key_names=['month', 'neighbourhood'])`.
+
+    :param predictions: Array (rows,) or (models x rows) with the predictions.
+    :param actuals: Array (rows,) with the actual values.
+    :param keys: List of arrays (rows,) with the keys that define the groups.
+    :param key_names: List of column names of the keys.
+    :param model_names: List of names of the models (one row per model and group).
+    :return: DataFrame with the keys (and model) and a column per metric.
+    """
+    codes, groups_df = group_codes(*keys)
+    if key_names is not None:
+        groups_df.columns = key_names
+    metrics = grouped_metrics(predictions, actuals, codes, error_metric, n_groups=len(groups_df))
+
+    if np.ndim(predictions) == 1:
+        return pd.concat([groups_df, pd.DataFrame(metrics)], axis=1)
+
+    if model_names is None:
+        model_names = list(range(len(predictions)))
+    frames = []
+    for i, model_name in enumerate(model_names):
+        frame = groups_df.copy()
+        frame.insert(0, 'model', model_name)
+        for em in error_metric:
+            frame[em] = metrics[em][i]
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+
+class MetricsCollector:
+    """
+    Collect the predictions of each month of a backtest and compute all the error metrics
+    at the end, with one grouped reduction, instead of one sklearn call and one
+    `results.loc[results['month'] == month, ...]` write per month and metric.
+
+    Other per-month values (best parameters, durations...) are recorded in a dictionary
+    and written as whole columns.
+
+    :param n_rows: Integer, number of rows of the results data frame (one per month).
+    """
+
+    def __init__(self, n_rows):
+        self.n_rows = n_rows
+        self.records = {}
+        self._predictions = []
+        self._actuals = []
+        self._groups = []
+
+    def record(self, row, **values):
+        """Record values of the results row `row` (position in the results data frame)."""
+        self.records.setdefault(row, {}).update(values)
+
+    def add_predictions(self, row, y_pred, y_true):
+        """
+        Add the predictions and actual values of the results row `row`. `y_pred` can also be
+        an array (metrics x rows) with a different prediction for each error metric.
+        """
+        y_true = np.asarray(y_true).ravel()
+        self._predictions.append(np.asarray(y_pred).reshape(-1, len(y_true)))
+        self._actuals.append(y_true)
+        self._groups.append(np.full(len(y_true), row))
+
+    def write(self, results, error_metric):
+        """Write the error metrics and the recorded values into `results` (column by column)."""
+        if self._predictions:
+            predictions = np.concatenate(self._predictions, axis=1)
+            groups = np.concatenate(self._groups)
+            metrics = grouped_metrics(predictions, np.concatenate(self._actuals), groups,
+                                      error_metric, n_groups=self.n_rows)
+            rows = np.unique(groups)
+            for i, em in enumerate(error_metric):
+                # One prediction for every metric, or a prediction per metric
+                values = metrics[em][0] if len(predictions) == 1 else metrics[em][i]
+                column = results[em].to_numpy(dtype=np.float64, copy=True)
+                column[rows] = values[rows]
+                results[em] = column
+
+        columns = {}
+        for row, values in self.records.items():
+            for key, value in values.items():
+                columns.setdefault(key, {})[row] = value
+        for key, values in columns.items():
+            column = results[key].to_numpy(copy=True) if key in results else np.full(self.n_rows, np.nan)
+            if any(isinstance(value, str) for value in values.values()):
+                column = column.astype(object)
+            column[list(values)] = list(values.values())
+            results[key] = pd.Series(column, index=results.index, dtype=column.dtype)
+        return results
@@ -0,0 +1,200 @@
+import os
+import json
+import joblib
+import threading
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+from collections import OrderedDict, namedtuple
+
+# Key that identifies a saved model
+ModelKey = namedtuple('ModelKey', ['window_size', 'month', 'hyp_tune', 'sample_df', 'cv_strategy'])
+
+# Default maximum number of deserialized models kept in memory
+DEFAULT_CACHE_SIZE = 512
+
+# In-process LRU cache shared by every ModelStore, keyed on the absolute model path,
+# so that a model is deserialized at most once per process no matter which store
+# (or which function) asks for it
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_cache_size = DEFAULT_CACHE_SIZE
+
+
+def set_cache_size(max_models):
+    """
+    Change the maximum number of models kept in the in-process cache.
+
+    :param max_models: Integer, number of models to keep (least recently used are evicted first).
+    """
+    global _cache_size
+    with _cache_lock:
+        _cache_size = max_models
+        while len(_cache) > _cache_size:
+            _cache.popitem(last=False)
+
+
+def clear_cache():
+    """Drop every model from the in-process cache."""
+    with _cache_lock:
+        _cache.clear()
+
+
+def _cache_get(path):
+    with _cache_lock:
+        model = _cache.get(path)
+        if model is not None:
+            _cache.move_to_end(path)
+        return model
+
+
+def _cache_put(path, model):
+    with _cache_lock:
+        _cache[path] = model
+        _cache.move_to_end(path)
+        while len(_cache) > _cache_size:
+            _cache.popitem(last=False)
+
+
+def parse_month(month):
+    """Return a month (Timestamp, datetime64 or string) as a 'YYYY-MM' string."""
+    if isinstance(month, str):
+        return month[:7]
+    if isinstance(month, pd.Timestamp):
+        return month.strftime('%Y-%m')
+    return np.datetime_as_string(month, unit='M')
+
+
+def save_model_file(model, path):
+    """
+    Save a fitted XGBRegressor in native XGBoost format. The scikit-learn parameters are
+    kept as a booster attribute, so `get_params` works on the loaded model.
+    """
+    params = {k: v for k, v in model.get_params().items()
+              if isinstance(v, (int, float, str, bool)) and k != 'missing'}
+    model.get_booster().set_attr(sklearn_params=json.dumps(params))
+    model.save_model(path)
+
+
+def load_model_file(path):
+    """
+    Load a single model from disk, either native XGBoost (.ubj/.json) or a legacy joblib pickle.
+    """
+    if path.endswith('.pkl'):
+        return joblib.load(path)
+    model = xgb.XGBRegressor()
+    model.load_model(path)
+    params = model.get_booster().attr('sklearn_params')
+    if params is not None:
+        model.set_params(**json.loads(params))
+    return model
+
+
+class ModelStore:
+    """
+    Registry of the models saved by `estimate_xgb` and read by `run_ensemble`.
+
+    Models are stored in native XGBoost UBJSON format under
+    `root_path/<hyp_tune>/[<cv_strategy>_]winsize<ws>_sample<sample_df>_<YYYY-MM>.ubj`.
+    Models are only read from disk the first time they are requested, and kept in
+    the in-process LRU cache afterwards. Legacy `.pkl` files with the same name are
+    read when no `.ubj` file exists.
+
+    :param root_path: String, the directory that holds the models.
+    """
+
+    def __init__(self, root_path):
+        self.root_path = root_path
+
+    def key(self, window_size, month, hyp_tune=None, sample_df=False, cv_strategy=None):
+        return ModelKey(window_size, parse_month(month), hyp_tune, sample_df, cv_strategy)
+
+    def path(self, key, extension='.ubj'):
+        path_end_ = ['winsize' + str(key.window_size),
+                     'sample' + str(key.sample_df),
+                     key.month]
+        if key.cv_strategy:
+            path_end_.insert(0, key.cv_strategy)
+        path_end_ = ('_').join(path_end_) + extension
+
+        if key.hyp_tune:
+            return os.path.abspath(os.path.join(self.root_path, key.hyp_tune, path_end_))
+        return os.path.abspath(os.path.join(self.root_path, path_end_))
+
+    def save(self, model, key):
+        """Save a fitted model and keep it in the cache. Returns the path written."""
+        path_ = self.path(key)
+        os.makedirs(os.path.dirname(path_), exist_ok=True)
+        save_model_file(model, path_)
+        _cache_put(path_, model)
+        return path_
+
+    def exists(self, key):
+        return os.path.exists(self.path(key)) or os.path.exists(self.path(key, '.pkl'))
+
+    def load(self, key):
+        """Return the model for a key, reading it from disk only if it is not cached."""
+        path_ = self.path(key)
+        model = _cache_get(path_)
+        if model is not None:
+            return model
+
+        # Fall back on a legacy pickle
+        if not os.path.exists(path_) and os.path.exists(self.path(key, '.pkl')):
+            model = load_model_file(self.path(key, '.pkl'))
+        else:
+            model = load_model_file(path_)
+        _cache_put(path_, model)
+        return model
+
+    def months(self, window_size, hyp_tune=None, sample_df=False, cv_strategy=None):
+        """Sorted list of the months ('YYYY-MM') with a saved model for a window size."""
+        # File names are '<prefix><YYYY-MM>.ubj'
+        directory, prefix = os.path.split(self.path(self.key(window_size, '0000-00', hyp_tune, sample_df, cv_strategy)))
+        prefix = prefix[:-len('0000-00.ubj')]
+        if not os.path.isdir(directory):
+            return []
+        months = set()
+        for file_name in os.listdir(directory):
+            stem, extension = os.path.splitext(file_name)
+            if file_name.startswith(prefix) and extension in ['.ubj', '.pkl']:
+                months.add(stem[len(prefix):])
+        return sorted(months)
+
+    def latest_month(self, window_sizes, hyp_tune=None, sample_df=False, cv_strategy=None):
+        """Latest month with a saved model for every window size (None if there is none)."""
+        months = None
+        for ws in window_sizes:
+            ws_months = set(self.months(ws, hyp_tune, sample_df, cv_strategy))
+            months = ws_months if months is None else months & ws_months
+        return max(months) if months else None
+
+    def load_ensemble(self, window_sizes, month, hyp_tune=None, sample_df=False, cv_strategy=None):
+        """Return the list of models for one month, one per window size (in the given order)."""
+        return [self.load(self.key(ws, month, hyp_tune, sample_df, cv_strategy))
+                for ws in window_sizes]
+
+    def save_ensemble_manifest(self, name, members):
+        """
+        Write a small JSON file listing the member model paths of each month's ensemble.
+
+        :param name: String, file name (without extension).
+        :param members: Dictionary mapping 'YYYY-MM' to a list of ModelKey.
+        """
+        manifest = {month: [self.path(key) for key in keys] for month, keys in members.items()}
+        path_ = os.path.join(self.root_path, name + '.json')
+        with open(path_, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        return path_
+
+
+# One store per directory and process
+_stores = {}
+
+
+def get_model_store(root_path):
+    """Return the shared ModelStore for a directory."""
+    root_path = os.path.abspath(root_path)
+    if root_path not in _stores:
+        _stores[root_path] = ModelStore(root_path)
+    return _stores[root_path]
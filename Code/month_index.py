@@ -0,0 +1,204 @@
+import hashlib
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory
+from scipy import sparse
+from feature_layout import sparse_matrix
+
+# Arrays of a MonthIndex that are placed in shared memory
+SHARED_ARRAYS = ['X', 'y', 'row_months']
+
+
+class MonthIndex:
+    """
+    Month-partitioned view of a data frame for walk-forward estimation.
+
+    The features are copied once into a single C-contiguous float32 matrix, with rows
+    sorted by month, and the row offset where each month starts is precomputed. Training
+    and test windows are then plain row slices of that matrix (views, no copy), so taking
+    a window costs O(1) instead of a boolean scan of the whole data frame.
+
+    :param df: DataFrame with the data (sorted by `month_col` if it is not already).
+    :param INDEP_VARS: List of feature columns.
+    :param DEP_VAR: List with the target column.
+    :param month_col: String, name of the month column.
+    :param dtype: NumPy dtype of the feature matrix.
+    :param sparse_columns: List of columns (e.g. the location dummies) stored sparsely: the
+        feature matrix is then a CSR matrix, where only these columns skip their zeros.
+    """
+
+    def __init__(self, df, INDEP_VARS, DEP_VAR, month_col='listing_month', dtype=np.float32,
+                 sparse_columns=None):
+
+        # Sort rows by month (stable, so the order within a month is kept)
+        if not df[month_col].is_monotonic_increasing:
+            df = df.sort_values(by=[month_col], kind='stable')
+
+        self.INDEP_VARS = list(INDEP_VARS)
+        self.DEP_VAR = list(DEP_VAR)
+
+        # Single feature matrix, target and month of each row
+        if sparse_columns:
+            self.X = sparse_matrix(df, self.INDEP_VARS, sparse_columns, dtype=dtype)
+        else:
+            self.X = np.ascontiguousarray(df[self.INDEP_VARS].to_numpy(dtype=dtype))
+        self.y = np.ascontiguousarray(df[self.DEP_VAR].to_numpy(dtype=np.float64)).ravel()
+        self.row_months = df[month_col].to_numpy(dtype='datetime64[ns]')
+
+        # Unique months and the row where each of them starts (plus the end of the data)
+        self.months = np.unique(self.row_months)
+        self.offsets = np.searchsorted(self.row_months, self.months, side='left')
+        self.offsets = np.append(self.offsets, len(self.row_months))
+
+    def share(self):
+        """
+        Move the feature matrix, target and row months into shared memory.
+
+        The index itself keeps working on the shared copies (the private ones are
+        released), so the data exists only once. A CSR feature matrix is shared as its
+        data, indices and indptr arrays. Returns a small picklable spec that worker
+        processes pass to `MonthIndex.attach`. Call `unlink` when done.
+        """
+        spec = {
+            'INDEP_VARS': self.INDEP_VARS,
+            'DEP_VAR': self.DEP_VAR,
+            'months': self.months,
+            'offsets': self.offsets,
+            'X_shape': self.X.shape if sparse.issparse(self.X) else None,
+            'arrays': {},
+        }
+        arrays = {name: getattr(self, name) for name in SHARED_ARRAYS}
+        if sparse.issparse(self.X):
+            X = arrays.pop('X')
+            arrays.update({'X_data': X.data, 'X_indices': X.indices, 'X_indptr': X.indptr})
+        self._shm = []
+        shared_arrays = {}
+        for name, arr in arrays.items():
+            shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+            shared = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+            shared[...] = arr
+            shared_arrays[name] = shared
+            self._shm.append(shm)
+            spec['arrays'][name] = (shm.name, arr.shape, arr.dtype.str)
+        self._set_arrays(shared_arrays, spec['X_shape'])
+        return spec
+
+    def _set_arrays(self, arrays, X_shape=None):
+        # Use the (shared) arrays, rebuilding the CSR feature matrix around its three arrays
+        if X_shape is not None:
+            arrays = dict(arrays)
+            arrays['X'] = sparse.csr_matrix((arrays.pop('X_data'), arrays.pop('X_indices'), arrays.pop('X_indptr')),
+                                            shape=X_shape, copy=False)
+        for name, arr in arrays.items():
+            setattr(self, name, arr)
+
+    @classmethod
+    def attach(cls, spec):
+        """Build a MonthIndex on top of the shared memory described by `spec` (no copy)."""
+        self = cls.__new__(cls)
+        self.INDEP_VARS = spec['INDEP_VARS']
+        self.DEP_VAR = spec['DEP_VAR']
+        self.months = spec['months']
+        self.offsets = spec['offsets']
+        self._shm = []
+        shared_arrays = {}
+        for name, (shm_name, shape, dtype) in spec['arrays'].items():
+            try:
+                # Python >= 3.13: the creating process is in charge of the cleanup
+                shm = shared_memory.SharedMemory(name=shm_name, track=False)
+            except TypeError:
+                shm = shared_memory.SharedMemory(name=shm_name)
+            shared_arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+            self._shm.append(shm)
+        self._set_arrays(shared_arrays, spec.get('X_shape'))
+        return self
+
+    def close(self):
+        """Detach from the shared memory (the arrays can't be used afterwards)."""
+        for name in SHARED_ARRAYS:
+            setattr(self, name, None)
+        for shm in getattr(self, '_shm', []):
+            shm.close()
+        self._shm = []
+
+    def unlink(self):
+        """Detach from and free the shared memory. Only the process that called `share` should do this."""
+        shms = getattr(self, '_shm', [])
+        self.close()
+        for shm in shms:
+            shm.unlink()
+
+    def month_hashes(self):
+        """
+        Hash of each month's features, target and date (computed once), so that cached
+        results can be keyed on the content of the months they use rather than on the whole
+        data: appending a month, or moving the last month of an experiment, leaves the
+        hashes of the other months unchanged.
+        """
+        if getattr(self, '_month_hashes', None) is None:
+            self._month_hashes = []
+            for pos, month in enumerate(self.months):
+                rows = slice(self.offsets[pos], self.offsets[pos + 1])
+                h = hashlib.sha1()
+                h.update(repr(self.INDEP_VARS).encode())
+                h.update(np.datetime_as_string(month, unit='M').encode())
+                if sparse.issparse(self.X):
+                    X = self.X[rows]
+                    arrays = [X.data, X.indices, X.indptr - X.indptr[0]]
+                else:
+                    arrays = [self.X[rows]]
+                for arr in arrays + [self.y[rows]]:
+                    h.update(np.ascontiguousarray(arr).view(np.uint8))
+                self._month_hashes.append(h.hexdigest())
+        return self._month_hashes
+
+    def window_months(self, rows):
+        """
+        Months of a slice of rows that starts and ends at month boundaries (e.g. a training
+        window): the row where each of them starts relative to the slice (plus the end of the
+        slice), and their hashes.
+        """
+        first = int(np.searchsorted(self.offsets, rows.start, side='left'))
+        last = int(np.searchsorted(self.offsets, rows.stop, side='left'))
+        return self.offsets[first:last + 1] - rows.start, self.month_hashes()[first:last]
+
+    def __len__(self):
+        return len(self.months)
+
+    def _position(self, month):
+        # Position of the first month >= `month`
+        month = np.datetime64(pd.Timestamp(month), 'ns')
+        return np.searchsorted(self.months, month, side='left')
+
+    def rows(self, first_month, end_month):
+        """Slice of the rows with `first_month <= listing_month < end_month`."""
+        return slice(self.offsets[self._position(first_month)],
+                     self.offsets[self._position(end_month)])
+
+    def month_rows(self, month):
+        """Slice of the rows of a single month (empty if the month has no rows)."""
+        pos = self._position(month)
+        if pos < len(self.months) and self.months[pos] == np.datetime64(pd.Timestamp(month), 'ns'):
+            return slice(self.offsets[pos], self.offsets[pos + 1])
+        return slice(self.offsets[pos], self.offsets[pos])
+
+    def train(self, first_month, month):
+        """Training window: features and target of the months in [first_month, month)."""
+        rows = self.rows(first_month, month)
+        return self.X[rows], self.y[rows]
+
+    def test(self, month):
+        """Test sample: features and target of a single month."""
+        rows = self.month_rows(month)
+        return self.X[rows], self.y[rows]
+
+    def month_abs_diff(self, rows):
+        """
+        Months (days / 30, rounded) between each row and the first month of the slice,
+        used to build sample weights.
+        """
+        row_months = self.row_months[rows]
+        if len(row_months) == 0:
+            return np.zeros(0)
+        days = (row_months - row_months[0]).astype('timedelta64[D]').astype(np.float64)
+        return np.round(days / 30)
@@ -0,0 +1,83 @@
+import numpy as np
+from collections import deque
+from batch_inference import ensemble_weights
+from metrics import grouped_metrics
+
+# How the errors of past months are combined
+TRACKERS = ['window', 'ewm']
+
+
+def member_errors(member_predictions, y_true, error_metric):
+    """
+    Error of every member in one month, for every metric: an array (metrics x members).
+
+    The metrics are computed as in `estimate_xgb` (see `metrics.grouped_metrics`).
+
+    :param member_predictions: Array (members x rows) with the predictions of each member.
+    :param y_true: Array with the actual values of the month.
+    :param error_metric: List of metrics ('rmse', 'mae', 'mape', 'mdae', 'pinball_<quantile>').
+    """
+    metrics = grouped_metrics(member_predictions, y_true, np.zeros(len(np.ravel(y_true)), dtype=np.int64),
+                              error_metric, n_groups=1)
+    return np.vstack([metrics[em][:, 0] for em in error_metric])
+
+
+class ErrorTracker:
+    """
+    Running error of each member of an ensemble, updated as each month's actual prices
+    arrive, from which the ensemble weights of the next month are computed.
+
+    With `tracker='window'` the error is the mean over the last `window` months (a running
+    sum plus a queue of past months); with `tracker='ewm'` it is an exponentially weighted
+    mean, error = (1 - alpha) * error + alpha * new error. Either way an update and a set of
+    weights cost O(members) per metric.
+
+    `tracker='window'` with `window=1` uses last month's errors only, as `run_ensemble` does
+    with the error metrics saved by `estimate_xgb`.
+
+    :param n_members: Integer, number of members of the ensemble.
+    :param error_metric: List of metrics tracked.
+    :param tracker: String, 'window' or 'ewm'.
+    :param window: Integer, months averaged by the window tracker.
+    :param alpha: Float in (0, 1], weight of the newest month in the ewm tracker.
+    """
+
+    def __init__(self, n_members, error_metric, tracker='window', window=1, alpha=0.5):
+        if tracker not in TRACKERS:
+            raise ValueError(f"Invalid tracker. Please choose from {TRACKERS}.")
+        self.n_members = n_members
+        self.error_metric = list(error_metric)
+        self.tracker = tracker
+        self.window = window
+        self.alpha = alpha
+
+        self.n_updates = 0
+        self.errors = np.zeros((len(self.error_metric), n_members))
+        self._sum = np.zeros_like(self.errors)
+        self._history = deque()
+
+    def update(self, month_errors):
+        """Add the errors (metrics x members) of a new month."""
+        month_errors = np.asarray(month_errors, dtype=np.float64)
+        if self.tracker == 'window':
+            self._history.append(month_errors)
+            self._sum += month_errors
+            if len(self._history) > self.window:
+                self._sum -= self._history.popleft()
+            self.errors = self._sum / len(self._history)
+        else:
+            if self.n_updates == 0:
+                self.errors = month_errors.copy()
+            else:
+                self.errors = (1 - self.alpha) * self.errors + self.alpha * month_errors
+        self.n_updates += 1
+
+    def update_from_predictions(self, member_predictions, y_true):
+        """Compute the errors of a new month from the members' predictions and add them."""
+        self.update(member_errors(member_predictions, y_true, self.error_metric))
+
+    def weights(self, weighting='inverse_error', temperature=1.0):
+        """Weights (metrics x members) of the next month, from the errors tracked so far."""
+        if self.n_updates == 0:
+            raise ValueError("No errors tracked yet: update the tracker with at least one month.")
+        return ensemble_weights(self.errors, weighting=weighting, temperature=temperature)
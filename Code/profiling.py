@@ -0,0 +1,112 @@
+import os
+import time
+import cProfile
+import tracemalloc
+import pandas as pd
+from model_store import parse_month
+
+
+class StageProfiler:
+    """
+    Per-month, per-stage timings of a backtest loop.
+
+    The loop calls `start_month` at the top of each month and `lap(stage)` at the end of
+    each stage: the time since the previous lap (or the start of the month) is attributed
+    to that stage. Laps outside a month (e.g. the metrics computed for all months at the
+    end) are recorded with no month.
+
+    :param trace_memory: Boolean, also record the peak traced memory of each stage (tracemalloc).
+        Tracing slows down allocations, so timings with it are only comparable with each other.
+    :param cprofile_dir: String, directory where a cProfile of each month is saved as
+        `<YYYY-MM>.prof` (no cProfile if None).
+    """
+
+    enabled = True
+
+    def __init__(self, trace_memory=False, cprofile_dir=None):
+        self.trace_memory = trace_memory
+        self.cprofile_dir = cprofile_dir
+        self.records = []
+        self._month = None
+        self._last = time.perf_counter()
+        self._profile = None
+        self._started_tracing = False
+
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        if cprofile_dir is not None:
+            os.makedirs(cprofile_dir, exist_ok=True)
+
+    def start_month(self, month):
+        self._month = month
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        if self.cprofile_dir is not None:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        self._last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        record = {'month': self._month, 'stage': stage, 'seconds': now - self._last}
+        if self.trace_memory:
+            record['peak_memory_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.reset_peak()
+        self.records.append(record)
+        # Don't count the bookkeeping above in the next stage
+        self._last = time.perf_counter()
+
+    def end_month(self):
+        if self._profile is not None:
+            self._profile.disable()
+            name = 'all_months' if self._month is None else parse_month(self._month)
+            self._profile.dump_stats(os.path.join(self.cprofile_dir, name + '.prof'))
+            self._profile = None
+        self._month = None
+
+    def frame(self):
+        """Long-format DataFrame with one row per month and stage ('month', 'stage', 'seconds'[, 'peak_memory_mb'])."""
+        columns = ['month', 'stage', 'seconds'] + (['peak_memory_mb'] if self.trace_memory else [])
+        return pd.DataFrame(self.records, columns=columns)
+
+    def breakdown(self):
+        """Seconds of each stage (columns) in each month (rows)."""
+        return self.frame().pivot_table(index='month', columns='stage', values='seconds', aggfunc='sum', sort=False)
+
+    def close(self):
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+
+class NullProfiler:
+    """Profiler that records nothing, so that disabled profiling costs one method call per stage."""
+
+    enabled = False
+
+    def start_month(self, month):
+        pass
+
+    def lap(self, stage):
+        pass
+
+    def end_month(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def get_profiler(profile):
+    """
+    Profiler of a backtest from its `profile` argument: False/None (no profiling), True
+    (timings only), or a StageProfiler (e.g. with tracemalloc or cProfile enabled).
+    """
+    if profile is None or profile is False:
+        return NullProfiler()
+    if profile is True:
+        return StageProfiler()
+    if isinstance(profile, StageProfiler):
+        return profile
+    raise ValueError("Invalid profile. Please choose from True, False or a StageProfiler.")
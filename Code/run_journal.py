@@ -0,0 +1,88 @@
+import os
+import json
+import time
+import numpy as np
+from model_store import parse_month
+from metrics import grouped_metrics
+
+
+def _to_json(value):
+    """JSON encoding of the NumPy and pandas values found in results rows."""
+    if isinstance(value, np.datetime64):
+        return str(value)
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def month_metrics(y_pred, y_true, error_metric):
+    """Error metrics of a single month, as a dictionary (computed as `metrics.grouped_metrics` does)."""
+    y_true = np.asarray(y_true).ravel()
+    metrics = grouped_metrics(np.asarray(y_pred).reshape(1, -1), y_true, np.zeros(len(y_true), dtype=np.int64),
+                              error_metric, n_groups=1)
+    return {em: float(metrics[em][0, 0]) for em in error_metric}
+
+
+class RunJournal:
+    """
+    Append-only journal of a backtest: one JSON line per finished month, with its error
+    metrics, best parameters, timings and model path, written (and synced to disk) as soon
+    as the month completes. A crashed, interrupted or extended run can then resume from
+    the journal and only compute the months that are missing.
+
+    Each run configuration needs its own journal file: months are identified by their
+    'YYYY-MM' key only. If a month was journaled more than once, the last line wins, and a
+    line cut short by a crash is ignored.
+
+    :param path_: String, path of the journal (.jsonl).
+    """
+
+    def __init__(self, path_):
+        self.path_ = path_
+        if os.path.dirname(path_):
+            os.makedirs(os.path.dirname(path_), exist_ok=True)
+
+        # A line cut short by a crash is left as is, but the next entry starts on a new line
+        self._pending_newline = False
+        if os.path.exists(path_) and os.path.getsize(path_):
+            with open(path_, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                self._pending_newline = f.read(1) != b'\n'
+
+    def entries(self):
+        """Dictionary with the last entry of each journaled month ('YYYY-MM' keys), in journal order."""
+        entries = {}
+        if not os.path.exists(self.path_):
+            return entries
+        with open(self.path_) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                entries[entry['month']] = entry
+        return entries
+
+    def append(self, month, values, model_path=None, state=None):
+        """
+        Journal a finished month.
+
+        :param month: The month (Timestamp, datetime64 or 'YYYY-MM' string).
+        :param values: Dictionary with the results of the month (error metrics, best parameters, timings...).
+        :param model_path: String, where the month's model was saved.
+        :param state: Dictionary with what later months need to resume from this one.
+        """
+        entry = {'month': parse_month(month), 'values': values, 'model_path': model_path,
+                 'state': state or {}, 'journaled_at': time.time()}
+        line = json.dumps(entry, default=_to_json)
+        if self._pending_newline:
+            line = '\n' + line
+            self._pending_newline = False
+        with open(self.path_, 'a') as f:
+            f.write(line + '\n')
+            f.flush()
+            os.fsync(f.fileno())
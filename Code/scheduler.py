@@ -0,0 +1,92 @@
+import os
+import time
+import numpy as np
+from collections import namedtuple
+
+# How the core budget is split: months estimated at the same time, grid search
+# candidates/folds fitted at the same time within a month, and threads per booster
+CorePlan = namedtuple('CorePlan', ['total_cores', 'months_in_flight', 'search_jobs', 'booster_jobs'])
+
+
+def plan_cores(n_cores=None, n_months=1, n_search_tasks=1, max_months_in_flight=None):
+    """
+    Split a total core budget among months, grid search tasks and XGBoost threads,
+    so that months_in_flight * search_jobs * booster_jobs <= n_cores.
+
+    Months are the outer level and are parallelized first (they share nothing). The
+    cores left for each month go to grid search tasks (candidates x folds), and what is
+    left after that goes to the threads of each booster.
+
+    :param n_cores: Integer, total number of cores to use (all cores if None).
+    :param n_months: Integer, number of months to estimate.
+    :param n_search_tasks: Integer, number of fits in each month's grid search (candidates x folds), 1 without tuning.
+    :param max_months_in_flight: Integer, cap on months estimated at the same time (e.g. to bound memory).
+    :return: CorePlan.
+    """
+    if n_cores is None:
+        n_cores = os.cpu_count()
+    n_cores = max(1, int(n_cores))
+
+    months_in_flight = max(1, min(n_months, n_cores))
+    if max_months_in_flight is not None:
+        months_in_flight = max(1, min(months_in_flight, max_months_in_flight))
+
+    cores_per_month = max(1, n_cores // months_in_flight)
+    search_jobs = max(1, min(n_search_tasks, cores_per_month))
+    booster_jobs = max(1, cores_per_month // search_jobs)
+
+    return CorePlan(n_cores, months_in_flight, search_jobs, booster_jobs)
+
+
+def n_search_tasks(parameter_grid, n_folds=5):
+    """
+    Number of fits of the largest grid search round (candidates x folds). `n_folds` is the
+    number of folds of the CV splitter (its get_n_splits()).
+    """
+    if not parameter_grid:
+        return 1
+    if isinstance(parameter_grid, dict):
+        parameter_grid = [parameter_grid]
+    n_candidates = [int(np.prod([max(1, len(v)) for v in grid.values()])) for grid in parameter_grid]
+    return max(n_candidates) * n_folds
+
+
+def order_largest_first(months, costs):
+    """
+    Sort months by decreasing cost (e.g. training rows), so that the most expensive
+    months start first and the short ones fill the gaps at the end.
+    """
+    order = np.argsort(-np.asarray(costs), kind='stable')
+    return [months[i] for i in order]
+
+
+class UtilizationTracker:
+    """
+    Record the CPU time used by each task and report how much of the core budget was
+    actually used: utilization = CPU seconds / (wall seconds * cores).
+
+    CPU time is measured with `time.process_time`, which counts every thread of the
+    process, so grid searches must run on threads (not subprocesses) to be counted.
+    """
+
+    def __init__(self, n_cores):
+        self.n_cores = n_cores
+        self.start_wall = time.time()
+        self.cpu_seconds = 0.0
+        self.task_seconds = 0.0
+        self.n_tasks = 0
+
+    def add(self, cpu_seconds, wall_seconds):
+        self.cpu_seconds += cpu_seconds
+        self.task_seconds += wall_seconds
+        self.n_tasks += 1
+
+    def report(self):
+        wall = time.time() - self.start_wall
+        return {
+            'n_cores': self.n_cores,
+            'n_tasks': self.n_tasks,
+            'wall_seconds': wall,
+            'cpu_seconds': self.cpu_seconds,
+            'utilization': self.cpu_seconds / (wall * self.n_cores) if wall > 0 else np.nan,
+        }
@@ -0,0 +1,353 @@
+import json
+import time
+import argparse
+import threading
+import numpy as np
+from collections import deque, namedtuple
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from model_store import get_model_store
+from batch_inference import feature_subset
+from load_data import neighbourhood_column, commune_column
+from spatial_features import SpatialIndex
+
+# Ensemble being served: the month of its models, their boosters, their weights and the
+# features of each booster (None for all INDEP_VARS)
+LiveEnsemble = namedtuple('LiveEnsemble', ['month', 'boosters', 'weights', 'subsets'])
+
+
+class FeatureEncoder:
+    """
+    Turn listings (dictionaries with the `INDEP_VARS` fields) into rows of the feature
+    matrix the models were trained on.
+
+    The position of every column is computed once. A listing can give its location as raw
+    'neighbourhood' / 'commune' names, which are one-hot encoded with the same column names
+    as `load_data.encode_locations` (unknown locations, and the dropped first commune, get
+    all zeros), or directly with the `nei_*` / `commune_*` dummies. Missing fields are NaN.
+
+    With a spatial index, the `distance_to_*` features a listing doesn't give are computed
+    from its 'longitude' and 'latitude' (see `spatial_features.SpatialIndex`).
+
+    :param INDEP_VARS: List of feature columns, in the order the models were trained on.
+    :param spatial_index: SpatialIndex used to compute missing distances (None to leave them NaN).
+    """
+
+    def __init__(self, INDEP_VARS, spatial_index=None):
+        self.INDEP_VARS = list(INDEP_VARS)
+        self.column_map = {col: i for i, col in enumerate(self.INDEP_VARS)}
+        self.location_columns = [i for i, col in enumerate(self.INDEP_VARS)
+                                 if col.startswith('nei_') or col.startswith('commune_')]
+        self.spatial_index = spatial_index
+        self.distance_columns = {col: i for col, i in self.column_map.items()
+                                 if col in ['distance_to_transport', 'distance_to_greenspace', 'distance_to_cbd']}
+        if spatial_index is not None and not {'longitude', 'latitude'} <= set(self.column_map):
+            raise ValueError("Computing distances requires 'longitude' and 'latitude' in INDEP_VARS.")
+
+    def encode(self, listings):
+        X = np.full((len(listings), len(self.INDEP_VARS)), np.nan, dtype=np.float32)
+        X[:, self.location_columns] = 0
+        for row, listing in enumerate(listings):
+            for key, value in listing.items():
+                if key == 'neighbourhood':
+                    col = self.column_map.get(neighbourhood_column(str(value)))
+                    value = 1
+                elif key == 'commune':
+                    col = self.column_map.get(commune_column(str(value)))
+                    value = 1
+                else:
+                    col = self.column_map.get(key)
+                if col is not None and value is not None:
+                    X[row, col] = value
+
+        # Distances of the listings that didn't give them, for all of them at once
+        if self.spatial_index is not None and self.distance_columns:
+            missing = np.isnan(X[:, list(self.distance_columns.values())]).any(axis=1)
+            if missing.any():
+                distances = self.spatial_index.distances(X[missing, self.column_map['longitude']],
+                                                         X[missing, self.column_map['latitude']])
+                for col, i in self.distance_columns.items():
+                    X[missing, i] = np.where(np.isnan(X[missing, i]), distances[col], X[missing, i])
+        return X
+
+
+class LatencyTracker:
+    """Latency of the last `maxlen` requests, with percentiles."""
+
+    def __init__(self, maxlen=10000):
+        self.latencies = deque(maxlen=maxlen)
+        self.batch_sizes = deque(maxlen=maxlen)
+        self.n_requests = 0
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+            self.n_requests += 1
+
+    def add_batch(self, n_requests):
+        with self.lock:
+            self.batch_sizes.append(n_requests)
+
+    def report(self):
+        with self.lock:
+            latencies = np.asarray(self.latencies)
+            batch_sizes = np.asarray(self.batch_sizes)
+            n_requests = self.n_requests
+        if len(latencies) == 0:
+            return {'n_requests': n_requests}
+        return {
+            'n_requests': n_requests,
+            'p50_ms': float(np.percentile(latencies, 50) * 1000),
+            'p99_ms': float(np.percentile(latencies, 99) * 1000),
+            'mean_requests_per_batch': float(batch_sizes.mean()) if len(batch_sizes) else np.nan,
+        }
+
+
+class ScoringService:
+    """
+    Long-lived predictor for new listings with the latest month's ensemble.
+
+    Requests are put in a queue; a single worker thread waits up to `max_delay_ms` after the
+    first queued request to coalesce the ones that arrive meanwhile (up to `max_batch_rows`
+    rows), and predicts all of them with one `inplace_predict` call per member.
+
+    The ensemble is an immutable snapshot that the worker reads once per batch. `reload`
+    loads the models of a newer month in the background and then swaps the snapshot, so
+    requests are never interrupted at month rollover.
+
+    :param model_root: String, directory with the models saved by `estimate_xgb` (the model store root).
+    :param INDEP_VARS: List of feature columns, in the order the models were trained on.
+    :param time_window_sizes: List of window sizes that make up the ensemble.
+    :param weights: List of weights of the members (equal weights if None).
+    :param hyp_tune: String, 'not_tuned' or 'tuned'.
+    :param sample_df: Sample setting of the saved models.
+    :param cv_strategy: CV strategy of the saved models (tuned models only).
+    :param max_delay_ms: Float, milliseconds to wait for more requests before predicting.
+    :param max_batch_rows: Integer, maximum rows predicted in one batch.
+    :param reload_seconds: Float, how often to look for a newer month (never if None).
+    :param n_jobs: Integer, threads per booster.
+    :param spatial_index_path: String, saved SpatialIndex used to compute the distances that
+        listings don't give (see `spatial_features.load_spatial_index`).
+    """
+
+    def __init__(self, model_root, INDEP_VARS, time_window_sizes, weights=None, hyp_tune='not_tuned',
+                 sample_df=False, cv_strategy=None, max_delay_ms=2.0, max_batch_rows=4096,
+                 reload_seconds=60, n_jobs=None, spatial_index_path=None):
+        self.model_store = get_model_store(model_root)
+        spatial_index = SpatialIndex.load(spatial_index_path) if spatial_index_path is not None else None
+        self.encoder = FeatureEncoder(INDEP_VARS, spatial_index=spatial_index)
+        self.time_window_sizes = list(time_window_sizes)
+        self.member_weights = weights
+        self.hyp_tune = hyp_tune
+        self.sample_df = sample_df
+        self.cv_strategy = cv_strategy
+        self.max_delay = max_delay_ms / 1000
+        self.max_batch_rows = max_batch_rows
+        self.reload_seconds = reload_seconds
+        self.n_jobs = n_jobs
+
+        self.latency = LatencyTracker()
+        self.ensemble = None
+        self._queue = deque()
+        self._queue_ready = threading.Condition()
+        self._reload_lock = threading.Lock()
+        self._stopped = threading.Event()
+
+        if not self.reload():
+            raise ValueError(f"No month with a model for every window size {self.time_window_sizes} in {model_root}.")
+
+        self._worker = threading.Thread(target=self._predict_loop, daemon=True)
+        self._worker.start()
+        if reload_seconds is not None:
+            self._reloader = threading.Thread(target=self._reload_loop, daemon=True)
+            self._reloader.start()
+
+    def reload(self):
+        """Swap in the latest month's ensemble if it is newer than the one served. Returns whether it changed."""
+        with self._reload_lock:
+            month = self.model_store.latest_month(self.time_window_sizes, self.hyp_tune, self.sample_df,
+                                                  self.cv_strategy)
+            if month is None or (self.ensemble is not None and month <= self.ensemble.month):
+                return False
+
+            models = self.model_store.load_ensemble(self.time_window_sizes, month, self.hyp_tune,
+                                                    self.sample_df, self.cv_strategy)
+            boosters = []
+            subsets = []
+            for model in models:
+                booster = model.get_booster()
+                subset = feature_subset(model)
+                n_features = len(self.encoder.INDEP_VARS) if subset is None else len(subset)
+                if booster.num_features() != n_features or (subset is not None and subset.max() >= len(self.encoder.INDEP_VARS)):
+                    raise ValueError(f"The models of {month} have {booster.num_features()} features, "
+                                     f"but {len(self.encoder.INDEP_VARS)} INDEP_VARS were given.")
+                subsets.append(subset)
+                if self.n_jobs is not None:
+                    booster.set_param({'nthread': self.n_jobs})
+                boosters.append(booster)
+
+            weights = np.ones(len(boosters)) if self.member_weights is None else np.asarray(self.member_weights, dtype=np.float64)
+            self.ensemble = LiveEnsemble(month, boosters, weights / weights.sum(), subsets)
+            return True
+
+    def _reload_loop(self):
+        while not self._stopped.wait(self.reload_seconds):
+            try:
+                self.reload()
+            except Exception as error:
+                # Keep serving the current month if the new models can't be read yet
+                print(f"Model reload failed: {error}")
+
+    def submit(self, listings):
+        """Queue listings for prediction. Returns a Future with the array of predictions."""
+        # The latency clock starts before the features are encoded (spatial lookups included)
+        start_time = time.perf_counter()
+        request = (self.encoder.encode(listings), Future(), start_time)
+        with self._queue_ready:
+            self._queue.append(request)
+            self._queue_ready.notify()
+        return request[1]
+
+    def predict(self, listings):
+        """Predict the rent of a list of listings (blocks until the batch they join is predicted)."""
+        return self.submit(listings).result()
+
+    def _predict_loop(self):
+        while not self._stopped.is_set():
+            # Wait for a first request, then for more until the delay or the batch size is reached
+            with self._queue_ready:
+                while not self._queue and not self._stopped.is_set():
+                    self._queue_ready.wait(0.1)
+                if self._stopped.is_set():
+                    break
+                deadline = time.perf_counter() + self.max_delay
+                n_rows = sum(len(X) for X, _, _ in self._queue)
+                while n_rows < self.max_batch_rows and time.perf_counter() < deadline:
+                    self._queue_ready.wait(deadline - time.perf_counter())
+                    n_rows = sum(len(X) for X, _, _ in self._queue)
+                batch = list(self._queue)
+                self._queue.clear()
+
+            # One prediction per member for the whole batch, with the ensemble of this moment
+            ensemble = self.ensemble
+            try:
+                X = np.concatenate([X for X, _, _ in batch])
+                predictions = np.vstack([booster.inplace_predict(X if subset is None else X[:, subset])
+                                         for booster, subset in zip(ensemble.boosters, ensemble.subsets)])
+                y_pred = ensemble.weights @ predictions
+            except Exception as error:
+                for _, future, _ in batch:
+                    future.set_exception(error)
+                continue
+
+            start = 0
+            for X_request, future, start_time in batch:
+                future.set_result(y_pred[start:start + len(X_request)])
+                start += len(X_request)
+                self.latency.add(time.perf_counter() - start_time)
+            self.latency.add_batch(len(batch))
+
+    def stats(self):
+        return {'month': self.ensemble.month, 'window_sizes': self.time_window_sizes, **self.latency.report()}
+
+    def close(self):
+        self._stopped.set()
+        with self._queue_ready:
+            self._queue_ready.notify_all()
+        self._worker.join()
+
+
+def make_handler(service):
+    """HTTP handler class for a ScoringService."""
+
+    class ScoringHandler(BaseHTTPRequestHandler):
+
+        def _send(self, status, body):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._send(200, service.stats())
+            elif self.path == '/health':
+                self._send(200, {'status': 'ok', 'month': service.ensemble.month})
+            else:
+                self._send(404, {'error': 'Not found'})
+
+        def do_POST(self):
+            if self.path == '/reload':
+                self._send(200, {'reloaded': service.reload(), 'month': service.ensemble.month})
+                return
+            if self.path != '/predict':
+                self._send(404, {'error': 'Not found'})
+                return
+
+            # A single listing, a list of listings or {"listings": [...]}
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            except ValueError:
+                self._send(400, {'error': 'Invalid JSON'})
+                return
+            single = isinstance(body, dict) and 'listings' not in body
+            listings = [body] if single else body['listings'] if isinstance(body, dict) else body
+
+            try:
+                y_pred = service.predict(listings)
+            except Exception as error:
+                self._send(500, {'error': str(error)})
+                return
+            month = service.ensemble.month
+            if single:
+                self._send(200, {'prediction': float(y_pred[0]), 'month': month})
+            else:
+                self._send(200, {'predictions': y_pred.tolist(), 'month': month})
+
+        def log_message(self, format, *args):
+            pass
+
+    return ScoringHandler
+
+
+def serve(model_root, INDEP_VARS, time_window_sizes, host='127.0.0.1', port=8000, **kwargs):
+    """
+    Start the scoring server (blocks until interrupted).
+
+    Endpoints: POST /predict (a listing, a list of listings or {"listings": [...]}),
+    GET /stats (served month, p50/p99 latency), GET /health and POST /reload.
+
+    :param kwargs: Any other argument of `ScoringService`.
+    """
+    service = ScoringService(model_root, INDEP_VARS, time_window_sizes, **kwargs)
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    print(f"Serving the {service.ensemble.month} ensemble on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Real-time rent price predictions with the latest ensemble.')
+    parser.add_argument('model_root', help='Directory of the model store')
+    parser.add_argument('--features', required=True, help='JSON file with the list of INDEP_VARS')
+    parser.add_argument('--window-sizes', default='1,3,6,12,24', help='Comma-separated window sizes')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-delay-ms', type=float, default=2.0)
+    parser.add_argument('--reload-seconds', type=float, default=60)
+    parser.add_argument('--spatial-index', default=None, help='Saved spatial index to compute missing distances')
+    args = parser.parse_args()
+
+    with open(args.features) as f:
+        INDEP_VARS = json.load(f)
+    serve(args.model_root, INDEP_VARS, [int(ws) for ws in args.window_sizes.split(',')],
+          host=args.host, port=args.port, max_delay_ms=args.max_delay_ms, reload_seconds=args.reload_seconds,
+          spatial_index_path=args.spatial_index)
@@ -0,0 +1,288 @@
+import os
+import json
+import joblib
+import numpy as np
+from scipy.spatial import cKDTree
+from load_data import file_hash
+
+# Transverse Mercator parameters of EPSG:5349 (POSGAR 2007 / Argentina 7), the projection
+# in which 1.4.AddVariables.R computes the distances: GRS80 ellipsoid, central meridian
+# 54°W, scale factor 1, false easting 7,500,000 m and latitude of origin 90°S
+GRS80_A = 6378137.0
+GRS80_F = 1 / 298.257222101
+CENTRAL_MERIDIAN = -54.0
+FALSE_EASTING = 7_500_000.0
+
+# Obelisco, the CBD of 1.4.AddVariables.R (longitude, latitude)
+CBD = (-58.38156271629649, -34.603737524695575)
+
+# Green spaces kept by 1.4.AddVariables.R
+GREENSPACE_CLASSES = ['PLAZA', 'JARDÍN BOTÁNICO', 'PARQUE', 'PARQUE SEMIPÚBLICO']
+GREENSPACE_MIN_AREA = 10000
+GREENSPACE_EXCLUDED = ['Balneario Norte', 'Bosque Alegre (Depvo. M. Belgrano)', 'Parque de la Raza (Aeroparque)']
+
+# Bump when the layout of the saved index changes, so old indexes are rebuilt
+INDEX_VERSION = 1
+
+
+def project(longitude, latitude):
+    """
+    Project (longitude, latitude) in degrees (EPSG:4326) to EPSG:5349 metres, so that
+    Euclidean distances are the ones `st_distance` computes in 1.4.AddVariables.R.
+
+    Transverse Mercator with Krüger's series to fourth order in n (sub-millimetre here).
+
+    :return: Tuple of arrays (easting, northing).
+    """
+    longitude = np.asarray(longitude, dtype=np.float64)
+    latitude = np.radians(np.asarray(latitude, dtype=np.float64))
+    lam = np.radians(longitude - CENTRAL_MERIDIAN)
+
+    n = GRS80_F / (2 - GRS80_F)
+    e = np.sqrt(GRS80_F * (2 - GRS80_F))
+    A = GRS80_A / (1 + n) * (1 + n**2 / 4 + n**4 / 64)
+    alpha = [n / 2 - 2 / 3 * n**2 + 5 / 16 * n**3 + 41 / 180 * n**4,
+             13 / 48 * n**2 - 3 / 5 * n**3 + 557 / 1440 * n**4,
+             61 / 240 * n**3 - 103 / 140 * n**4,
+             49561 / 161280 * n**4]
+
+    # Conformal latitude, then the spherical transverse Mercator and Krüger's correction
+    sin_lat = np.sin(latitude)
+    t = np.sinh(np.arctanh(sin_lat) - e * np.arctanh(e * sin_lat))
+    xi_prime = np.arctan2(t, np.cos(lam))
+    eta_prime = np.arctanh(np.sin(lam) / np.sqrt(1 + t**2))
+    xi = xi_prime.copy()
+    eta = eta_prime.copy()
+    for j, alpha_j in enumerate(alpha, start=1):
+        xi += alpha_j * np.sin(2 * j * xi_prime) * np.cosh(2 * j * eta_prime)
+        eta += alpha_j * np.cos(2 * j * xi_prime) * np.sinh(2 * j * eta_prime)
+
+    # Northing measured from the south pole (latitude of origin 90°S)
+    return FALSE_EASTING + A * eta, A * (xi + np.pi / 2)
+
+
+def simplify_ring(points, tolerance):
+    """
+    Douglas-Peucker simplification of a ring or line of projected points, as `st_simplify`
+    with `dTolerance=tolerance` (the first and last points are kept).
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if len(points) < 3 or tolerance <= 0:
+        return points
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        segment = points[end] - points[start]
+        offsets = points[start + 1:end] - points[start]
+        length = np.hypot(*segment)
+        if length == 0:
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distances = np.abs(segment[0] * offsets[:, 1] - segment[1] * offsets[:, 0]) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = start + 1 + farthest
+            keep[split] = True
+            stack += [(start, split), (split, end)]
+    return points[keep]
+
+
+def densify_ring(points, max_spacing):
+    """Points along the edges of a ring, no more than `max_spacing` apart."""
+    points = np.asarray(points, dtype=np.float64)
+    if len(points) < 2:
+        return points
+    edges = np.diff(points, axis=0)
+    n_steps = np.maximum(1, np.ceil(np.hypot(edges[:, 0], edges[:, 1]) / max_spacing)).astype(np.int64)
+    edge = np.repeat(np.arange(len(edges)), n_steps)
+    fraction = (np.arange(n_steps.sum()) - np.repeat(np.cumsum(n_steps) - n_steps, n_steps)) / n_steps[edge]
+    return np.vstack([points[edge] + edges[edge] * fraction[:, None], points[-1:]])
+
+
+def contains_points(ring, points):
+    """Whether each point is inside a closed ring (crossing number, one pass per edge)."""
+    inside = np.zeros(len(points), dtype=bool)
+    x, y = points[:, 0], points[:, 1]
+    for (x1, y1), (x2, y2) in zip(ring[:-1], ring[1:]):
+        crosses = (y1 > y) != (y2 > y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+        inside ^= crosses & (x < x_cross)
+    return inside
+
+
+def read_geojson_points(path_):
+    """(longitude, latitude) array of the Point and MultiPoint features of a GeoJSON file."""
+    with open(path_, encoding='utf-8') as f:
+        features = json.load(f)['features']
+    points = []
+    for feature in features:
+        geometry = feature['geometry']
+        if geometry is None:
+            continue
+        if geometry['type'] == 'Point':
+            points.append(geometry['coordinates'][:2])
+        elif geometry['type'] == 'MultiPoint':
+            points += [point[:2] for point in geometry['coordinates']]
+    return np.asarray(points, dtype=np.float64).reshape(-1, 2)
+
+
+def is_kept_greenspace(properties):
+    """Filter of 1.4.AddVariables.R: large plazas and parks, without the excluded ones."""
+    return (properties.get('clasificac') in GREENSPACE_CLASSES
+            and (properties.get('area') or 0) > GREENSPACE_MIN_AREA
+            and properties.get('nombre') not in GREENSPACE_EXCLUDED)
+
+
+def read_geojson_polygons(path_, keep=None):
+    """
+    Polygons of the Polygon and MultiPolygon features of a GeoJSON file, each as a list of
+    (longitude, latitude) rings (the exterior ring first, then the holes).
+
+    :param keep: Function of the feature properties that says whether to keep it (all if None).
+    """
+    with open(path_, encoding='utf-8') as f:
+        features = json.load(f)['features']
+    polygons = []
+    for feature in features:
+        geometry = feature['geometry']
+        if geometry is None or (keep is not None and not keep(feature.get('properties') or {})):
+            continue
+        if geometry['type'] == 'Polygon':
+            polygons.append([np.asarray(ring, dtype=np.float64)[:, :2] for ring in geometry['coordinates']])
+        elif geometry['type'] == 'MultiPolygon':
+            polygons += [[np.asarray(ring, dtype=np.float64)[:, :2] for ring in polygon]
+                         for polygon in geometry['coordinates']]
+    return polygons
+
+
+class SpatialIndex:
+    """
+    Nearest-amenity distances of listings, as 1.4.AddVariables.R computes them, without
+    the listings x amenities distance matrix.
+
+    Everything is projected once to EPSG:5349. Transport stations are points in a KD-tree.
+    Green spaces are simplified (as `st_simplify(dTolerance=5)`), and their boundaries are
+    sampled every `max_spacing` metres into a second KD-tree; a listing inside a green
+    space (and not in one of its holes) is at distance 0, as with the union of green spaces
+    in R. Distances to green spaces are therefore within `max_spacing / 2` of the exact ones.
+
+    :param stations: Array (stations x 2) with the (longitude, latitude) of the transport stations.
+    :param greenspaces: List of polygons, each a list of (longitude, latitude) rings (exterior first).
+    :param cbd: Tuple with the (longitude, latitude) of the CBD.
+    :param simplify_tolerance: Float, Douglas-Peucker tolerance of the green space boundaries, in metres.
+    :param max_spacing: Float, maximum distance between the sampled boundary points, in metres.
+    """
+
+    def __init__(self, stations=None, greenspaces=None, cbd=CBD, simplify_tolerance=5, max_spacing=5):
+        self.version = INDEX_VERSION
+        self.sources = {}
+
+        self.station_tree = None
+        if stations is not None and len(stations):
+            stations = np.asarray(stations, dtype=np.float64)
+            self.station_tree = cKDTree(np.column_stack(project(stations[:, 0], stations[:, 1])))
+
+        # Projected, simplified rings of every green space, and the points of their boundaries
+        self.greenspace_tree = None
+        self.exteriors = []
+        self.holes = []
+        if greenspaces:
+            boundary = []
+            for polygon in greenspaces:
+                rings = [simplify_ring(np.column_stack(project(ring[:, 0], ring[:, 1])), simplify_tolerance)
+                         for ring in polygon]
+                self.exteriors.append(rings[0])
+                self.holes.append(rings[1:])
+                boundary += [densify_ring(ring, max_spacing) for ring in rings]
+            self.greenspace_tree = cKDTree(np.vstack(boundary))
+
+            # Bounding boxes, so that only the polygons near a listing are tested
+            self.extents = np.array([ring.min(axis=0).tolist() + ring.max(axis=0).tolist()
+                                     for ring in self.exteriors])
+
+        self.cbd = np.array(project(*cbd))
+
+    def _inside_greenspace(self, points):
+        inside = np.zeros(len(points), dtype=bool)
+        for exterior, holes, extent in zip(self.exteriors, self.holes, self.extents):
+            candidates = np.flatnonzero((points[:, 0] >= extent[0]) & (points[:, 0] <= extent[2])
+                                        & (points[:, 1] >= extent[1]) & (points[:, 1] <= extent[3]) & ~inside)
+            if len(candidates) == 0:
+                continue
+            in_polygon = contains_points(exterior, points[candidates])
+            for hole in holes:
+                in_polygon &= ~contains_points(hole, points[candidates])
+            inside[candidates[in_polygon]] = True
+        return inside
+
+    def distances(self, longitude, latitude, n_jobs=1):
+        """
+        Distances in metres of a batch of locations to the nearest transport station, the
+        nearest green space and the CBD (NaN for missing coordinates).
+
+        :param n_jobs: Integer, threads of the KD-tree queries (-1 for all cores).
+        :return: Dictionary with the arrays 'distance_to_transport', 'distance_to_greenspace' and 'distance_to_cbd'.
+        """
+        x, y = project(longitude, latitude)
+        points = np.column_stack([np.atleast_1d(x), np.atleast_1d(y)])
+        valid = np.isfinite(points).all(axis=1)
+        result = {name: np.full(len(points), np.nan)
+                  for name in ['distance_to_transport', 'distance_to_greenspace', 'distance_to_cbd']}
+
+        if self.station_tree is not None:
+            result['distance_to_transport'][valid] = self.station_tree.query(points[valid], workers=n_jobs)[0]
+        if self.greenspace_tree is not None:
+            distance = self.greenspace_tree.query(points[valid], workers=n_jobs)[0]
+            distance[self._inside_greenspace(points[valid])] = 0
+            result['distance_to_greenspace'][valid] = distance
+        result['distance_to_cbd'][valid] = np.hypot(*(points[valid] - self.cbd).T)
+        return result
+
+    def add_features(self, df, longitude='longitude', latitude='latitude', n_jobs=1):
+        """Copy of a data frame of listings with the distance columns added (or replaced)."""
+        return df.assign(**self.distances(df[longitude].to_numpy(), df[latitude].to_numpy(), n_jobs=n_jobs))
+
+    def save(self, path_):
+        """Save the index (KD-trees included), so that it loads without being rebuilt."""
+        if os.path.dirname(path_):
+            os.makedirs(os.path.dirname(path_), exist_ok=True)
+        joblib.dump(self, path_)
+
+    @staticmethod
+    def load(path_):
+        return joblib.load(path_)
+
+
+def load_spatial_index(station_paths, greenspaces_path, index_path=None, rebuild=False, **kwargs):
+    """
+    Spatial index of the transport stations and green spaces in GeoJSON files, with the
+    green spaces filtered as in 1.4.AddVariables.R.
+
+    The first call builds the index and saves it to `index_path`; later calls load it,
+    unless the GeoJSON files changed (their hashes are stored with the index).
+
+    :param station_paths: List of GeoJSON files with stations (e.g. subway entrances and train stations).
+    :param greenspaces_path: String, GeoJSON file with the public green spaces.
+    :param index_path: String, where the index is saved (not saved if None).
+    :param rebuild: Boolean, if True, rebuilds the index even if it exists.
+    :param kwargs: Any other argument of `SpatialIndex`.
+    """
+    sources = {os.path.abspath(path_): file_hash(path_) for path_ in list(station_paths) + [greenspaces_path]}
+
+    if index_path is not None and os.path.exists(index_path) and not rebuild:
+        index = SpatialIndex.load(index_path)
+        if getattr(index, 'version', None) == INDEX_VERSION and index.sources == sources:
+            return index
+
+    stations = np.vstack([read_geojson_points(path_) for path_ in station_paths])
+    greenspaces = read_geojson_polygons(greenspaces_path, keep=is_kept_greenspace)
+    index = SpatialIndex(stations, greenspaces, **kwargs)
+    index.sources = sources
+    if index_path is not None:
+        index.save(index_path)
+    return index
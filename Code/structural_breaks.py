@@ -0,0 +1,259 @@
+import numpy as np
+import pandas as pd
+from scipy.stats import f
+from feature_layout import LOCATION_GROUPS
+
+
+class MonthlyOLSStats:
+    """
+    Sufficient statistics of an OLS regression (X'X, X'y, y'y and the number of rows) of
+    each month, accumulated over months, so that the RSS of the regression on any range
+    of consecutive months costs one k x k solve instead of a refit on the data.
+
+    The design matrix is built once. The regressors and the target are centred (and the
+    regressors scaled) with their means and standard deviations over all the data; with
+    an intercept, the fitted values and the RSS of every regression are the same as on
+    the raw data, but X'X is much better conditioned.
+
+    :param X: Array (rows x regressors) without the intercept column.
+    :param y: Array with the target.
+    :param month_codes: Integer array with the month (0, 1, ...) of each row.
+    :param n_months: Integer, number of months.
+    """
+
+    def __init__(self, X, y, month_codes, n_months):
+        X = np.asarray(X, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64).ravel()
+        scale = X.std(axis=0)
+        scale[scale == 0] = 1
+        X = np.column_stack([np.ones(len(X)), (X - X.mean(axis=0)) / scale])
+        y = y - y.mean()
+        self.n_params = X.shape[1]
+
+        # Statistics of each month, then cumulative sums with a leading zero
+        order = np.argsort(month_codes, kind='stable')
+        X, y, month_codes = X[order], y[order], np.asarray(month_codes)[order]
+        offsets = np.searchsorted(month_codes, np.arange(n_months + 1), side='left')
+        XtX = np.zeros((n_months, self.n_params, self.n_params))
+        Xty = np.zeros((n_months, self.n_params))
+        yty = np.zeros(n_months)
+        for m in range(n_months):
+            rows = slice(offsets[m], offsets[m + 1])
+            XtX[m] = X[rows].T @ X[rows]
+            Xty[m] = X[rows].T @ y[rows]
+            yty[m] = y[rows] @ y[rows]
+
+        self.cum_XtX = np.concatenate([np.zeros((1, self.n_params, self.n_params)), np.cumsum(XtX, axis=0)])
+        self.cum_Xty = np.concatenate([np.zeros((1, self.n_params)), np.cumsum(Xty, axis=0)])
+        self.cum_yty = np.concatenate([[0], np.cumsum(yty)])
+        self.cum_n = offsets.astype(np.int64)
+
+    def n_rows(self, start, end):
+        """Number of rows of the months [start, end)."""
+        return int(self.cum_n[end] - self.cum_n[start])
+
+    def rss(self, start, end):
+        """RSS of the OLS regression on the months [start, end) (minimum-norm solution if singular)."""
+        XtX = self.cum_XtX[end] - self.cum_XtX[start]
+        Xty = self.cum_Xty[end] - self.cum_Xty[start]
+        yty = self.cum_yty[end] - self.cum_yty[start]
+        beta = np.linalg.pinv(XtX, rcond=1e-10, hermitian=True) @ Xty
+        return max(yty - Xty @ beta, 0.0)
+
+
+def design_matrix(df, DEP_VAR, INDEP_VARS, month_col='listing_month'):
+    """
+    Regressors, target and month codes of a data frame, with the rows that have a missing
+    value dropped (as statsmodels formulas do).
+
+    :return: Tuple with X (without intercept), y, the month code of each row and the sorted unique months.
+    """
+    columns = list(INDEP_VARS) + list(DEP_VAR)
+    df = df.dropna(subset=columns)
+    months, month_codes = np.unique(df[month_col].to_numpy(dtype='datetime64[ns]'), return_inverse=True)
+    X = df[list(INDEP_VARS)].to_numpy(dtype=np.float64)
+    y = df[list(DEP_VAR)].to_numpy(dtype=np.float64).ravel()
+    return X, y, month_codes, months
+
+
+def _chow(stats, split, n_months):
+    # Chow statistic of the split after month `split` (the first part is months [0, split])
+    k = stats.n_params
+    n = stats.n_rows(0, n_months)
+    rss = stats.rss(0, n_months)
+    rss1 = stats.rss(0, split + 1)
+    rss2 = stats.rss(split + 1, n_months)
+    chow_statistic = ((rss - (rss1 + rss2)) / k) / ((rss1 + rss2) / (n - 2 * k))
+    p_value = f.sf(chow_statistic, k, n - 2 * k)
+    return {'chow_statistic': chow_statistic, 'p_value': p_value, 'rss': rss, 'rss1': rss1, 'rss2': rss2,
+            'n1': stats.n_rows(0, split + 1), 'n2': stats.n_rows(split + 1, n_months)}
+
+
+def location_groups(df, by):
+    """
+    Group of each row: the values of column `by`, or, if the data only has the dummies of a
+    location variable ('neighbourhood' -> `nei_*`, 'commune' -> `commune_*`), the dummy that is set.
+    """
+    if by in df:
+        return df[by].to_numpy()
+    prefix, dropped_first = LOCATION_GROUPS[by]
+    dummies = [col for col in df.columns if col.startswith(prefix)]
+    values = df[dummies].to_numpy()
+    names = np.array([col[len(prefix):] for col in dummies], dtype=object)
+    groups = names[values.argmax(axis=1)]
+    return np.where(values.any(axis=1), groups, 'reference' if dropped_first else None)
+
+
+def _by_group(scan, df, DEP_VAR, INDEP_VARS, by, month_col='listing_month', **kwargs):
+    # Run a scan on the rows of each group and stack the results with a group column
+    groups = location_groups(df, by)
+    results = []
+    for group in pd.unique(groups[pd.notna(groups)]):
+        group_df = df.loc[groups == group]
+        if group_df[month_col].nunique() < 2:
+            continue
+        group_results = scan(group_df, DEP_VAR, INDEP_VARS, month_col=month_col, **kwargs)
+        group_results.insert(0, by, group)
+        results.append(group_results)
+    return pd.concat(results, ignore_index=True) if results else pd.DataFrame()
+
+
+def chow_test(data, split_date, DEP_VAR=['price_realpesos'], INDEP_VARS=None, month_col='listing_month'):
+    """
+    Chow test of a break after `split_date`, as the `chow_test` helper of MasterPython.ipynb:
+    the first sample has the months <= split_date, F statistic with dfn = k and
+    dfd = n - 2k (k regressors including the intercept).
+
+    :return: Tuple (chow_statistic, p_value).
+    """
+    X, y, month_codes, months = design_matrix(data, DEP_VAR, INDEP_VARS, month_col)
+    split = int(np.searchsorted(months, np.datetime64(pd.Timestamp(split_date), 'ns'), side='right')) - 1
+    stats = MonthlyOLSStats(X, y, month_codes, len(months))
+    result = _chow(stats, split, len(months))
+    return result['chow_statistic'], result['p_value']
+
+
+def chow_scan(df, DEP_VAR=['price_realpesos'], INDEP_VARS=None, by=None, min_rows=None, month_col='listing_month'):
+    """
+    Chow test of a break after every month but the last, from a single pass over the data.
+
+    Each month's X'X and X'y are computed once; the RSS of the full sample and of the two
+    subsamples of every split then come from cumulative sums, at O(k^3) per split, instead
+    of three OLS refits per split.
+
+    :param by: String, run the scan separately for each 'neighbourhood' or 'commune' (or any
+        column), with a column of the group in the results (all the data if None).
+    :param min_rows: Integer, skip splits where a subsample has fewer rows (2k by default, so
+        that both subsamples can be estimated).
+    :return: DataFrame with one row per split month: 'split_month', 'chow_statistic',
+        'p_value', the RSS of the full sample and of both subsamples, and their rows.
+    """
+    if by is not None:
+        return _by_group(chow_scan, df, DEP_VAR, INDEP_VARS, by, min_rows=min_rows, month_col=month_col)
+
+    X, y, month_codes, months = design_matrix(df, DEP_VAR, INDEP_VARS, month_col)
+    stats = MonthlyOLSStats(X, y, month_codes, len(months))
+    if min_rows is None:
+        min_rows = 2 * stats.n_params
+
+    results = []
+    for split in range(len(months) - 1):
+        if min(stats.n_rows(0, split + 1), stats.n_rows(split + 1, len(months))) < min_rows:
+            continue
+        results.append({'split_month': months[split], **_chow(stats, split, len(months))})
+    return pd.DataFrame(results, columns=['split_month', 'chow_statistic', 'p_value', 'rss', 'rss1', 'rss2',
+                                          'n1', 'n2'])
+
+
+def breaks_at_confidence_levels(scan, confidence_levels={'10%': 0.10, '5%': 0.05, '1%': 0.01}):
+    """
+    Months of a `chow_scan` with a significant break at each confidence level, formatted
+    'YYYY-MM' as in MasterPython.ipynb.
+
+    :return: Dictionary with the list of months of each level.
+    """
+    months = pd.to_datetime(scan['split_month']).dt.strftime('%Y-%m')
+    return {level: months[scan['p_value'] <= alpha].tolist() for level, alpha in confidence_levels.items()}
+
+
+def sup_f_test(df, DEP_VAR=['price_realpesos'], INDEP_VARS=None, by=None, trimming=0.15, month_col='listing_month'):
+    """
+    Sup-F (Quandt likelihood ratio) test of a single break at an unknown month: the largest
+    Chow statistic over the splits that leave at least `trimming` of the rows on each side.
+
+    The Chow p-value of that split is pointwise and overstates the significance of the
+    sup-F statistic; compare the statistic with Andrews (1993) critical values instead.
+
+    :param by: String, run the test separately for each 'neighbourhood' or 'commune' (or any column).
+    :return: DataFrame with one row (per group): 'break_month', 'sup_f', 'pointwise_p_value' and
+        the number of splits compared.
+    """
+    if by is not None:
+        return _by_group(sup_f_test, df, DEP_VAR, INDEP_VARS, by, trimming=trimming, month_col=month_col)
+
+    scan = chow_scan(df, DEP_VAR, INDEP_VARS, month_col=month_col)
+    n = scan['n1'] + scan['n2']
+    scan = scan.loc[(scan['n1'] >= trimming * n) & (scan['n2'] >= trimming * n)]
+    if len(scan) == 0:
+        return pd.DataFrame(columns=['break_month', 'sup_f', 'pointwise_p_value', 'n_splits'])
+    best = scan.loc[scan['chow_statistic'].idxmax()]
+    return pd.DataFrame([{'break_month': best['split_month'], 'sup_f': best['chow_statistic'],
+                          'pointwise_p_value': best['p_value'], 'n_splits': len(scan)}])
+
+
+def multiple_breaks(df, DEP_VAR=['price_realpesos'], INDEP_VARS=None, by=None, max_breaks=5,
+                    min_segment_months=6, month_col='listing_month'):
+    """
+    Bai-Perron search of multiple breaks: for each number of breaks, the break months that
+    minimise the total RSS of the regressions on each segment, by dynamic programming over
+    the RSS of every range of at least `min_segment_months` consecutive months (each one a
+    solve on the cumulative statistics).
+
+    :param by: String, run the search separately for each 'neighbourhood' or 'commune' (or any column).
+    :param max_breaks: Integer, largest number of breaks.
+    :param min_segment_months: Integer, fewest months in a segment.
+    :return: DataFrame with one row per number of breaks: 'n_breaks', 'break_months' (the
+        last month of every segment but the last), 'rss' and 'bic'; the row with the lowest
+        BIC is flagged in 'selected'.
+    """
+    if by is not None:
+        return _by_group(multiple_breaks, df, DEP_VAR, INDEP_VARS, by, max_breaks=max_breaks,
+                         min_segment_months=min_segment_months, month_col=month_col)
+
+    X, y, month_codes, months = design_matrix(df, DEP_VAR, INDEP_VARS, month_col)
+    stats = MonthlyOLSStats(X, y, month_codes, len(months))
+    n_months, k, n = len(months), stats.n_params, len(y)
+    h = min_segment_months
+
+    # RSS of every segment of months [start, end) that is long enough
+    segment_rss = np.full((n_months + 1, n_months + 1), np.inf)
+    for start in range(n_months):
+        for end in range(start + h, n_months + 1):
+            segment_rss[start, end] = stats.rss(start, end)
+
+    # best[b, end]: lowest RSS of months [0, end) with b breaks, and where its last segment starts
+    max_breaks = min(max_breaks, n_months // h - 1)
+    best = np.full((max_breaks + 1, n_months + 1), np.inf)
+    last_start = np.zeros((max_breaks + 1, n_months + 1), dtype=np.int64)
+    best[0] = segment_rss[0]
+    for b in range(1, max_breaks + 1):
+        for end in range((b + 1) * h, n_months + 1):
+            candidates = best[b - 1, :end] + segment_rss[:end, end]
+            last_start[b, end] = int(np.argmin(candidates))
+            best[b, end] = candidates[last_start[b, end]]
+
+    results = []
+    for b in range(max_breaks + 1):
+        if not np.isfinite(best[b, n_months]):
+            continue
+        breaks, end = [], n_months
+        for level in range(b, 0, -1):
+            end = last_start[level, end]
+            breaks.insert(0, months[end - 1])
+        rss = best[b, n_months]
+        results.append({'n_breaks': b, 'break_months': breaks, 'rss': rss,
+                        'bic': n * np.log(rss / n) + ((b + 1) * k + b) * np.log(n)})
+
+    results = pd.DataFrame(results)
+    results['selected'] = results['bic'] == results['bic'].min()
+    return results
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+import xgboost as xgb
+from sklearn.model_selection import GridSearchCV, ParameterGrid, TimeSeriesSplit
+from benchmark import DEP_VAR, make_listings, feature_columns
+from cv_cache import FoldScoreCache
+from estimate_xgboost import estimate_xgb
+from hyperparameter_search import CVEvaluator, MonthSeriesSplit, month_series_cv
+from month_index import MonthIndex
+
+GRID = [{'max_depth': [2, 3], 'n_estimators': [10]}]
+
+
+def test_month_series_split_folds_are_whole_months():
+    offsets = np.array([0, 3, 5, 9, 10])
+    folds = list(MonthSeriesSplit(offsets, n_splits=5).split(np.zeros((10, 1))))
+    assert len(folds) == 3
+    assert [valid.tolist() for _, valid in folds] == [[3, 4], [5, 6, 7, 8], [9]]
+    assert [train.tolist() for train, _ in folds] == [[0, 1, 2], list(range(5)), list(range(9))]
+    # A single month can't be split by month
+    assert isinstance(month_series_cv(np.array([0, 10])), TimeSeriesSplit)
+
+
+def test_month_hashes_do_not_depend_on_other_months():
+    df = make_listings(600, 6)
+    INDEP_VARS = feature_columns(df)
+    full = MonthIndex(df, INDEP_VARS, DEP_VAR)
+    first_months = MonthIndex(df[df['listing_month'] < full.months[4]], INDEP_VARS, DEP_VAR)
+    assert full.month_hashes()[:4] == first_months.month_hashes()
+
+
+def test_cached_grid_search_scores_match_grid_search_cv(tmp_path):
+    df = make_listings(800, 4)
+    month_index = MonthIndex(df, feature_columns(df), DEP_VAR)
+    offsets, hashes = month_index.window_months(slice(0, len(month_index.y)))
+    estimator = xgb.XGBRegressor(objective='reg:squarederror', tree_method='exact', seed=789)
+    cv = TimeSeriesSplit(n_splits=5)
+    candidates = list(ParameterGrid(GRID))
+
+    grid_search = GridSearchCV(estimator, GRID, cv=cv, scoring='neg_mean_squared_error').fit(month_index.X, month_index.y)
+    evaluator = CVEvaluator(estimator, month_index.X, month_index.y, cv, n_jobs=2,
+                            cache=FoldScoreCache(str(tmp_path / 'cv.sqlite')), month_offsets=offsets, month_hashes=hashes)
+    np.testing.assert_allclose(evaluator.score_many(candidates), grid_search.cv_results_['mean_test_score'], rtol=1e-6)
+    assert evaluator.n_fits == len(candidates) * 5
+
+
+def test_time_series_split_is_unchanged_by_the_cache(tmp_path):
+    df = make_listings(1200, 6)
+    kwargs = dict(DEP_VAR=DEP_VAR, INDEP_VARS=feature_columns(df), tune_hyperparams=True, parameter_grid=GRID,
+                  cv_strategy='time_series_split', time_window_size=3, error_metric=['rmse'])
+    plain = estimate_xgb(df, **kwargs)
+    cached = estimate_xgb(df, cv_cache_path=str(tmp_path / 'cv.sqlite'), **kwargs)
+    np.testing.assert_allclose(cached['rmse'].dropna(), plain['rmse'].dropna())
+    np.testing.assert_array_equal(cached['max_depth'].dropna(), plain['max_depth'].dropna())
+
+
+@pytest.mark.parametrize('time_window_size', [False, 3])
+@pytest.mark.parametrize('engine', ['exact', 'hist'])
+def test_cached_folds_are_reused_after_extending_ending_month(tmp_path, engine, time_window_size):
+    df = make_listings(1200, 7)
+    kwargs = dict(DEP_VAR=DEP_VAR, INDEP_VARS=feature_columns(df), tune_hyperparams=True,
+                  parameter_grid=GRID, cv_strategy='month_series_split', starting_month=0,
+                  time_window_size=time_window_size, engine=engine, cv_cache_path=str(tmp_path / 'cv.sqlite'))
+
+    first = estimate_xgb(df, ending_month=5, **kwargs)
+    extended = estimate_xgb(df, ending_month=6, **kwargs)
+
+    # The months of the first run are scored from the cache, and only the new month is fitted
+    assert extended.attrs['cv_cache']['hits'] >= first.attrs['cv_cache']['misses']
+    assert extended.attrs['cv_cache']['misses'] < first.attrs['cv_cache']['misses']
+    np.testing.assert_allclose(extended['rmse'].iloc[:5].dropna(), first['rmse'].iloc[:5].dropna())
@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+from benchmark import DEP_VAR, make_listings, feature_columns
+from estimate_xgboost import estimate_xgb
+from feature_attribution import month_attributions
+from feature_layout import location_columns
+from month_index import MonthIndex
+
+
+def test_sparse_month_index_is_shared():
+    df = make_listings(600, 4)
+    INDEP_VARS = feature_columns(df)
+    sparse_columns = [col for cols in location_columns(INDEP_VARS).values() for col in cols]
+    month_index = MonthIndex(df, INDEP_VARS, DEP_VAR, sparse_columns=sparse_columns)
+    X = month_index.X.toarray()
+
+    spec = month_index.share()
+    try:
+        attached = MonthIndex.attach(spec)
+        np.testing.assert_array_equal(attached.X.toarray(), X)
+        np.testing.assert_array_equal(attached.test(month_index.months[-1])[0].toarray(),
+                                      month_index.test(month_index.months[-1])[0].toarray())
+        attached.close()
+    finally:
+        month_index.unlink()
+
+
+def test_sparse_layout_with_several_months_in_flight(tmp_path):
+    df = make_listings(1500, 5)
+    INDEP_VARS = feature_columns(df)
+    estimate_xgb(df, DEP_VAR, INDEP_VARS, time_window_size=1, feature_layout='sparse',
+                 save_model_path=str(tmp_path))
+
+    kwargs = dict(INDEP_VARS=INDEP_VARS, time_window_sizes=[1], n_repeats=2, feature_layout='sparse',
+                  feature_groups=location_columns(INDEP_VARS))
+    in_process = month_attributions(df, str(tmp_path), n_cores=1, **kwargs)
+    in_workers = month_attributions(df, str(tmp_path), n_cores=3, **kwargs)
+
+    assert in_process['month'].nunique() == 4
+    columns = [col for col in in_process.columns if col != 'seconds']
+    pd.testing.assert_frame_equal(in_workers[columns], in_process[columns])
@@ -0,0 +1,24 @@
+import time
+from benchmark import DEP_VAR, make_listings, feature_columns
+from estimate_xgboost import estimate_xgb
+from scoring_server import ScoringService
+
+
+def test_latency_includes_feature_encoding(tmp_path):
+    df = make_listings(600, 3)
+    INDEP_VARS = feature_columns(df)
+    estimate_xgb(df, DEP_VAR, INDEP_VARS, time_window_size=1, error_metric=['rmse'], save_model_path=str(tmp_path))
+
+    service = ScoringService(str(tmp_path), INDEP_VARS, [1], reload_seconds=None, max_delay_ms=0)
+    try:
+        encode = service.encoder.encode
+
+        def slow_encode(listings):
+            time.sleep(0.05)
+            return encode(listings)
+
+        service.encoder.encode = slow_encode
+        service.predict([{'covered_area': 50.0}])
+        assert service.stats()['p50_ms'] >= 50
+    finally:
+        service.close()
@@ -0,0 +1,9 @@
+import pandas as pd
+from structural_breaks import breaks_at_confidence_levels
+
+
+def test_breaks_include_p_values_equal_to_alpha():
+    scan = pd.DataFrame({'split_month': pd.to_datetime(['2018-01-01', '2018-02-01', '2018-03-01']),
+                         'p_value': [0.05, 0.01, 0.2]})
+    breaks = breaks_at_confidence_levels(scan)
+    assert breaks == {'10%': ['2018-01', '2018-02'], '5%': ['2018-01', '2018-02'], '1%': ['2018-02']}
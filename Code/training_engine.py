@@ -0,0 +1,157 @@
+import numpy as np
+import xgboost as xgb
+from scipy import sparse
+from joblib import Parallel, delayed
+from sklearn.model_selection import ParameterGrid, check_cv
+
+# Training engines supported by estimate_xgb and process_month
+ENGINES = ['exact', 'hist']
+
+# XGBRegressor parameters that are not booster parameters
+SKLEARN_ONLY_PARAMS = ['n_estimators', 'n_jobs', 'missing', 'enable_categorical', 'feature_types',
+                       'feature_weights', 'importance_type', 'callbacks', 'early_stopping_rounds',
+                       'eval_metric', 'random_state', 'kwargs']
+
+
+def check_engine(engine):
+    if engine not in ENGINES:
+        raise ValueError(f"Invalid engine. Please choose from {ENGINES}.")
+
+
+def booster_params(params, seed_=789, max_bin=256, n_jobs=None):
+    """
+    Translate XGBRegressor parameters into `xgb.train` parameters for the hist engine.
+    Returns the parameters and the number of boosting rounds.
+    """
+    num_boost_round = params.get('n_estimators') or 100
+    params = {k: v for k, v in params.items() if k not in SKLEARN_ONLY_PARAMS}
+    params.update({
+        'objective': params.get('objective') or 'reg:squarederror',
+        'tree_method': 'hist',
+        'max_bin': max_bin,
+        'seed': seed_,
+    })
+    if n_jobs is not None:
+        params['nthread'] = n_jobs
+    params = {k: v for k, v in params.items() if v is not None}
+    return params, num_boost_round
+
+
+class HistWindow:
+    """
+    Quantized training window for the `hist` engine.
+
+    The quantile cuts of the training window are computed once (one QuantileDMatrix).
+    The cross-validation folds are quantized once with the same cuts, and every grid
+    search candidate is trained on those same matrices, instead of rebuilding the data
+    for each candidate and fold as GridSearchCV does. The test month is quantized with
+    the same cuts too.
+
+    :param X_train: Array with the features of the training window.
+    :param y_train: Array with the target of the training window.
+    :param sample_weight: Array with sample weights (or None).
+    :param max_bin: Integer, number of histogram bins per feature.
+    :param seed_: Integer, random seed.
+    :param n_jobs: Integer, threads per booster.
+    :param search_jobs: Integer, candidates/folds trained at the same time (threads).
+    :param feature_types: List of XGBoost feature types ('q', 'c'), for categorical features.
+    """
+
+    def __init__(self, X_train, y_train, sample_weight=None, max_bin=256, seed_=789,
+                 n_jobs=None, search_jobs=1, feature_types=None):
+        self.X_train = X_train if sparse.issparse(X_train) else np.asarray(X_train, dtype=np.float32)
+        self.y_train = np.asarray(y_train).ravel()
+        self.sample_weight = sample_weight
+        self.max_bin = max_bin
+        self.seed_ = seed_
+        self.n_jobs = n_jobs
+        self.search_jobs = search_jobs
+        self.matrix_args = {}
+        if feature_types is not None:
+            self.matrix_args = {'feature_types': feature_types, 'enable_categorical': True}
+
+        # The whole window is not weighted (as the final fit of the exact engine); the
+        # weights are used when fitting the cross-validation folds
+        self.dtrain = xgb.QuantileDMatrix(self.X_train, self.y_train, max_bin=max_bin, **self.matrix_args)
+        self._folds = {}
+
+    def _matrix(self, rows, label=True):
+        weight = None if self.sample_weight is None else np.asarray(self.sample_weight)[rows]
+        return xgb.QuantileDMatrix(self.X_train[rows], self.y_train[rows] if label else None,
+                                   weight=weight if label else None,
+                                   ref=self.dtrain, max_bin=self.max_bin, **self.matrix_args)
+
+    def folds(self, cv, n_samples=None):
+        """
+        Quantized (train, validation, y_validation) matrices of each fold, built once per cv.
+        If `n_samples` is given, only the last (most recent) `n_samples` rows of each
+        training fold are used.
+        """
+        cv = check_cv(cv)
+        key = (repr(cv), n_samples)
+        if key not in self._folds:
+            self._folds[key] = []
+            for train_idx, valid_idx in cv.split(self.X_train):
+                if n_samples is not None:
+                    train_idx = train_idx[-n_samples:]
+                self._folds[key].append(
+                    (self._matrix(train_idx), self._matrix(valid_idx, label=False), self.y_train[valid_idx])
+                )
+        return self._folds[key]
+
+    def _fold_score(self, params, fold):
+        dtrain, dvalid, y_valid = fold
+        params, num_boost_round = booster_params(params, self.seed_, self.max_bin, self.n_jobs)
+        booster = xgb.train(params, dtrain, num_boost_round=num_boost_round)
+        return -np.mean((booster.predict(dvalid) - y_valid) ** 2)
+
+    def fold_scores(self, params, cv, n_samples=None, fold_ids=None):
+        """Cross-validation score (negative MSE) of a single candidate in each fold (or in `fold_ids`)."""
+        if fold_ids is None:
+            fold_ids = range(len(self.folds(cv, n_samples)))
+        return self.candidate_fold_scores([(params, i) for i in fold_ids], cv, n_samples)
+
+    def candidate_fold_scores(self, tasks, cv, n_samples=None):
+        """Cross-validation score (negative MSE) of each (candidate parameters, fold id) task, fitted at the same time."""
+        folds = self.folds(cv, n_samples)
+        return Parallel(n_jobs=self.search_jobs, backend='threading')(
+            delayed(self._fold_score)(params, folds[i]) for params, i in tasks
+        )
+
+    def score(self, params, cv, n_samples=None):
+        """Mean cross-validation score (negative MSE) of a single candidate."""
+        return float(np.mean(self.fold_scores(params, cv, n_samples)))
+
+    def grid_search(self, base_params, param_grid, cv):
+        """
+        Exhaustive search over `param_grid`, scored like GridSearchCV with
+        scoring='neg_mean_squared_error'. Returns the best candidate's parameters.
+        """
+        candidates = list(ParameterGrid(param_grid))
+        folds = self.folds(cv)
+
+        tasks = [(i, fold) for i in range(len(candidates)) for fold in folds]
+        scores = Parallel(n_jobs=self.search_jobs, backend='threading')(
+            delayed(self._fold_score)({**base_params, **candidates[i]}, fold) for i, fold in tasks
+        )
+        mean_scores = np.asarray(scores).reshape(len(candidates), len(folds)).mean(axis=1)
+
+        self.cv_results_ = {'params': candidates, 'mean_test_score': mean_scores}
+        self.best_params_ = candidates[int(np.argmax(mean_scores))]
+        return self.best_params_
+
+    def fit(self, params):
+        """Train on the whole quantized window and return an XGBRegressor with the result."""
+        train_params, num_boost_round = booster_params(params, self.seed_, self.max_bin, self.n_jobs)
+        booster = xgb.train(train_params, self.dtrain, num_boost_round=num_boost_round)
+
+        model = xgb.XGBRegressor()
+        model.load_model(bytearray(booster.save_raw('ubj')))
+        model.set_params(**{k: v for k, v in params.items() if v is not None})
+        model.set_params(tree_method='hist', max_bin=self.max_bin)
+        return model
+
+    def predict(self, model, X_test):
+        """Predict a test sample quantized with the cuts of the training window."""
+        dtest = xgb.QuantileDMatrix(X_test, ref=self.dtrain, max_bin=self.max_bin, **self.matrix_args)
+        return model.get_booster().predict(dtest)